@@ -0,0 +1,147 @@
+#
+# bcpconvert - convert DWC bcp-format data files
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import gzip
+from argparse import ArgumentParser
+
+from .db.dwcbcp import (data_file_kind, DWCBCPConnection)
+from .db.bcp.cache import (open_cache, write_cache)
+from .db.bcp.compressed import (CompressedFileWriter, compressed_suffix,
+                                open_data_file)
+
+# Suffixes of input files that are compressed using a stream format
+# (which cannot be randomly accessed, and thus cannot be read
+# directly by the bcp engine.)
+_stream_suffixes = ['.gz', '.zst']
+
+def _open_input(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    elif filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('%s: zstd input requires the zstandard package'
+                             % filename)
+        fp = open(filename, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(fp, closefd = True)
+    else:
+        return open_data_file(filename)
+
+def _output_name(filename):
+    for s in _stream_suffixes:
+        if filename.endswith(s):
+            return filename[:-len(s)] + compressed_suffix
+    return filename + compressed_suffix
+
+def _input_files(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for f in sorted(os.listdir(p)):
+                base = f
+                for s in _stream_suffixes:
+                    if f.endswith(s):
+                        base = f[:-len(s)]
+                if data_file_kind(base, suffix = None) is not None:
+                    yield os.path.join(p, f)
+        else:
+            yield p
+
+def compress_file(input_file, output_file, codec = 'zlib', level = None,
+                  chunk_size = 1024 * 1024):
+    """
+    Convert a data file to block-compressed format.
+
+    input_file may be an uncompressed file, a block-compressed file,
+    or a file compressed with gzip ('.gz') or zstd ('.zst').  The
+    output is written to a temporary file and renamed to output_file
+    when complete.
+    """
+    tmpfile = output_file + '.tmp'
+    with _open_input(input_file) as inf:
+        with CompressedFileWriter(tmpfile, codec = codec, level = level,
+                                  chunk_size = chunk_size) as outf:
+            data = inf.read(chunk_size)
+            while data:
+                outf.write(data)
+                data = inf.read(chunk_size)
+    os.rename(tmpfile, output_file)
+
+def cache_dir(dirname):
+    """
+    Create column caches for all data files in a directory.
+
+    Caches that already exist, and are up-to-date, are left
+    unchanged.  Returns a list of the data files that were converted.
+    """
+    converted = []
+    with DWCBCPConnection([dirname]) as conn:
+        for tbl in conn.tables():
+            for f in tbl.data_files():
+                if open_cache(tbl, f) is None:
+                    write_cache(tbl, f)
+                    converted.append(f)
+    return converted
+
+def main():
+    p = ArgumentParser(
+        description = 'Convert bcp data files to block-compressed format,'
+        ' or create column caches for faster reading.')
+    p.add_argument('--codec', choices = ('zlib', 'zstd'), default = 'zlib',
+                   help = 'compression algorithm (default: zlib)')
+    p.add_argument('--level', metavar = 'N', type = int,
+                   help = 'compression level')
+    p.add_argument('--chunk-size', metavar = 'KIB', type = int,
+                   default = 1024,
+                   help = 'uncompressed size of each chunk (default: 1024)')
+    p.add_argument('--delete-input', action = 'store_true',
+                   help = 'delete each input file after converting it')
+    p.add_argument('--cache', action = 'store_true',
+                   help = 'create column caches rather than compressing')
+    p.add_argument('paths', metavar = 'PATH', nargs = '+',
+                   help = 'data file or directory to convert')
+    opts = p.parse_args()
+
+    status = 0
+    if opts.cache:
+        for d in opts.paths:
+            try:
+                for f in cache_dir(d):
+                    print('%s -> %s.cache' % (f, f))
+            except Exception as e:
+                sys.stderr.write('%s: %s\n' % (d, e))
+                status = 1
+        sys.exit(status)
+
+    for f in _input_files(opts.paths):
+        if f.endswith(compressed_suffix):
+            continue
+        out = _output_name(f)
+        try:
+            compress_file(f, out, codec = opts.codec, level = opts.level,
+                          chunk_size = opts.chunk_size * 1024)
+        except Exception as e:
+            sys.stderr.write('%s: %s\n' % (f, e))
+            status = 1
+            continue
+        print('%s -> %s' % (f, out))
+        if opts.delete_input:
+            os.unlink(f)
+    sys.exit(status)
@@ -0,0 +1,201 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end benchmark of the conversion process.
+
+This generates a synthetic data directory (see downcast.synthetic),
+or uses an existing one, and then runs downcast (--init, --batch, and
+optionally --batch --terminate) on it, measuring the time and memory
+used by each stage.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from datetime import timedelta
+from argparse import ArgumentParser
+
+from .timestamp import T
+from .synthetic import generate
+
+# Command used to run each stage (in a fresh interpreter, so that the
+# resource usage of each stage can be measured separately)
+_downcast_command = [sys.executable, '-c',
+                     'import sys; from downcast.main import main; '
+                     'main(sys.argv[1:])']
+
+def _run_stage(name, args, log_file):
+    """
+    Run a command, and measure its resource usage.
+
+    The result is a dictionary containing 'stage', 'wall_time' (in
+    seconds), 'cpu_time' (user and system time, in seconds), and
+    'max_rss' (peak resident set size of the process or any of its
+    descendants, in kilobytes.)
+    """
+    env = dict(os.environ)
+    pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [pkgdir] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    with open(log_file, 'ab') as log:
+        start = time.monotonic()
+        proc = subprocess.Popen(args, stdin = subprocess.DEVNULL,
+                                stdout = log, stderr = log, env = env)
+        # Use wait4 rather than proc.wait, in order to obtain the
+        # resource usage of this particular process
+        (_, status, usage) = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        end = time.monotonic()
+    if status != 0:
+        raise Exception('%s failed (see %s)' % (name, log_file))
+    return {
+        'stage': name,
+        'wall_time': end - start,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'max_rss': usage.ru_maxrss,
+    }
+
+def run_benchmark(data_dir, work_dir, terminate = True, extra_args = []):
+    """
+    Convert a synthetic data directory, and return a list of results.
+
+    data_dir must contain a 'synthetic.json' file describing the data.
+    The output and log files are written to work_dir.
+    """
+    with open(os.path.join(data_dir, 'synthetic.json')) as f:
+        summary = json.load(f)
+
+    conf_file = os.path.join(work_dir, 'server.conf')
+    with open(conf_file, 'wt') as f:
+        f.write('[synthetic]\ntype = bcp\nbcp-path = %s\n'
+                % os.path.abspath(data_dir))
+    output_dir = os.path.join(work_dir, 'output')
+    log_file = os.path.join(work_dir, 'benchmark.log')
+
+    start = T(summary['start']) - timedelta(minutes = 1)
+    end = T(summary['end']) + timedelta(minutes = 1)
+    common = (_downcast_command
+              + ['--server', 'synthetic', '--password-file', conf_file,
+                 '--output-dir', output_dir] + list(extra_args))
+
+    stages = [('init', ['--init', '--start', str(start)]),
+              ('batch', ['--batch', '--end', str(end)])]
+    if terminate:
+        stages.append(('terminate', ['--batch', '--end', str(end),
+                                     '--terminate']))
+
+    rows = sum(summary['rows'].values())
+    data_seconds = (T(summary['data_end']) - T(summary['data_start'])) \
+                   .total_seconds()
+    results = []
+    for (name, args) in stages:
+        r = _run_stage(name, common + args, log_file)
+        if name == 'batch':
+            r['rows_per_second'] = rows / r['wall_time']
+            r['data_seconds_per_second'] = (data_seconds * summary['beds']
+                                            / r['wall_time'])
+        results.append(r)
+    return results
+
+def _format_results(results):
+    lines = ['%-10s %9s %9s %12s %12s %10s'
+             % ('stage', 'wall (s)', 'cpu (s)', 'rows/s',
+                'data s/s', 'RSS (MiB)')]
+    for r in results:
+        rps = r.get('rows_per_second')
+        dps = r.get('data_seconds_per_second')
+        lines.append('%-10s %9.2f %9.2f %12s %12s %10.1f'
+                     % (r['stage'], r['wall_time'], r['cpu_time'],
+                        '-' if rps is None else '%.0f' % rps,
+                        '-' if dps is None else '%.1f' % dps,
+                        r['max_rss'] / 1024))
+    return '\n'.join(lines)
+
+def main():
+    p = ArgumentParser(
+        description = 'Measure the speed of converting synthetic data.',
+        epilog = 'Additional arguments following "--" are passed to'
+        ' downcast.')
+    p.add_argument('--data-dir', metavar = 'DIR',
+                   help = 'existing synthetic data directory')
+    p.add_argument('--work-dir', metavar = 'DIR',
+                   help = 'directory for output files (default: temporary)')
+    p.add_argument('--keep', action = 'store_true',
+                   help = 'do not delete the temporary directory')
+    p.add_argument('--no-terminate', action = 'store_true',
+                   help = 'do not measure the terminate stage')
+    p.add_argument('--json', metavar = 'FILE',
+                   help = 'write results to FILE in JSON format')
+    g = p.add_argument_group('synthetic data options')
+    g.add_argument('--beds', metavar = 'N', type = int, default = 4,
+                   help = 'number of beds (default: 4)')
+    g.add_argument('--hours', metavar = 'H', type = float, default = 1.0,
+                   help = 'length of time to generate (default: 1)')
+    g.add_argument('--signals', metavar = 'N', type = int, default = 4,
+                   help = 'number of waveforms per bed (default: 4)')
+    g.add_argument('--clock-adjustments', metavar = 'N', type = int,
+                   default = 0,
+                   help = 'number of clock adjustments per bed')
+    g.add_argument('--seed', metavar = 'N', type = int, default = 1,
+                   help = 'random number seed')
+    p.add_argument('downcast_args', metavar = 'ARG', nargs = '*',
+                   help = 'additional arguments for downcast')
+    opts = p.parse_args()
+
+    if opts.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix = 'downcast-benchmark-')
+    else:
+        work_dir = opts.work_dir
+        if os.path.exists(os.path.join(work_dir, 'output')):
+            sys.exit('%s: directory %s already exists'
+                     % (sys.argv[0], os.path.join(work_dir, 'output')))
+        os.makedirs(work_dir, exist_ok = True)
+
+    try:
+        results = []
+        data_dir = opts.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(work_dir, 'data')
+            start = time.monotonic()
+            generate(data_dir, beds = opts.beds, hours = opts.hours,
+                     signals = opts.signals,
+                     clock_adjustments = opts.clock_adjustments,
+                     seed = opts.seed)
+            print('generated data in %.2f seconds'
+                  % (time.monotonic() - start))
+
+        results = run_benchmark(data_dir, work_dir,
+                                terminate = not opts.no_terminate,
+                                extra_args = opts.downcast_args)
+        print(_format_results(results))
+
+        if opts.json:
+            with open(opts.json, 'wt') as f:
+                json.dump(results, f, indent = 1, sort_keys = True)
+                f.write('\n')
+    finally:
+        if opts.work_dir is None and not opts.keep:
+            shutil.rmtree(work_dir, ignore_errors = True)
+        elif opts.work_dir is None:
+            print('output saved in %s' % work_dir)
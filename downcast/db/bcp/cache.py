@@ -0,0 +1,470 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import bisect
+import mmap
+import struct
+import logging
+import uuid
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from ..exceptions import (Error, OperationalError, ProgrammingError)
+from .types import (INTEGER, ROWID, BOOLEAN, DATETIME, UUID)
+from ... import timestamp
+
+# A column cache file contains a copy of the contents of a single
+# data file, converted into arrays of binary values.  It consists of:
+#
+#  - the magic string;
+#
+#  - the length of the header (32-bit little-endian);
+#
+#  - the header, a JSON object describing the table format, the
+#    source file, and the location of each array;
+#
+#  - the arrays, each aligned to a multiple of 8 bytes.
+#
+# Each column is stored in one of the following ways:
+#
+#  - 'int': an array of signed 64-bit integers.
+#
+#  - 'bool': an array of signed 8-bit integers.
+#
+#  - 'time': an array of signed 64-bit integers (microseconds since
+#    1970-01-01 00:00 UTC), plus an array of signed 16-bit integers
+#    (the original timezone offset in minutes.)
+#
+#  - 'uuid': an array of 16-byte strings.
+#
+#  - 'raw': an array of (n + 1) 64-bit integers giving the start and
+#    end of each value in a blob containing the original field
+#    contents.
+#
+# 'int', 'bool', 'time', and 'uuid' columns may also have an array of
+# 8-bit null flags.  In addition, the cache includes an array giving
+# the starting byte offset of each row in the original data file
+# (plus the end of the last row.)
+
+_magic = b'\x89BCC\r\n\x1a\n'
+_version = 1
+_byteorder = sys.byteorder
+
+cache_suffix = '.cache'
+
+_epoch = datetime(1970, 1, 1, tzinfo = timezone.utc)
+_one_us = timedelta(microseconds = 1)
+_one_min = timedelta(minutes = 1)
+
+def _column_kind(data_type):
+    if data_type is INTEGER or data_type is ROWID:
+        return 'int'
+    elif data_type is BOOLEAN:
+        return 'bool'
+    elif data_type is DATETIME:
+        return 'time'
+    elif data_type is UUID:
+        return 'uuid'
+    else:
+        return 'raw'
+
+def _table_format(table):
+    return [[name, list(fmt), ty.__name__]
+            for (name, fmt, ty) in zip(table._col_name,
+                                       table._col_format,
+                                       table._col_type)]
+
+def _source_info(data_file):
+    st = os.stat(data_file)
+    return [st.st_size, st.st_mtime_ns]
+
+def cache_file_name(data_file):
+    """Get the name of the column cache for a given data file."""
+    return data_file + cache_suffix
+
+################################################################
+
+def write_cache(table, data_file, cache_file = None):
+    """
+    Convert a data file into a column cache.
+
+    table is the BCPTable to which the data file belongs; the table
+    format must already be defined (i.e., at least one data file must
+    have been imported.)  The cache is written to a temporary file
+    and renamed to cache_file (by default, data_file + '.cache') when
+    complete.
+    """
+    from .connection import BCPTableIterator
+
+    if cache_file is None:
+        cache_file = cache_file_name(data_file)
+
+    source = _source_info(data_file)
+    kinds = [_column_kind(ty) for ty in table._col_type]
+    ncols = len(kinds)
+
+    values = []
+    extra = []
+    nulls = []
+    for k in kinds:
+        if k == 'int' or k == 'time':
+            values.append(array('q'))
+        elif k == 'bool':
+            values.append(array('b'))
+        elif k == 'raw':
+            values.append(array('q', [0]))
+        else:
+            values.append(bytearray())
+        if k == 'time':
+            extra.append(array('h'))
+        elif k == 'raw':
+            extra.append(bytearray())
+        else:
+            extra.append(None)
+        nulls.append(bytearray())
+    row_offsets = array('q')
+
+    with BCPTableIterator(table, filename = data_file, raw = True) as it:
+        offs = 0
+        row = it._next_row
+        while row:
+            row_offsets.append(offs)
+            for i in range(ncols):
+                b = row[i]
+                k = kinds[i]
+                if k == 'raw':
+                    if b:
+                        extra[i] += b
+                    values[i].append(len(extra[i]))
+                    continue
+                if not b:
+                    nulls[i].append(1)
+                    if k == 'uuid':
+                        values[i] += bytes(16)
+                    else:
+                        values[i].append(0)
+                    if k == 'time':
+                        extra[i].append(0)
+                    continue
+                nulls[i].append(0)
+                v = table._col_type[i].from_bytes(b)
+                if k == 'int':
+                    values[i].append(v)
+                elif k == 'bool':
+                    values[i].append(1 if v else 0)
+                elif k == 'uuid':
+                    values[i] += v.bytes
+                else:
+                    values[i].append((v - _epoch) // _one_us)
+                    extra[i].append(v.utcoffset() // _one_min)
+            offs = it._input_offset()
+            row = it._fetch_next()
+        row_offsets.append(offs)
+
+    # Arrange the arrays in the output file
+    sections = []
+    def add_section(data):
+        sections.append(data)
+        return len(sections) - 1
+
+    columns = []
+    for i in range(ncols):
+        col = {'kind': kinds[i], 'values': add_section(values[i])}
+        if extra[i] is not None:
+            col['extra'] = add_section(extra[i])
+        if kinds[i] != 'raw' and any(nulls[i]):
+            col['nulls'] = add_section(nulls[i])
+        columns.append(col)
+
+    header = {
+        'version': _version,
+        'byteorder': _byteorder,
+        'format': _table_format(table),
+        'source': source,
+        'rows': len(row_offsets) - 1,
+        'row_offsets': add_section(row_offsets),
+        'columns': columns,
+    }
+
+    # Compute the location of each section.  The header length
+    # depends on the section offsets, so repeat until it's stable.
+    hlen = 0
+    while True:
+        pos = len(_magic) + 4 + hlen
+        locs = []
+        for s in sections:
+            pos += -pos % 8
+            n = len(s) * (s.itemsize if isinstance(s, array) else 1)
+            locs.append([pos, n])
+            pos += n
+        header['sections'] = locs
+        hdata = json.dumps(header, sort_keys = True).encode()
+        if len(hdata) == hlen:
+            break
+        hlen = len(hdata)
+
+    tmpfile = cache_file + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(_magic)
+        f.write(struct.pack('<I', hlen))
+        f.write(hdata)
+        for (s, (pos, _)) in zip(sections, locs):
+            f.write(bytes(pos - f.tell()))
+            f.write(s)
+        f.flush()
+        os.fdatasync(f.fileno())
+
+    # If the data file was modified while we were reading it, then
+    # the cache is invalid
+    if _source_info(data_file) != source:
+        os.unlink(tmpfile)
+        raise OperationalError('%s was modified during conversion'
+                               % data_file)
+    os.rename(tmpfile, cache_file)
+
+def open_cache(table, data_file, cache_file = None):
+    """
+    Open the column cache for a data file, if it exists.
+
+    If the cache exists, and it is up-to-date with respect to the
+    data file and the table format, this returns a ColumnCache.
+    Otherwise, this returns None.
+    """
+    if cache_file is None:
+        cache_file = cache_file_name(data_file)
+    try:
+        fp = open(cache_file, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        with fp:
+            return ColumnCache(fp, table, _source_info(data_file))
+    except StaleCacheError:
+        return None
+    except Exception as e:
+        logging.warning('unable to read %s: %s' % (cache_file, e))
+        return None
+
+class StaleCacheError(Exception):
+    """Exception indicating that a cache file is out of date."""
+    pass
+
+class ColumnCache:
+    """
+    Read-only view of a column cache file.
+
+    The file is memory-mapped; values are converted into the
+    appropriate Python types only when they are requested.
+    """
+
+    def __init__(self, fp, table, source):
+        self.name = fp.name
+        if fp.read(len(_magic)) != _magic:
+            raise ValueError('not a cache file')
+        (hlen,) = struct.unpack('<I', fp.read(4))
+        header = json.loads(fp.read(hlen).decode())
+
+        if (header['version'] != _version
+                or header['byteorder'] != _byteorder
+                or header['format'] != _table_format(table)
+                or header['source'] != source):
+            raise StaleCacheError()
+
+        self._map = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        buf = memoryview(self._map)
+
+        def section(n, fmt = 'B'):
+            (pos, size) = header['sections'][n]
+            return buf[pos:pos + size].cast(fmt)
+
+        self.nrows = header['rows']
+        self.row_offsets = section(header['row_offsets'], 'q')
+
+        self.getters = []
+        for (i, col) in enumerate(header['columns']):
+            kind = col['kind']
+            if kind == 'int':
+                get = section(col['values'], 'q').__getitem__
+            elif kind == 'bool':
+                get = _bool_getter(section(col['values'], 'b'))
+            elif kind == 'time':
+                get = _time_getter(section(col['values'], 'q'),
+                                   section(col['extra'], 'h'))
+            elif kind == 'uuid':
+                get = _uuid_getter(section(col['values']))
+            elif kind == 'raw':
+                get = _raw_getter(section(col['values'], 'q'),
+                                  section(col['extra']),
+                                  table._col_type[i].from_bytes)
+            else:
+                raise ValueError('unknown column type %r' % kind)
+            if 'nulls' in col:
+                get = _null_getter(section(col['nulls']), get)
+            self.getters.append(get)
+
+    def row(self, n):
+        """Retrieve the nth row of the table."""
+        return [get(n) for get in self.getters]
+
+    def row_number(self, offset):
+        """Find the row that begins at the given offset in the data file."""
+        return bisect.bisect_left(self.row_offsets, offset, 0, self.nrows)
+
+def _null_getter(nulls, get):
+    return lambda n: None if nulls[n] else get(n)
+
+def _bool_getter(values):
+    return lambda n: (values[n] != 0)
+
+_tz_base = {}
+def _time_getter(values, offsets):
+    def get(n):
+        tzoffs = offsets[n]
+        base = _tz_base.get(tzoffs)
+        if base is None:
+            tz = timestamp.fixed_timezone(tzoffs)
+            base = _tz_base[tzoffs] = _epoch.astimezone(tz)
+        return timestamp.T(base + timedelta(microseconds = values[n]))
+    return get
+
+def _uuid_getter(values):
+    return lambda n: uuid.UUID(bytes = bytes(values[16 * n : 16 * n + 16]))
+
+def _raw_getter(bounds, blob, from_bytes):
+    def get(n):
+        start = bounds[n]
+        end = bounds[n + 1]
+        if start == end:
+            return None
+        return from_bytes(bytes(blob[start:end]))
+    return get
+
+################################################################
+
+class BCPCachedTableIterator:
+    """
+    Iterator for reading a table whose data files are all cached.
+
+    This provides the same interface as BCPTableIterator, but rows
+    are retrieved from column caches rather than by parsing the
+    original data files.
+    """
+
+    def __init__(self, table):
+        self._table = table
+        self._caches = [f[4] for f in table._files]
+        if self._table._order_column is None:
+            self._loc_column = 0
+        else:
+            self._loc_column = self._table._order_column
+        self._seek_start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._caches = []
+        self._seek_end()
+
+    def fetch(self):
+        """Fetch and return the next row of input data."""
+        row = self._next_row
+        self._next_row = self._fetch_next()
+        return row
+
+    def _fetch_next(self):
+        while self._filenum < len(self._caches):
+            c = self._caches[self._filenum]
+            n = self._rownum
+            if n < c.nrows:
+                self._rownum = n + 1
+                return c.row(n)
+            self._filenum += 1
+            self._rownum = 0
+        return None
+
+    def seek(self, column_number, target):
+        """
+        Jump to a given position in the input data.
+
+        If target is None, jump to the beginning of the table.
+        Otherwise, jump to the first row where the given column
+        matches the target value.
+        """
+        if target is None:
+            self._seek_start()
+        elif column_number == self._table._order_column:
+            self._seek_location(target)
+        elif column_number in self._table._index_columns:
+            self._seek_indexed(column_number, target)
+        else:
+            raise ProgrammingError('cannot seek by column %s'
+                                   % column_number)
+
+    def _seek_location(self, target):
+        tbl = self._table
+        fstart = [f[1] for f in tbl._files]
+        filenum = bisect.bisect_right(fstart, target) - 1
+        if filenum < 0:
+            self._seek_start()
+            return
+
+        try:
+            get = self._caches[filenum].getters[self._loc_column]
+            lo = 0
+            hi = self._caches[filenum].nrows
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if get(mid) < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            self._filenum = filenum
+            self._rownum = lo
+            self._next_row = self._fetch_next()
+        except Error:
+            raise
+        except Exception as e:
+            raise OperationalError('unable to seek to %r in %s: %s'
+                                   % (target, tbl.name, e))
+
+    def _seek_indexed(self, column_number, target):
+        for (filenum, f) in enumerate(self._table._files):
+            offs = f[3][column_number].get(target, None)
+            if offs is not None:
+                self._filenum = filenum
+                self._rownum = self._caches[filenum].row_number(offs)
+                self._next_row = self._fetch_next()
+                return
+        self._seek_end()
+
+    def _seek_start(self):
+        self._filenum = 0
+        self._rownum = 0
+        self._next_row = self._fetch_next()
+
+    def _seek_end(self):
+        self._filenum = len(self._caches)
+        self._rownum = 0
+        self._next_row = None
@@ -0,0 +1,247 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import io
+import struct
+import zlib
+
+# A block-compressed data file consists of:
+#
+#  - a 16-byte header: the magic string, the name of the compression
+#    algorithm ('zlib' or 'zstd'), and the uncompressed size of each
+#    chunk (32-bit little-endian);
+#
+#  - a sequence of chunks, each of which is compressed independently;
+#
+#  - an index giving the file offset of the start of each chunk, and
+#    the offset of the end of the last chunk (64-bit little-endian);
+#
+#  - a 24-byte trailer: the total uncompressed size, the file offset
+#    of the index (both 64-bit little-endian), and the magic string.
+#
+# Since every chunk (except the last) has the same uncompressed size,
+# any position in the uncompressed data can be found by reading a
+# single chunk.
+
+_magic = b'\x89BCZ\r\n\x1a\n'
+_header = struct.Struct('<8s4sI')
+_trailer = struct.Struct('<QQ8s')
+
+compressed_suffix = '.bcz'
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd compression requires the zstandard package')
+    return zstandard
+
+def _decompressor(codec):
+    if codec == b'zlib':
+        return zlib.decompress
+    elif codec == b'zstd':
+        return _zstd().ZstdDecompressor().decompress
+    else:
+        raise ValueError('unknown compression type %r' % codec)
+
+def _compressor(codec, level):
+    if codec == 'zlib':
+        if level is None:
+            level = 6
+        return lambda data: zlib.compress(data, level)
+    elif codec == 'zstd':
+        if level is None:
+            level = 3
+        return _zstd().ZstdCompressor(level = level).compress
+    else:
+        raise ValueError('unknown compression type %r' % codec)
+
+def is_compressed_file(fp):
+    """Check whether an open binary file is block-compressed."""
+    pos = fp.tell()
+    try:
+        fp.seek(0)
+        return (fp.read(len(_magic)) == _magic)
+    finally:
+        fp.seek(pos)
+
+def open_data_file(filename):
+    """
+    Open a data file for reading.
+
+    If the file is block-compressed, the result is a
+    CompressedFileReader; otherwise, it is a normal binary file
+    object.  In either case, the file can be read and randomly
+    accessed as if it were uncompressed.
+    """
+    fp = open(filename, 'rb')
+    try:
+        if is_compressed_file(fp):
+            return CompressedFileReader(fp)
+        return fp
+    except BaseException:
+        fp.close()
+        raise
+
+class CompressedFileReader(io.RawIOBase):
+    """
+    Seekable reader for a block-compressed data file.
+
+    The contents of the file are presented as an ordinary read-only
+    binary file: read(), seek(), and tell() operate on the
+    uncompressed data.  Only one chunk is held in memory at a time.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.name = fp.name
+
+        fp.seek(0)
+        (magic, codec, self._chunk_size) = _header.unpack(
+            fp.read(_header.size))
+        if magic != _magic or self._chunk_size <= 0:
+            raise ValueError('%s is not a compressed data file' % self.name)
+        self._decompress = _decompressor(codec)
+
+        fp.seek(-_trailer.size, os.SEEK_END)
+        (self._size, index_offset, magic) = _trailer.unpack(
+            fp.read(_trailer.size))
+        if magic != _magic:
+            raise ValueError('%s is truncated' % self.name)
+
+        n = -(-self._size // self._chunk_size)
+        fp.seek(index_offset)
+        self._index = struct.unpack('<%dQ' % (n + 1), fp.read(8 * (n + 1)))
+
+        self._pos = 0
+        self._chunk_num = None
+        self._chunk = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+            self._chunk = b''
+        io.RawIOBase.close(self)
+
+    def _load_chunk(self, num):
+        if num != self._chunk_num:
+            start = self._index[num]
+            end = self._index[num + 1]
+            self._fp.seek(start)
+            self._chunk = self._decompress(self._fp.read(end - start))
+            self._chunk_num = num
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        parts = []
+        while size > 0 and self._pos < self._size:
+            (num, offs) = divmod(self._pos, self._chunk_size)
+            self._load_chunk(num)
+            data = self._chunk[offs:offs + size]
+            if not data:
+                raise ValueError('%s is corrupted' % self.name)
+            parts.append(data)
+            self._pos += len(data)
+            size -= len(data)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+class CompressedFileWriter:
+    """
+    Writer for a block-compressed data file.
+
+    Data is written sequentially using write(); the index and trailer
+    are written when the file is closed.
+    """
+
+    def __init__(self, filename, codec = 'zlib', level = None,
+                 chunk_size = 1024 * 1024):
+        self._compress = _compressor(codec, level)
+        self._chunk_size = chunk_size
+        self._fp = open(filename, 'wb')
+        self._fp.write(_header.pack(_magic, codec.encode(), chunk_size))
+        self._index = []
+        self._buf = bytearray()
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fp.close()
+
+    def write(self, data):
+        self._buf += data
+        self._size += len(data)
+        while len(self._buf) >= self._chunk_size:
+            self._write_chunk(bytes(self._buf[:self._chunk_size]))
+            del self._buf[:self._chunk_size]
+        return len(data)
+
+    def _write_chunk(self, data):
+        self._index.append(self._fp.tell())
+        self._fp.write(self._compress(data))
+
+    def close(self, fsync = True):
+        if self._fp.closed:
+            return
+        if self._buf:
+            self._write_chunk(bytes(self._buf))
+            self._buf = bytearray()
+        index_offset = self._fp.tell()
+        self._index.append(index_offset)
+        self._fp.write(struct.pack('<%dQ' % len(self._index), *self._index))
+        self._fp.write(_trailer.pack(self._size, index_offset, _magic))
+        self._fp.flush()
+        if fsync:
+            os.fdatasync(self._fp.fileno())
+        self._fp.close()
@@ -25,6 +25,8 @@
 from ..exceptions import (Error, OperationalError,
                           DataSyntaxError, ProgrammingError)
 from .cursor import BCPCursor
+from .compressed import open_data_file
+from .cache import (open_cache, BCPCachedTableIterator)
 
 class BCPConnection:
     """
@@ -58,9 +60,13 @@ def add_table(self, name):
     def get_table(self, name):
         """Retrieve a table by name."""
         if name not in self._tables:
-            raise OperationalError('undefined table %s' % q.table)
+            raise OperationalError('undefined table %s' % name)
         return self._tables[name]
 
+    def tables(self):
+        """Retrieve a list of all tables."""
+        return list(self._tables.values())
+
     def parse(self, statement, params):
         """Parse an SQL statement."""
         return self._parser.parse(statement, params)
@@ -109,6 +115,7 @@ def __init__(self, name):
 
         self._sync_pattern = re.compile(b'\n().')
         self._sync_pattern_group = 1
+        self._follow = False
 
         self._files = []
 
@@ -188,6 +195,20 @@ def set_sync_pattern(self, pattern, group = 1):
         self._sync_pattern = re.compile(pattern)
         self._sync_pattern_group = group
 
+    def set_follow(self, follow):
+        """
+        Allow the last data file to grow while it is being read.
+
+        If follow is true, only complete rows are read from the last
+        data file: the last row in the file is ignored until another
+        row is added after it (or until another data file is
+        imported.)  Rows that are appended to the file later on are
+        added by calling refresh().
+
+        This function must be called before importing any data files.
+        """
+        self._follow = follow
+
     def add_data_file(self, data_file, format_file):
         """
         Import a file into the table.
@@ -195,7 +216,12 @@ def add_data_file(self, data_file, format_file):
         data_file is the name of the raw data file; format_file is the
         name of the corresponding freebcp format file.  (Note that
         only a very small subset of the possible freebcp formats are
-        supported.)
+        supported.)  The data file may also be block-compressed (see
+        compressed.py.)
+
+        If an up-to-date column cache exists for the data file (see
+        cache.py), it is used in place of the data file when reading
+        the table.
 
         If multiple data files are supplied, their contents are
         concatenated; the files must have the same format.
@@ -261,12 +287,17 @@ def add_data_file(self, data_file, format_file):
             else:
                 location = row[self._order_column]
                 if self._files:
-                    (oldfile, oldloc, _, _) = self._files[-1]
+                    (oldfile, oldloc, _, _, _) = self._files[-1]
                     if location <= oldloc:
                         raise OperationalError(
                             'files out of order (%s, %s)'
                             % (oldfile, data_file))
 
+            # The previous file is no longer being written, so all of
+            # its rows are now complete
+            if self._follow and self._files:
+                self._complete_last_file()
+
             row1_offset = it._input_offset()
 
             # Get the total file size
@@ -285,35 +316,141 @@ def add_data_file(self, data_file, format_file):
                         'sync pattern not found in first row of %s'
                         % data_file)
 
+            # If the file may still be growing, the last row may be
+            # incomplete
+            cache = open_cache(self, data_file)
+            if self._follow:
+                end = fsize
+                fsize = max(row1_offset,
+                            self._last_row_offset(f, 0, end, data_file))
+                if fsize != end:
+                    cache = None
+
             f.seek(oldpos)
 
             # If any indices are required, read the entire data file
+            # (or the index columns of the cache)
             indices = {}
             if self._index_columns:
                 icols = list(self._index_columns)
                 for i in icols:
                     indices[i] = {}
-                offs = 0
-                while row:
-                    for i in icols:
-                        v = row[i]
-                        k = indices[i].setdefault(v, offs)
-                        if k != offs:
-                            raise OperationalError(
-                                'duplicate %s in %s at byte %s and %s'
-                                % (self._col_name[i], data_file, k, offs))
-                        for (oldfile, _, _, oldind) in self._files:
-                            if v in oldind[i]:
-                                raise OperationalError(
-                                    ('duplicate %s in %s (byte %s)'
-                                     + ' and %s (byte %s)')
-                                    % (self._col_name[i],
-                                       oldfile, oldind[i][v],
-                                       data_file, offs))
-                    offs = it._input_offset()
-                    row = it._fetch_next()
-
-            self._files.append((data_file, location, fsize, indices))
+                if cache:
+                    rows = _cached_columns(cache, icols)
+                else:
+                    rows = _text_columns(it, row, 0, fsize)
+                self._index_rows(data_file, rows, indices, self._files)
+
+            self._files.append((data_file, location, fsize, indices, cache))
+
+    def _index_rows(self, data_file, rows, indices, other_files):
+        # Add the given rows of data_file to the indices, checking
+        # that no value is duplicated within the file or in any of
+        # other_files.
+        icols = list(indices)
+        for (offs, row) in rows:
+            for i in icols:
+                v = row[i]
+                k = indices[i].setdefault(v, offs)
+                if k != offs:
+                    raise OperationalError(
+                        'duplicate %s in %s at byte %s and %s'
+                        % (self._col_name[i], data_file, k, offs))
+                for (oldfile, _, _, oldind, _) in other_files:
+                    if v in oldind[i]:
+                        raise OperationalError(
+                            ('duplicate %s in %s (byte %s)'
+                             + ' and %s (byte %s)')
+                            % (self._col_name[i],
+                               oldfile, oldind[i][v],
+                               data_file, offs))
+
+    def refresh(self):
+        """
+        Add rows that have been appended to the last data file.
+
+        This has no effect unless set_follow() has been called.  The
+        sync pattern must match at the end of the previously imported
+        data; only rows that are known to be complete are added.
+        """
+        if not self._follow or not self._files:
+            return
+        (data_file, _, fsize, _, _) = self._files[-1]
+        try:
+            with open_data_file(data_file) as f:
+                end = f.seek(0, os.SEEK_END)
+                if end < fsize:
+                    raise OperationalError('%s has been truncated'
+                                           % data_file)
+                if end == fsize:
+                    return
+                newsize = self._last_row_offset(f, fsize, end, data_file)
+        except Error:
+            raise
+        except Exception as e:
+            raise OperationalError('cannot read %s: %s' % (data_file, e))
+        self._extend_last_file(newsize)
+
+    def _complete_last_file(self):
+        # Add all remaining rows of the last data file.
+        data_file = self._files[-1][0]
+        try:
+            with open_data_file(data_file) as f:
+                end = f.seek(0, os.SEEK_END)
+        except Exception as e:
+            raise OperationalError('cannot read %s: %s' % (data_file, e))
+        self._extend_last_file(end)
+
+    def _extend_last_file(self, newsize):
+        (data_file, location, fsize, indices, cache) = self._files[-1]
+        if newsize <= fsize:
+            return
+        if indices:
+            with BCPTableIterator(self, filename = data_file) as it:
+                it._set_input_pos(0, fsize)
+                row = it._fetch_next()
+                rows = _text_columns(it, row, fsize, newsize)
+                self._index_rows(data_file, rows, indices, self._files[:-1])
+        self._files[-1] = (data_file, location, newsize, indices, None)
+
+    def _last_row_offset(self, f, start, end, data_file):
+        # Find the start of the last row between start and end (that
+        # row may be incomplete, if the file is still being written.)
+        # start must be a row boundary; unless it is the beginning of
+        # the file, check that the sync pattern matches there.
+        pattern = self._sync_pattern
+        group = self._sync_pattern_group
+
+        if start > 0:
+            base = max(0, start - 4096)
+            f.seek(base)
+            buf = f.read(min(end, start + 4096) - base)
+            m = pattern.search(buf)
+            while m and base + m.start(group) < start:
+                m = pattern.search(buf, m.start() + 1)
+            if not m:
+                if end - start < 4096:
+                    # not enough data yet to identify the next row
+                    return start
+                raise DataSyntaxError('sync pattern not found at byte %d'
+                                      ' of %s' % (start, data_file))
+            if base + m.start(group) != start:
+                raise DataSyntaxError('sync pattern does not match at byte'
+                                      ' %d of %s' % (start, data_file))
+
+        size = 65536
+        while True:
+            base = max(start, end - size)
+            f.seek(base)
+            buf = f.read(end - base)
+            last = None
+            for m in pattern.finditer(buf):
+                last = m
+            if last is not None and base + last.start(group) > start:
+                return base + last.start(group)
+            if base == start:
+                return start
+            size *= 2
 
     def n_columns(self):
         """Get the number of columns in the table."""
@@ -342,16 +479,43 @@ def column_indexed(self, n):
         """Check whether the nth column is indexed."""
         return (n in self._index_columns)
 
+    def data_files(self):
+        """Get the list of data files that have been imported."""
+        return [f[0] for f in self._files]
+
     def clear(self):
         """Remove all imported data."""
         self._files = []
 
     def iterator(self):
         """Create an iterator for reading the table."""
+        if self._files and all(f[4] for f in self._files):
+            return BCPCachedTableIterator(self)
         return BCPTableIterator(self)
 
+def _text_columns(it, row, offs, end):
+    # Iterate over the rows of a data file, from byte offset offs to
+    # end, yielding the byte offset and contents of each row.
+    while row and offs < end:
+        yield (offs, row)
+        offs = it._input_offset()
+        if offs >= end:
+            break
+        row = it._fetch_next()
+
+def _cached_columns(cache, icols):
+    # Iterate over the given columns of a column cache, yielding the
+    # byte offset (in the original data file) and contents of each
+    # row.  Other columns are set to None.
+    getters = [(i, cache.getters[i]) for i in icols]
+    row = [None] * len(cache.getters)
+    for n in range(cache.nrows):
+        for (i, get) in getters:
+            row[i] = get(n)
+        yield (cache.row_offsets[n], row)
+
 class BCPTableIterator:
-    def __init__(self, table, filename = None):
+    def __init__(self, table, filename = None, raw = False):
         self._table = table
 
         # Determine which column is used for ordering; if table is not
@@ -372,7 +536,10 @@ def __init__(self, table, filename = None):
                                   table._col_format,
                                   table._col_type):
             try:
-                self._readfuncs.append((readfunc[fmt], ty.from_bytes))
+                if raw:
+                    self._readfuncs.append((readfunc[fmt], bytes))
+                else:
+                    self._readfuncs.append((readfunc[fmt], ty.from_bytes))
             except KeyError:
                 raise OperationalError(
                     'unsupported format for %s in %s'
@@ -381,13 +548,15 @@ def __init__(self, table, filename = None):
         # Open the given file (if specified), or else open all data
         # files for this table
         if filename is None:
-            fnl = [f[0] for f in table._files]
+            fnl = [(f[0], f[2]) for f in table._files]
         else:
-            fnl = [filename]
+            fnl = [(filename, None)]
         self._infiles = []
-        for fn in fnl:
+        for (fn, size) in fnl:
             try:
-                f = open(fn, 'rb')
+                f = open_data_file(fn)
+                if table._follow and size is not None:
+                    f = _BoundedFile(f, size)
                 self._infiles.append(f)
             except Exception as e:
                 self.close()
@@ -618,3 +787,36 @@ def _read_ahead(self, count = 4096):
             else:
                 self._infile = None
         raise EOFError()
+
+class _BoundedFile:
+    """
+    Data file that may be growing while it is being read.
+
+    Only the first 'size' bytes of the file are visible.
+    """
+    def __init__(self, fp, size):
+        self._fp = fp
+        self._size = size
+
+    @property
+    def name(self):
+        return self._fp.name
+
+    def read(self, size = -1):
+        remaining = self._size - self._fp.tell()
+        if remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self._fp.read(size)
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_END:
+            return self._fp.seek(self._size + offset)
+        return self._fp.seek(offset, whence)
+
+    def tell(self):
+        return self._fp.tell()
+
+    def close(self):
+        self._fp.close()
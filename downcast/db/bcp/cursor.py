@@ -72,11 +72,13 @@ def execute(self, statement, params = ()):
             self._table_iters[table] = table.iterator()
         it = self._table_iters[table]
 
+        tie_cols = []
         if q.order is not None:
-            i = table.column_number(q.order)
+            i = table.column_number(q.order[0])
             if i != table.order_column():
                 raise ProgrammingError('cannot sort %s by %s'
-                                       % (q.table, q.order))
+                                       % (q.table, q.order[0]))
+            tie_cols = [table.column_number(c) for c in q.order[1:]]
 
         cols = []
         for c in q.columns:
@@ -131,7 +133,11 @@ def execute(self, statement, params = ()):
             it.seek(None, None)
         else:
             it.seek(*seek)
-        self._query_fetch = it.fetch
+        if tie_cols:
+            self._query_fetch = _sort_ties(it.fetch, table.order_column(),
+                                           tie_cols)
+        else:
+            self._query_fetch = it.fetch
         self._query_skip = skip
         self._query_cols = cols
 
@@ -192,6 +198,27 @@ def nextset(self):
 class HaltQuery(Exception):
     pass
 
+def _sort_ties(fetch, key_col, sort_cols):
+    # Rows are stored in order of key_col; rows with equal values of
+    # key_col are read as a group and sorted by sort_cols (with nulls
+    # first.)
+    def sort_key(row):
+        return tuple((row[i] is not None, row[i]) for i in sort_cols)
+    def rows():
+        row = fetch()
+        while row:
+            k = row[key_col]
+            group = [row]
+            row = fetch()
+            while row and row[key_col] == k:
+                group.append(row)
+                row = fetch()
+            if len(group) > 1:
+                group.sort(key = sort_key)
+            yield from group
+    it = rows()
+    return lambda: next(it, None)
+
 def _halt():
     raise HaltQuery()
 
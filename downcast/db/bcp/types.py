@@ -65,7 +65,7 @@ def from_bytes(b):
 class DATETIME(BCPType):
     """BCP type for a timestamp column."""
     def from_bytes(b):
-        return timestamp.T(b.decode())
+        return timestamp.parse_bytes(b)
     def from_param(p):
         return timestamp.T(p)
 
@@ -18,8 +18,10 @@
 
 import os
 import re
+import time
 
 from .bcp import *
+from .bcp.compressed import compressed_suffix
 
 # Sorting order for each table
 
@@ -220,9 +222,41 @@
     }
 }
 
+_meta_tables = {'Enumeration', 'Numeric', 'Wave'}
+_data_file_pattern = re.compile('\\.[0-9]+_[0-9]+\\Z')
+
+def data_file_kind(filename, suffix = compressed_suffix):
+    """
+    Determine the type of a file in a data directory.
+
+    If filename is the name of a data file for one of the metadata
+    tables ('Enumeration', 'Numeric', or 'Wave'), this returns 'meta'.
+    If it is the name of a data file for one of the other tables
+    (e.g. 'Alert.20010101_20010102'), this returns 'data'.  Otherwise,
+    this returns None.
+
+    The file name may optionally end with the given suffix.
+    """
+    if suffix and filename.endswith(suffix):
+        filename = filename[:-len(suffix)]
+    if filename in _meta_tables:
+        return 'meta'
+    elif _data_file_pattern.search(filename):
+        return 'data'
+    else:
+        return None
+
+# Minimum time (in seconds) between checks for new data, when
+# following data directories
+_refresh_interval = 1
+
 class DWCBCPConnection(BCPConnection):
-    def __init__(self, datadirs):
+    def __init__(self, datadirs, follow = False):
         BCPConnection.__init__(self)
+        self._follow = follow
+        self._data_dirs = []
+        self._imported = {}
+        self._refresh_time = time.monotonic()
         for d in datadirs:
             self.add_data_dir(d)
 
@@ -268,19 +302,74 @@ def add_data_dir(self, dirname):
         For the other tables, all data files are concatenated in the
         order that they are imported.  All of these files must be
         sorted by timestamp, and must not overlap.
+
+        Any of the data files may instead be block-compressed, in
+        which case the file name has the suffix '.bcz' (for example,
+        'Alert.20010101_20010102.bcz'.)  If both compressed and
+        uncompressed versions of a file exist, the uncompressed
+        version is used.
+
+        If the connection was opened with follow = True, the directory
+        is checked for new data (see refresh()) before creating each
+        cursor.
         """
+        self._data_dirs.append(dirname)
+        self._scan_data_dir(dirname)
 
-        meta_tables = {'Enumeration', 'Numeric', 'Wave'}
-        data_pat = re.compile('\.[0-9]+_[0-9]+\Z')
-        for f in sorted(os.listdir(dirname)):
+    def _scan_data_dir(self, dirname):
+        files = set(os.listdir(dirname))
+        for f in sorted(files):
+            kind = data_file_kind(f)
+            if kind is None:
+                continue
+            if f.endswith(compressed_suffix):
+                if f[:-len(compressed_suffix)] in files:
+                    continue
             path = os.path.join(dirname, f)
+
+            # Skip files that have already been imported (metadata
+            # files are imported again if they have been modified)
+            if kind == 'meta':
+                st = os.stat(path)
+                info = (st.st_size, st.st_mtime_ns)
+            else:
+                info = True
+            if (self._imported.get(path) == info
+                    or path + compressed_suffix in self._imported):
+                continue
+
             base = f.split('.')[0]
             table = '_Export.%s_' % base
             fmtpath = os.path.join(dirname, base + '.fmt')
-            if f in meta_tables:
-                self.add_data_file(table, path, fmtpath, True)
-            elif data_pat.search(f):
-                self.add_data_file(table, path, fmtpath, False)
+            self.add_data_file(table, path, fmtpath, (kind == 'meta'))
+
+            # Empty data files are ignored by add_data_file; if
+            # following the directory, try again later
+            if (kind == 'meta' or not self._follow
+                    or path in self.get_table(table).data_files()):
+                self._imported[path] = info
+
+    def refresh(self):
+        """
+        Import data that has been added since the database was opened.
+
+        Any new data files in the data directories are imported, and
+        rows that have been appended to the last data file of each
+        table are added.  This is only possible if the connection was
+        opened with follow = True.
+        """
+        self._refresh_time = time.monotonic()
+        for d in self._data_dirs:
+            self._scan_data_dir(d)
+        for t in self.tables():
+            t.refresh()
+
+    def cursor(self):
+        """Create a cursor for reading the database."""
+        if (self._follow and time.monotonic()
+                >= self._refresh_time + _refresh_interval):
+            self.refresh()
+        return BCPConnection.cursor(self)
 
     def add_data_file(self, table, data_file, format_file, replace = False):
         """
@@ -301,6 +390,7 @@ def add_data_file(self, table, data_file, format_file, replace = False):
         tbl = self.add_table(table)
         tbl.set_sync_pattern(_table_sync_pattern[table])
         tbl.set_order(_table_order_column[table])
+        tbl.set_follow(self._follow and not replace)
         for (col, dtype) in _table_columns[table].items():
             tbl.add_column(col, dtype)
         for col in _table_id_columns.get(table, []):
@@ -311,5 +401,5 @@ def add_data_file(self, table, data_file, format_file, replace = False):
 
 #### DB-API ####
 
-def connect(datadirs):
-    return DWCBCPConnection(datadirs)
+def connect(datadirs, follow = False):
+    return DWCBCPConnection(datadirs, follow)
@@ -138,9 +138,17 @@ def p_constraint(self, p):
         p[0] = Constraint(column = p[1], relation = p[2], value = p[3])
 
     def p_order(self, p):
-        """order : ORDER BY column"""
+        """order : ORDER BY order_columns"""
         p[0] = p[3]
 
+    def p_order_columns(self, p):
+        """order_columns : order_columns ',' column"""
+        p[0] = p[1] + [p[3]]
+
+    def p_order_columns_1(self, p):
+        """order_columns : column"""
+        p[0] = [p[1]]
+
     def p_order_0(self, p):
         """order : """
         p[0] = None
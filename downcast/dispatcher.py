@@ -18,6 +18,10 @@
 
 from collections import OrderedDict
 import logging
+import time
+
+from . import metrics
+from . import profiler
 
 class Dispatcher:
     """Object that tracks and routes incoming messages.
@@ -150,6 +154,12 @@ def flush(self):
         for h in self.handlers:
             self._handler_flush(h)
 
+    def collect_metrics(self):
+        """Update metrics that describe the pending messages."""
+        metrics.set_gauge('downcast_dispatcher_pending_messages',
+                          len(self.all_messages))
+        metrics.set_gauge('downcast_dispatcher_channels', len(self.channels))
+
     ################################################################
 
     def _ack_message(self, channel, msg, handler):
@@ -245,11 +255,14 @@ def _replay_pending(self, channel):
             # messages here, may be suboptimal.  Try to avoid making
             # this a problem by ensuring that we never keep a huge
             # number of pending messages in any given channel.
+            n = 0
             for (m, mi) in list(channel.messages.items()):
                 ttl = (mi.expires - self.message_counter)
                 for h in active:
                     if h in mi.handlers:
                         self._handler_send_message(h, channel, m, ttl)
+                        n += 1
+            metrics.inc('downcast_dispatcher_replayed_total', n)
 
     def _check_expiring(self):
         while len(self.all_messages) > 0:
@@ -267,6 +280,7 @@ def _check_expiring(self):
     def _expire_message(self, channel, msg):
         # Message is about to expire.  Notify all handlers that
         # still have not acked it
+        metrics.inc('downcast_dispatcher_expired_total')
         for h in channel._message_handlers(msg):
             self._handler_send_message(h, channel, msg, 0)
 
@@ -302,12 +316,22 @@ def _expire_message(self, channel, msg):
     # anything in 'flush' except flushing buffers.
 
     def _handler_send_message(self, handler, channel, msg, ttl):
+        timed = (metrics.enabled() or profiler.active())
+        if timed:
+            start = time.perf_counter()
         try:
             handler.send_message(channel.channel_id, msg, channel, ttl)
         except (OSError, MemoryError, ImportError, SyntaxError, SystemError):
             raise
         except Exception as e:
             self._log_exception_once(handler, channel, msg, 'send_message', e)
+        if timed:
+            elapsed = time.perf_counter() - start
+            name = type(handler).__name__
+            metrics.inc('downcast_handler_calls_total', handler = name)
+            metrics.inc('downcast_handler_seconds_total', elapsed,
+                        handler = name)
+            profiler.record('handler.' + name, elapsed)
 
     def _handler_flush(self, handler):
         handler.flush()
@@ -17,7 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from collections import OrderedDict, deque
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import json
 import os
 import hashlib
@@ -25,6 +25,8 @@
 import sys
 import time
 
+from . import metrics
+from . import profiler
 from .subprocess import ParallelDispatcher
 from .parser import (WaveSampleParser, NumericValueParser,
                      EnumerationValueParser, AlertParser,
@@ -35,18 +37,25 @@
 
 class Extractor:
     def __init__(self, db, dest_dir, fatal_exceptions = False,
-                 deterministic_output = False, debug = False):
+                 deterministic_output = False, debug = False,
+                 dispatcher = None, conn = None):
         self.db = db
         self.dest_dir = dest_dir
         self.queues = []
-        self.dispatcher = ParallelDispatcher(
-            8, fatal_exceptions = fatal_exceptions)
-        self.conn = db.connect()
+        if dispatcher is None:
+            dispatcher = ParallelDispatcher(
+                8, fatal_exceptions = fatal_exceptions)
+            dispatcher.add_dead_letter_handler(DefaultDeadLetterHandler())
+        self.dispatcher = dispatcher
+        if conn is None:
+            conn = db.connect()
+        self.conn = conn
         self.current_timestamp = very_old_timestamp
         self.queue_timestamp = OrderedDict()
+        self.probe_time = {}
+        self.probe_delay = {}
         if dest_dir is not None:
             os.makedirs(dest_dir, exist_ok = True)
-        self.dispatcher.add_dead_letter_handler(DefaultDeadLetterHandler())
         self.deterministic_output = deterministic_output
         self.debug = debug
 
@@ -54,6 +63,8 @@ def add_queue(self, queue):
         """Add an input queue."""
         self.queues.append(queue)
         self.queue_timestamp[queue] = very_old_timestamp
+        self.probe_time[queue] = 0
+        self.probe_delay[queue] = queue.idle_delay()
         if self.dest_dir is not None:
             queue.load_state(self.dest_dir)
         # XXX
@@ -69,7 +80,15 @@ def add_handler(self, handler):
 
     def flush(self):
         """Flush all output handlers, and save queue state to disk."""
+        start = profiler.begin()
         self.dispatcher.flush()
+        self.save_state()
+        profiler.end('flush', start)
+        metrics.write()
+        profiler.maybe_dump()
+
+    def save_state(self):
+        """Save queue state to disk."""
         if self.dest_dir is not None:
             for queue in self.queues:
                 queue.save_state(self.dest_dir, self.deterministic_output)
@@ -111,10 +130,10 @@ def run(self):
 
         # If the oldest queue timestamp is greater than the current
         # timestamp, then *all* queues must now be idle; in that case,
-        # ignore timestamps and handle queues in round-robin order.
+        # wait until there are new messages.
         if self.queue_timestamp[q] > self.current_timestamp:
-            q = next(iter(self.queue_timestamp))
-            self.queue_timestamp.move_to_end(q)
+            self._run_probe()
+            return
 
         # Retrieve and submit a batch of messages.
         try:
@@ -139,16 +158,64 @@ def run(self):
             self._run_queries(q, cursor)
         finally:
             cursor.close()
+        metrics.maybe_write()
+        profiler.maybe_dump()
+
+    def next_probe_time(self):
+        """Get the time (according to time.monotonic) of the next probe."""
+        return min(self.probe_time.values())
+
+    def _run_probe(self):
+        """Check whether an idle queue has new messages.
+
+        Rather than repeatedly querying every queue in full, wait
+        until the next queue is due to be checked, and then query a
+        single row to see whether anything has been added.  If not,
+        the interval before that queue is checked again is doubled
+        (up to queue.max_probe_delay()); if so, a normal batch of
+        messages is retrieved.
+        """
+        q = min(self.queues, key = self.probe_time.get)
+        delay = self.probe_time[q] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            cursor = self.conn.cursor()
+            start = profiler.begin()
+            parser = q.probe_message_parser(self.db)
+            msgs = list(self.db.get_messages(parser, cursor = cursor))
+            profiler.end('probe', start)
+            metrics.inc('downcast_probes_total', queue = q.queue_name,
+                        result = ('data' if msgs else 'empty'))
+
+            if msgs:
+                q.skip_to(q.message_timestamp(msgs[0]))
+                sq = q.stalling_queue()
+                while sq is not None:
+                    q = sq
+                    sq = q.stalling_queue()
+                self._run_queries(q, cursor)
+            else:
+                self.probe_delay[q] = min(self.probe_delay[q] * 2,
+                                          q.max_probe_delay())
+                self.probe_time[q] = (time.monotonic()
+                                      + self.probe_delay[q].total_seconds())
+        finally:
+            cursor.close()
+        metrics.maybe_write()
+        profiler.maybe_dump()
 
     def _run_queries(self, queue, cursor):
         parser = queue.next_message_parser(self.db)
+        clock_start = time.monotonic()
+        dispatch_time = 0
 
         if self.debug:
             dbg_start = getattr(queue, 'newest_seen_timestamp', None)
             dbg_duration = getattr(queue, 'last_batch_duration', None)
             if dbg_duration:
                 dbg_duration = dbg_duration.total_seconds()
-            dbg_clock_start = time.monotonic()
             sys.stderr.write('%s %s+%s'
                              % (type(queue).__name__,
                                 dbg_start, dbg_duration))
@@ -179,10 +246,23 @@ def _run_queries(self, queue, cursor):
             if ts > queue.query_time:
                 queue.query_time = ts
 
+            dispatch_start = time.monotonic()
             queue.push_message(msg, self.dispatcher)
+            dispatch_time += time.monotonic() - dispatch_start
+
+        clock_elapsed = time.monotonic() - clock_start
+        queue.batch_completed(clock_elapsed - dispatch_time)
+        if queue.last_batch_count > 0:
+            self.probe_delay[queue] = queue.idle_delay()
+        self.probe_time[queue] = (time.monotonic()
+                                  + self.probe_delay[queue].total_seconds())
+        profiler.record('query', clock_elapsed - dispatch_time)
+        profiler.record('dispatch', dispatch_time)
+        if metrics.enabled():
+            self._update_metrics(queue, clock_elapsed, dispatch_time)
 
         if self.debug:
-            dbg_clock_elapsed = time.monotonic() - dbg_clock_start
+            dbg_clock_elapsed = clock_elapsed
             dbg_newest = getattr(queue, 'last_batch_count_at_newest', None)
             dbg_total = getattr(queue, 'last_batch_count', None)
             dbg_limit = getattr(queue, 'last_batch_limit', None)
@@ -212,6 +292,36 @@ def _run_queries(self, queue, cursor):
                 sys.stderr.write('\n')
             self.queue_timestamp[queue] = (queue.query_time + queue.bias())
 
+    def _update_metrics(self, queue, elapsed, dispatch_time):
+        name = queue.queue_name
+        n = queue.last_batch_count
+        metrics.inc('downcast_queries_total', queue = name)
+        metrics.inc('downcast_rows_fetched_total', n, queue = name)
+        metrics.observe('downcast_query_seconds', elapsed - dispatch_time,
+                        queue = name)
+        metrics.observe('downcast_dispatch_seconds', dispatch_time,
+                        queue = name)
+        metrics.observe('downcast_batch_rows', n, queue = name)
+        if elapsed > 0:
+            metrics.set_gauge('downcast_rows_per_second', n / elapsed,
+                              queue = name)
+        if queue.last_batch_duration is not None:
+            metrics.set_gauge('downcast_batch_duration_seconds',
+                              queue.last_batch_duration.total_seconds(),
+                              queue = name)
+        if queue.last_batch_limit is not None:
+            metrics.set_gauge('downcast_batch_limit', queue.last_batch_limit,
+                              queue = name)
+        if queue.newest_seen_timestamp is not None:
+            lag = self.current_timestamp - queue.newest_seen_timestamp
+            metrics.set_gauge('downcast_queue_lag_seconds',
+                              lag.total_seconds(), queue = name)
+        metrics.set_gauge('downcast_queue_unacked_messages',
+                          queue.unacked_count, queue = name)
+        metrics.set_gauge('downcast_queue_acked_saved',
+                          sum(len(m) for m in queue.acked_saved.values()),
+                          queue = name)
+
     def _update_current_time(self, cursor):
         for queue in self.queues:
             parser = queue.final_message_parser(self.db)
@@ -220,15 +330,99 @@ def _update_current_time(self, cursor):
                 if ts > self.current_timestamp:
                     self.current_timestamp = ts
 
+class ExtractorGroup:
+    """
+    Set of extractors, for several servers, sharing the same handlers.
+
+    Each server is read by its own Extractor, which has its own
+    queues and its own notion of the current time.  All of them send
+    messages to a single dispatcher (and a single set of handler
+    processes.)  run() gives each server a turn in round-robin order,
+    so that a server with a large backlog cannot starve the others.
+
+    Extractors for the same server share a single database
+    connection.
+    """
+    def __init__(self, dest_dir, fatal_exceptions = False,
+                 deterministic_output = False, debug = False):
+        self.dest_dir = dest_dir
+        self.extractors = deque()
+        self.connections = {}
+        self.dispatcher = ParallelDispatcher(
+            8, fatal_exceptions = fatal_exceptions)
+        self.dispatcher.add_dead_letter_handler(DefaultDeadLetterHandler())
+        self.deterministic_output = deterministic_output
+        self.debug = debug
+
+    def connection(self, db):
+        """Get the shared connection to a database."""
+        conn = self.connections.get(db.servername)
+        if conn is None:
+            conn = self.connections[db.servername] = db.connect()
+        return conn
+
+    def add_extractor(self, db):
+        """Add an extractor for a database, and return it."""
+        ex = Extractor(db, self.dest_dir,
+                       deterministic_output = self.deterministic_output,
+                       debug = self.debug, dispatcher = self.dispatcher,
+                       conn = self.connection(db))
+        self.extractors.append(ex)
+        return ex
+
+    def add_handler(self, handler):
+        """Add a message handler."""
+        self.dispatcher.add_handler(handler)
+
+    def flush(self):
+        """Flush all output handlers, and save queue state to disk."""
+        start = profiler.begin()
+        self.dispatcher.flush()
+        for ex in self.extractors:
+            ex.save_state()
+        profiler.end('flush', start)
+        metrics.write()
+        profiler.maybe_dump()
+
+    def idle(self):
+        """Check whether all available messages have been received."""
+        return all(ex.idle() for ex in self.extractors)
+
+    def run(self):
+        """Perform some amount of work for one of the servers."""
+        for _ in range(len(self.extractors)):
+            ex = self.extractors[0]
+            self.extractors.rotate(-1)
+            if not ex.idle():
+                ex.run()
+                return
+
+        # All servers are idle; wait for whichever is due to be
+        # checked first.
+        min(self.extractors, key = Extractor.next_probe_time).run()
+
 class ExtractorQueue:
+    """
+    Object that reads messages from one table.
+
+    Each query covers a range of timestamps, chosen so that it
+    returns about target_batch_rows rows (by default, half of
+    messages_per_batch, the maximum for a query) based on the number
+    of rows per second of data seen in previous queries.  The range
+    is reduced if queries take longer than target_query_time
+    seconds.
+    """
     def __init__(self, queue_name, start_time = None, end_time = None,
-                 messages_per_batch = 10000):
+                 messages_per_batch = 10000, target_batch_rows = None,
+                 target_query_time = 2.0):
         self.queue_name = queue_name
         self.newest_seen_timestamp = start_time
+        self.newest_seen_seqnum = None
         self.oldest_unacked_timestamp = start_time
         self.end_time = end_time
         self.message_info = {}
         self.timestamp_info = deque()
+        self.unacked_count = 0
         if start_time is not None:
             self.timestamp_info.append(TimestampInfo(start_time))
 
@@ -237,10 +431,20 @@ def __init__(self, queue_name, start_time = None, end_time = None,
         self.last_batch_count_at_newest = 0
         self.last_batch_limit = 0
         self.last_batch_count = 0
+        self.last_batch_start = None
         self.last_batch_end = None
         self.last_batch_duration = None
+        self.batch_start = start_time
+        self.batch_start_exclusive = False
         self.query_time = very_old_timestamp
 
+        if target_batch_rows is None:
+            target_batch_rows = messages_per_batch // 2
+        self.target_batch_rows = target_batch_rows
+        self.target_query_time = target_query_time
+        self.last_query_time = None
+        self.data_rate = None
+
     def load_state(self, dest_dir):
         filename = self._state_file_name(dest_dir)
         try:
@@ -250,10 +454,14 @@ def load_state(self, dest_dir):
             return
         self.message_info = {}
         self.timestamp_info = deque()
+        self.unacked_count = 0
         try:
             ts = T(data['time'])
             self.newest_seen_timestamp = ts
+            self.newest_seen_seqnum = None
             self.oldest_unacked_timestamp = ts
+            self.batch_start = ts
+            self.batch_start_exclusive = False
             if ts is not None:
                 self.timestamp_info.append(TimestampInfo(ts))
         except KeyError:
@@ -306,46 +514,152 @@ def _message_hash(self, msg):
         return m.hexdigest()
 
     def next_message_parser(self, db):
-        if self.newest_seen_timestamp is None:
+        if (self.last_batch_limit
+                and self.last_batch_count >= self.last_batch_limit):
+            # Our last query hit the batch limit, so there may be
+            # more rows with the same timestamp as the last row
+            # received.  Fetch the rest of the rows at that timestamp
+            # (and nothing else), so that the following query can
+            # begin strictly after it.  Rows with the same timestamp
+            # are sorted by sequence number, if the table has one, so
+            # only those at or after the last sequence number need
+            # to be fetched again.
+            ts = self.newest_seen_timestamp
+            seqnum = self.newest_seen_seqnum
+            self.batch_start = ts
+            self.batch_start_exclusive = True
+            self.last_batch_limit = None
+            self.last_batch_count = 0
+            self.last_batch_count_at_newest = 0
+            if seqnum is None:
+                return self.message_parser(db, None, time = ts)
+            return self.message_parser(db, None, time = ts,
+                                       seqnum_ge = seqnum)
+
+        if self.last_batch_limit:
+            # Our last query returned everything in its time window.
+            # If that window lies far enough in the past that no
+            # more rows can be added to it, there is no need to look
+            # at it again.  Otherwise, more messages might arrive
+            # later with the timestamp we saw last.
+            if self._window_complete(self.last_batch_end):
+                self.batch_start = self.last_batch_end
+                self.batch_start_exclusive = True
+            else:
+                self.batch_start = self.newest_seen_timestamp
+                self.batch_start_exclusive = False
+
+        n = self.limit_per_batch
+        start = self.batch_start
+        if start is None:
             # We know nothing.  Simply read the N earliest messages
             # from the table.
-            n = self.limit_per_batch
             d = None
-
-        elif (self.last_batch_count > self.last_batch_count_at_newest
-              or self.last_batch_duration is None):
-            # Our last query gave results from multiple timestamps (or
-            # our last query was the very first, so it didn't have a
-            # duration), so advance by the default batch duration.
-            n = self.limit_per_batch
-            d = self.default_batch_duration()
-
-        elif self.last_batch_count < self.last_batch_limit:
-            # Our last query gave results for only one timestamp, and
-            # fewer than the batch limit; temporarily increase the
-            # duration.
-            n = self.last_batch_limit
-            d = self.last_batch_duration * 2
-
-        else:
-            # Our last query gave results for only one timestamp, and
-            # hit the batch limit; temporarily increase the limit.
-            n = self.last_batch_limit * 2
-            d = self.last_batch_duration
-
-        start = self.newest_seen_timestamp
-        if start is None:
             end = self.end_time
+            constraints = {'time_le': end}
         else:
+            d = self._adaptive_batch_duration()
             if self.end_time is not None:
                 d = min(d, self.end_time - start)
             end = start + d
+            if self.batch_start_exclusive:
+                constraints = {'time_gt': start, 'time_le': end}
+            else:
+                constraints = {'time_ge': start, 'time_le': end}
         self.last_batch_limit = n
+        self.last_batch_start = start
         self.last_batch_end = end
         self.last_batch_duration = d
         self.last_batch_count = 0
         self.last_batch_count_at_newest = 0
-        return self.message_parser(db, n, time_ge = start, time_le = end)
+        return self.message_parser(db, n, **constraints)
+
+    def _window_complete(self, end):
+        if end is None:
+            return False
+        now = T(datetime.now(timezone.utc))
+        return (end < now - self.max_insert_delay())
+
+    def max_insert_delay(self):
+        # Rows are assumed to be added to the database no later than
+        # this long after their timestamps
+        return timedelta(minutes = 30)
+
+    def probe_message_parser(self, db):
+        """
+        Construct a parser to check for new messages.
+
+        The query returns at most one row, which is the earliest
+        message newer than any message seen so far.
+        """
+        if self.newest_seen_timestamp is None:
+            return self.message_parser(db, 1)
+        return self.message_parser(db, 1,
+                                   time_gt = self.newest_seen_timestamp)
+
+    def skip_to(self, timestamp):
+        """
+        Begin the next query at the given timestamp.
+
+        This is used when a probe has shown that there are no
+        messages between the newest message seen and timestamp.
+        """
+        self.batch_start = timestamp
+        self.batch_start_exclusive = False
+        self.last_batch_limit = 0
+
+    def max_probe_delay(self):
+        return max(self.idle_delay(), timedelta(seconds = 30))
+
+    def _adaptive_batch_duration(self):
+        if self.data_rate is None:
+            d = self.default_batch_duration()
+        elif self.data_rate > 0:
+            d = timedelta(seconds = self.target_batch_rows / self.data_rate)
+        else:
+            d = self.max_batch_duration()
+
+        # If the last query was too slow, shrink the window in
+        # proportion
+        if (self.last_query_time is not None
+                and self.last_query_time > self.target_query_time
+                and self.last_batch_duration is not None):
+            d = min(d, self.last_batch_duration
+                    * (self.target_query_time / self.last_query_time))
+
+        return max(self.min_batch_duration(),
+                   min(self.max_batch_duration(), d))
+
+    def batch_completed(self, query_time):
+        """
+        Update statistics after receiving the results of a query.
+
+        query_time is the time (in seconds) spent executing the query
+        and fetching its results.
+        """
+        if self.last_batch_limit is None:
+            # Rows at a single timestamp tell us nothing about the
+            # density of the data.
+            return
+        self.last_query_time = query_time
+        if self.last_batch_start is None or self.last_batch_duration is None:
+            return
+
+        # Estimate how many rows there are per second of data.  If
+        # the query hit its limit, the results only extend as far as
+        # the newest timestamp received.
+        if self.last_batch_count >= self.last_batch_limit:
+            span = self.newest_seen_timestamp - self.last_batch_start
+        else:
+            span = self.last_batch_duration
+        span = span.total_seconds()
+        if span <= 0:
+            return
+        rate = self.last_batch_count / span
+        if self.data_rate is None:
+            self.data_rate = rate
+        else:
+            self.data_rate = (self.data_rate + rate) / 2
 
     def final_message_parser(self, db):
         return self.message_parser(db, 1,
@@ -354,10 +668,12 @@ def final_message_parser(self, db):
                                    reverse = True)
 
     def reached_present(self):
-        if self.end_time is None:
-            # XXX This is broken.  With requirement for time-limited
-            # queries we need a different approach for real-time
-            # conversion.
+        if self.last_batch_limit is None:
+            return False
+        elif self.end_time is None:
+            # The query may have ended before the next message that
+            # exists; in that case, Extractor._run_probe will find
+            # it and skip forward.
             return (self.last_batch_count < self.last_batch_limit)
         else:
             return (self.last_batch_end >= self.end_time
@@ -375,9 +691,14 @@ def push_message(self, message, dispatcher):
         if ts == self.newest_seen_timestamp:
             self.last_batch_count_at_newest += 1
             tsinfo = self.timestamp_info[-1]
+            seqnum = self.message_seqnum(message)
+            if (self.newest_seen_seqnum is not None
+                    and (seqnum is None or seqnum > self.newest_seen_seqnum)):
+                self.newest_seen_seqnum = seqnum
         elif (self.newest_seen_timestamp is None
               or ts > self.newest_seen_timestamp):
             self.newest_seen_timestamp = ts
+            self.newest_seen_seqnum = self.message_seqnum(message)
             self.last_batch_count_at_newest = 1
             tsinfo = TimestampInfo(ts)
             self.timestamp_info.append(tsinfo)
@@ -411,6 +732,7 @@ def push_message(self, message, dispatcher):
                     return
 
         tsinfo.unacked.add(msginfo)
+        self.unacked_count += 1
         dispatcher.send_message(channel, message, self, ttl)
 
     def nack_message(self, channel, message, handler):
@@ -422,6 +744,7 @@ def ack_message(self, channel, message, handler):
             tsinfo = msginfo.timestamp
             tsinfo.unacked.remove(msginfo)
             tsinfo.acked.append(msginfo)
+            self.unacked_count -= 1
         except KeyError:
             self._log_warning('ack for an unknown message')
         self._update_pointer()
@@ -498,11 +821,21 @@ def message_channel(self, message):
         return message.origin.get_patient_id(message.mapping_id, True)
     def message_timestamp(self, message):
         return message.timestamp
+    def message_seqnum(self, message):
+        return message.sequence_number
     def message_ttl(self, message):
         return self.limit_per_batch * 20
 
     def default_batch_duration(self):
         return timedelta(seconds = 11)
+    def min_batch_duration(self):
+        return timedelta(seconds = 1)
+    def max_batch_duration(self):
+        if self.mapping_id is not None:
+            # Only one mapping's rows are selected, so allow a query
+            # to span any gap in that mapping's data
+            return timedelta(days = 3650)
+        return timedelta(minutes = 60)
     def bias(self):
         return timedelta(0)
 
@@ -514,10 +847,18 @@ def message_channel(self, message):
         return message.patient_id
     def message_timestamp(self, message):
         return message.timestamp
+    def message_seqnum(self, message):
+        return None
     def message_ttl(self, message):
         return self.limit_per_batch * 20
     def default_batch_duration(self):
         return timedelta(minutes = 60)
+    def min_batch_duration(self):
+        return timedelta(minutes = 1)
+    def max_batch_duration(self):
+        if self.patient_id is not None:
+            return timedelta(days = 3650)
+        return timedelta(days = 1)
     def bias(self):
         return timedelta(0)
 
@@ -573,6 +914,8 @@ def message_parser(self, db, limit, **kwargs):
     def message_channel(self, message):
         message.origin.set_patient_id(message.mapping_id, message.patient_id)
         return message.patient_id
+    def message_seqnum(self, message):
+        return None
     def bias(self):
         return timedelta(minutes = -8)
     def idle_delay(self):
@@ -618,6 +961,8 @@ def message_channel(self, message):
         return None
     def message_timestamp(self, message):
         return message.timestamp
+    def message_seqnum(self, message):
+        return None
     def message_ttl(self, message):
         return 1000             # XXX
     def idle_delay(self):
@@ -19,17 +19,22 @@
 import sys
 import os
 from argparse import ArgumentParser, ArgumentTypeError
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
 
+from . import metrics
+from . import profiler
 from .server import DWCDB
+from .parser import PatientMappingParser
 from .timestamp import T
-from .extractor import (Extractor, WaveSampleQueue, NumericValueQueue,
+from .extractor import (ExtractorGroup, WaveSampleQueue, NumericValueQueue,
                         EnumerationValueQueue, AlertQueue,
                         PatientMappingQueue, PatientBasicInfoQueue,
                         PatientDateAttributeQueue,
                         PatientStringAttributeQueue, BedTagQueue)
 
 from .output.archive import Archive
+from .output.sync import durability_policies
 from .output.numerics import NumericValueHandler
 from .output.waveforms import WaveSampleHandler
 from .output.enums import EnumerationValueHandler
@@ -41,7 +46,10 @@ def main(args = None):
     opts = _parse_cmdline(args)
     extractor = _init_extractor(opts)
     archive = _init_archive(opts, extractor)
-    _main_loop(opts, extractor, archive)
+    try:
+        _main_loop(opts, extractor, archive)
+    finally:
+        profiler.dump()
 
 def _parse_timestamp(arg):
     try:
@@ -50,17 +58,32 @@ def _parse_timestamp(arg):
         raise ArgumentTypeError(
             "%r is not in the format 'YYYY-MM-DD HH:MM:SS.SSS +ZZ:ZZ'" % arg)
 
+def _parse_uuid(arg):
+    try:
+        return UUID(arg)
+    except Exception:
+        raise ArgumentTypeError("%r is not a valid UUID" % arg)
+
 def _parse_cmdline(args):
     p = ArgumentParser(
         description = 'Extract and convert DWC patient data.',
         fromfile_prefix_chars = '@')
 
     g = p.add_argument_group('input selection')
-    g.add_argument('--server', metavar = 'NAME',
-                   help = 'name of DWC database server')
+    g.add_argument('--server', metavar = 'NAME', action = 'append',
+                   help = 'name of DWC database server'
+                   ' (may be given more than once)')
     g.add_argument('--password-file', metavar = 'FILE',
                    default = 'server.conf',
                    help = 'file containing login credentials')
+    g.add_argument('--patient', metavar = 'UUID', action = 'append',
+                   type = _parse_uuid,
+                   help = 'extract only the data for the given patient'
+                   ' into a new output database')
+    g.add_argument('--mapping', metavar = 'UUID', action = 'append',
+                   type = _parse_uuid,
+                   help = 'extract only the data for the given mapping ID'
+                   ' into a new output database')
 
     g = p.add_argument_group('output database location')
     g.add_argument('--output-dir', metavar = 'DIR',
@@ -81,6 +104,41 @@ def _parse_cmdline(args):
                    help = 'collect data up to the given time')
     g.add_argument('--terminate', action = 'store_true',
                    help = 'handle final data after permanent shutdown')
+    g.add_argument('--durability', choices = durability_policies,
+                   default = 'fdatasync',
+                   help = 'method for syncing output files to disk'
+                   + ' (default: fdatasync)')
+    g.add_argument('--finalize-workers', metavar = 'N', type = int,
+                   default = 2,
+                   help = 'number of records to finalize at once'
+                   + ' (per handler process)')
+    g.add_argument('--max-open-files', metavar = 'N', type = int,
+                   default = 512,
+                   help = 'number of output files to keep open'
+                   + ' (per handler process)')
+
+    g = p.add_argument_group('query tuning')
+    g.add_argument('--batch-rows', metavar = 'N', type = int,
+                   help = 'number of rows to aim for in each query'
+                   + ' (default: 5000)')
+    g.add_argument('--batch-time', metavar = 'SECONDS', type = float,
+                   default = 2.0,
+                   help = 'shrink queries that take longer than this'
+                   + ' (default: 2)')
+
+    g = p.add_argument_group('monitoring')
+    g.add_argument('--metrics', choices = ('prometheus', 'json'),
+                   help = 'write runtime metrics to the state directory')
+    g.add_argument('--metrics-interval', metavar = 'SECONDS', type = float,
+                   default = 15,
+                   help = 'how often to update metrics (default: 15)')
+    g.add_argument('--profile', action = 'store_true',
+                   help = 'record processing times from the start'
+                   + ' (SIGUSR2 switches this on or off)')
+    g.add_argument('--profile-interval', metavar = 'SECONDS', type = float,
+                   default = 60,
+                   help = 'how often to write processing times'
+                   + ' (default: 60)')
 
     opts = p.parse_args(args)
     progname = sys.argv[0]
@@ -91,22 +149,36 @@ def _parse_cmdline(args):
     if opts.server is None:
         sys.exit(('%s: no --server specified' % progname)
                  + '\n' + p.format_usage())
-
-    if (opts.init + opts.batch + opts.live) != 1:
-        sys.exit(('%s: must specify exactly one of --init, --batch, or --live'
+    if len(set(opts.server)) != len(opts.server):
+        sys.exit(('%s: --server specified more than once for the same name'
                   % progname) + '\n' + p.format_usage())
 
-    if opts.start is not None and not opts.init:
-        sys.exit(('%s: --start can only be used with --init' % progname)
+    # Extracting selected patients is done in a single step, and
+    # creates a new output database
+    opts.targeted = bool(opts.patient or opts.mapping)
+    if (opts.init + opts.batch + opts.live + opts.targeted) != 1:
+        sys.exit(('%s: must specify exactly one of --init, --batch, --live,'
+                  ' or --patient/--mapping' % progname)
+                 + '\n' + p.format_usage())
+
+    if opts.start is not None and not (opts.init or opts.targeted):
+        sys.exit(('%s: --start can only be used with --init'
+                  ' or --patient/--mapping' % progname)
                  + '\n' + p.format_usage())
-    if opts.end is not None and not opts.batch:
-        sys.exit(('%s: --end can only be used with --batch' % progname)
+    if opts.end is not None and not (opts.batch or opts.targeted):
+        sys.exit(('%s: --end can only be used with --batch'
+                  ' or --patient/--mapping' % progname)
                  + '\n' + p.format_usage())
 
+    if opts.targeted:
+        if opts.end is None:
+            opts.end = T(datetime.now(timezone.utc))
+        opts.terminate = True
+
     if opts.state_dir is None:
         opts.state_dir = opts.output_dir
 
-    if opts.init:
+    if opts.init or opts.targeted:
         if os.path.exists(opts.state_dir):
             sys.exit("%s: directory %s already exists"
                      % (progname, opts.state_dir))
@@ -123,46 +195,103 @@ def _parse_cmdline(args):
     return opts
 
 def _init_extractor(opts):
+    if opts.metrics == 'prometheus':
+        metrics.enable(os.path.join(opts.state_dir, '%metrics.prom'),
+                       'prometheus', opts.metrics_interval)
+    elif opts.metrics == 'json':
+        metrics.enable(os.path.join(opts.state_dir, '%metrics.json'),
+                       'json', opts.metrics_interval)
+
+    profiler.install(os.path.join(opts.state_dir, '%profile.txt'),
+                     opts.profile_interval, active = opts.profile)
+
     DWCDB.load_config(opts.password_file)
 
-    db = DWCDB(opts.server)
-    ex = Extractor(db, opts.state_dir, fatal_exceptions = True,
-                   deterministic_output = True, debug = True)
-
-    pmq = PatientMappingQueue('mapping',
-                              start_time = opts.start,
-                              end_time = opts.end)
-    ex.add_queue(pmq)
-
-    ex.add_queue(PatientBasicInfoQueue(
-        'patients',
-        start_time = opts.start, end_time = opts.end))
-    ex.add_queue(PatientStringAttributeQueue(
-        'strings',
-        start_time = opts.start, end_time = opts.end))
-    ex.add_queue(PatientDateAttributeQueue(
-        'dates',
-        start_time = opts.start, end_time = opts.end))
-    # ex.add_queue(BedTagQueue(
-    #     'beds',
-    #     start_time = opts.start, end_time = opts.end))
-
-    ex.add_queue(WaveSampleQueue(
-        'waves',
-        start_time = opts.start, end_time = opts.end))
-    ex.add_queue(NumericValueQueue(
-        'numerics',
-        start_time = opts.start, end_time = opts.end))
-    ex.add_queue(EnumerationValueQueue(
-        'enums',
-        start_time = opts.start, end_time = opts.end))
-    ex.add_queue(AlertQueue(
-        'alerts',
-        start_time = opts.start, end_time = opts.end))
-    return ex
+    group = ExtractorGroup(opts.state_dir, fatal_exceptions = True,
+                           deterministic_output = True, debug = True)
+
+    qopts = {'start_time': opts.start,
+             'end_time': opts.end,
+             'target_batch_rows': opts.batch_rows,
+             'target_query_time': opts.batch_time}
+
+    for server in opts.server:
+        db = DWCDB(server)
+
+        # With multiple servers, each server's queues (and their
+        # state files) are named after the server
+        if len(opts.server) == 1:
+            prefix = ''
+        else:
+            prefix = server + '.'
+
+        if opts.targeted:
+            _add_targeted_queues(opts, group, db, prefix, qopts)
+            continue
+
+        ex = group.add_extractor(db)
+        ex.add_queue(PatientMappingQueue(prefix + 'mapping', **qopts))
+        ex.add_queue(PatientBasicInfoQueue(prefix + 'patients', **qopts))
+        ex.add_queue(PatientStringAttributeQueue(prefix + 'strings', **qopts))
+        ex.add_queue(PatientDateAttributeQueue(prefix + 'dates', **qopts))
+        # ex.add_queue(BedTagQueue(prefix + 'beds', **qopts))
+
+        ex.add_queue(WaveSampleQueue(prefix + 'waves', **qopts))
+        ex.add_queue(NumericValueQueue(prefix + 'numerics', **qopts))
+        ex.add_queue(EnumerationValueQueue(prefix + 'enums', **qopts))
+        ex.add_queue(AlertQueue(prefix + 'alerts', **qopts))
+    return group
+
+def _add_targeted_queues(opts, group, db, prefix, qopts):
+    # Find all mapping IDs belonging to the selected patients, and all
+    # patients associated with the selected mapping IDs
+    conn = group.connection(db)
+    mapping_ids = set(opts.mapping or [])
+    patient_ids = set(opts.patient or [])
+    for patient_id in opts.patient or []:
+        p = PatientMappingParser(dialect = db.dialect,
+                                 paramstyle = db.paramstyle,
+                                 limit = None, patient_id = patient_id)
+        for msg in db.get_messages(p, connection = conn):
+            mapping_ids.add(msg.mapping_id)
+    for mapping_id in list(mapping_ids):
+        p = PatientMappingParser(dialect = db.dialect,
+                                 paramstyle = db.paramstyle,
+                                 limit = None, mapping_id = mapping_id)
+        for msg in db.get_messages(p, connection = conn):
+            patient_ids.add(msg.patient_id)
+
+    if not mapping_ids:
+        sys.exit('%s: no mapping IDs found for the given patients on %s'
+                 % (sys.argv[0], db.servername))
+
+    # Each mapping ID, and each patient, is read by a separate
+    # extractor, so that they are processed in turn (all of them
+    # using the same connection to the server)
+    for mapping_id in sorted(mapping_ids):
+        ex = group.add_extractor(db)
+        mprefix = '%s%s.' % (prefix, mapping_id)
+        mopts = dict(qopts, mapping_id = mapping_id)
+        ex.add_queue(PatientMappingQueue(mprefix + 'mapping', **mopts))
+        ex.add_queue(WaveSampleQueue(mprefix + 'waves', **mopts))
+        ex.add_queue(NumericValueQueue(mprefix + 'numerics', **mopts))
+        ex.add_queue(EnumerationValueQueue(mprefix + 'enums', **mopts))
+        ex.add_queue(AlertQueue(mprefix + 'alerts', **mopts))
+
+    for patient_id in sorted(patient_ids):
+        ex = group.add_extractor(db)
+        pprefix = '%s%s.' % (prefix, patient_id)
+        popts = dict(qopts, patient_id = patient_id)
+        ex.add_queue(PatientBasicInfoQueue(pprefix + 'patients', **popts))
+        ex.add_queue(PatientStringAttributeQueue(pprefix + 'strings',
+                                                 **popts))
+        ex.add_queue(PatientDateAttributeQueue(pprefix + 'dates', **popts))
 
 def _init_archive(opts, extractor):
-    a = Archive(opts.output_dir, deterministic_output = True)
+    a = Archive(opts.output_dir, deterministic_output = True,
+                finalization_workers = opts.finalize_workers,
+                durability = opts.durability,
+                max_open_files = opts.max_open_files)
     extractor.add_handler(NumericValueHandler(a))
     extractor.add_handler(WaveSampleHandler(a))
     extractor.add_handler(EnumerationValueHandler(a))
@@ -186,7 +315,10 @@ def _main_loop(opts, extractor, archive):
     if opts.terminate:
         extractor.dispatcher.terminate()
         extractor.flush()
-        a = Archive(opts.output_dir)
+        a = Archive(opts.output_dir,
+                    finalization_workers = opts.finalize_workers,
+                    durability = opts.durability)
         a.terminate()
+        a.wait_finalized()
     else:
         extractor.flush()
@@ -16,12 +16,68 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import namedtuple
+def message_type(typename, field_names, key):
+    """
+    Create a class representing a type of message.
+
+    Messages behave like namedtuples: fields are passed to the
+    constructor (by position or by keyword) and accessed as
+    attributes, and the repr is the same.  Messages are used as
+    dictionary keys at several points along the way from the
+    database to the output handlers, so the hash is computed once,
+    from the fields listed in key (which must identify a unique row
+    in the source table.)  Two messages are equal if all their
+    fields are equal.
+
+    Messages must not be modified after they are created.
+    """
+    field_names = tuple(field_names)
+    args = ', '.join(field_names)
+    body = ''.join('    self.%s = %s\n' % (f, f) for f in field_names)
+    ns = {}
+    exec(('def __init__(self, %s):\n%s'
+          '    self._hash = hash((%s,))\n')
+         % (args, body, ', '.join(key)), ns)
+
+    def _values(self):
+        return tuple(getattr(self, f) for f in field_names)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not type(self) or other._hash != self._hash:
+            return False
+        return _values(self) == _values(other)
+
+    def __ne__(self, other):
+        return not __eq__(self, other)
+
+    def __repr__(self):
+        return '%s(%s)' % (typename, ', '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in field_names))
+
+    def __reduce__(self):
+        return (type(self), _values(self))
+
+    return type(typename, (), {
+        '__slots__': field_names + ('_hash',),
+        '__doc__': '%s(%s)' % (typename, args),
+        '_fields': field_names,
+        '__init__': ns['__init__'],
+        '__hash__': __hash__,
+        '__eq__': __eq__,
+        '__ne__': __ne__,
+        '__repr__': __repr__,
+        '__reduce__': __reduce__,
+    })
 
 ################################################################
 
 # _Export.WaveSample_
-WaveSampleMessage = namedtuple('WaveSampleMessage', (
+WaveSampleMessage = message_type('WaveSampleMessage', (
     # The original data source (required for looking up wave_ids.)
     'origin',
 
@@ -64,12 +120,13 @@
     'paced_pulses',
 
     # Should correspond to 'mapping_id' in PatientMappingMessage.
-    'mapping_id'))
+    'mapping_id'),
+    key = ('wave_id', 'timestamp', 'sequence_number', 'mapping_id'))
 
 ################################################################)
 
 # _Export.Alert_
-AlertMessage = namedtuple('AlertMessage', (
+AlertMessage = message_type('AlertMessage', (
     # The original data source.
     'origin',
 
@@ -120,12 +177,13 @@
     'end_time',
 
     # Should correspond to 'mapping_id' in PatientMappingMessage.
-    'mapping_id'))
+    'mapping_id'),
+    key = ('alert_id', 'timestamp', 'sequence_number', 'mapping_id'))
 
 ################################################################)
 
 # _Export.EnumerationValue_
-EnumerationValueMessage = namedtuple('EnumerationValueMessage', (
+EnumerationValueMessage = message_type('EnumerationValueMessage', (
     # The original data source (required for looking up
     # enumeration_ids.)
     'origin',
@@ -149,12 +207,14 @@
     'value',
 
     # Should correspond to 'mapping_id' in PatientMappingMessage.
-    'mapping_id'))
+    'mapping_id'),
+    key = ('enumeration_id', 'timestamp', 'sequence_number',
+           'mapping_id'))
 
 ################################################################
 
 # _Export.NumericValue_
-NumericValueMessage = namedtuple('NumericValueMessage', (
+NumericValueMessage = message_type('NumericValueMessage', (
     # The original data source (required for looking up
     # numeric_ids.)
     'origin',
@@ -182,12 +242,13 @@
     'value',
 
     # Should correspond to 'mapping_id' in PatientMappingMessage.
-    'mapping_id'))
+    'mapping_id'),
+    key = ('numeric_id', 'timestamp', 'sequence_number', 'mapping_id'))
 
 ################################################################
 
 # _Export.PatientMapping_
-PatientMappingMessage = namedtuple('PatientMappingMessage', (
+PatientMappingMessage = message_type('PatientMappingMessage', (
     # The original data source.
     'origin',
 
@@ -207,10 +268,11 @@
 
     # Presumably indicates the original host from which the message
     # was received by the DWC system.
-    'hostname'))
+    'hostname'),
+    key = ('mapping_id', 'timestamp'))
 
 # _Export.Patient_
-PatientBasicInfoMessage = namedtuple('PatientBasicInfoMessage', (
+PatientBasicInfoMessage = message_type('PatientBasicInfoMessage', (
     # The original data source.
     'origin',
 
@@ -258,10 +320,11 @@
     'clinical_unit',
 
     # Magic number for sex.
-    'gender'))
+    'gender'),
+    key = ('patient_id', 'timestamp'))
 
 # _Export.BedTag_
-BedTagMessage = namedtuple('BedTagMessage', (
+BedTagMessage = message_type('BedTagMessage', (
     # The original data source.
     'origin',
 
@@ -273,10 +336,12 @@
     'timestamp',
 
     # Tag.  What is this?
-    'tag'))
+    'tag'),
+    key = ('bed_label', 'timestamp'))
 
 # _Export.PatientDateAttribute_
-PatientDateAttributeMessage = namedtuple('PatientDateAttributeMessage', (
+PatientDateAttributeMessage = message_type(
+    'PatientDateAttributeMessage', (
     # The original data source.
     'origin',
 
@@ -291,10 +356,12 @@
     'name',
 
     # Value of the attribute.
-    'value'))
+    'value'),
+    key = ('patient_id', 'timestamp', 'name'))
 
 # _Export.PatientStringAttribute_
-PatientStringAttributeMessage = namedtuple('PatientStringAttributeMessage', (
+PatientStringAttributeMessage = message_type(
+    'PatientStringAttributeMessage', (
     # The original data source.
     'origin',
 
@@ -309,5 +376,6 @@
     'name',
 
     # Value of the attribute.
-    'value'))
+    'value'),
+    key = ('patient_id', 'timestamp', 'name'))
 
@@ -0,0 +1,296 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runtime metrics.
+
+Metrics are disabled by default, in which case the functions in this
+module do nothing.  When enabled (by calling enable()), each process
+keeps its own set of counters, gauges and histograms, and
+periodically rewrites a file containing their current values, either
+in Prometheus text format (suitable for the node exporter's textfile
+collector) or in JSON format.
+
+Every sample is labelled with the name of the process ('main' for
+the extractor process, or the name of the child process), so the
+files written by different processes may be combined.
+
+All metrics are listed in _metric_info below.
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+
+# Histogram buckets
+_time_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1, 2.5, 5, 10, 30, 60)
+_count_buckets = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Metric name: (type, description, histogram buckets)
+_metric_info = {
+    # Extractor (per queue)
+    'downcast_query_seconds': (
+        'histogram', 'Time spent executing queries and fetching rows',
+        _time_buckets),
+    'downcast_dispatch_seconds': (
+        'histogram', 'Time spent dispatching the messages from one query',
+        _time_buckets),
+    'downcast_batch_rows': (
+        'histogram', 'Number of rows returned by one query',
+        _count_buckets),
+    'downcast_rows_fetched_total': (
+        'counter', 'Total number of rows fetched', None),
+    'downcast_queries_total': (
+        'counter', 'Total number of queries executed', None),
+    'downcast_rows_per_second': (
+        'gauge', 'Rows fetched per second by the latest query', None),
+    'downcast_batch_duration_seconds': (
+        'gauge', 'Time span requested by the latest query', None),
+    'downcast_batch_limit': (
+        'gauge', 'Row limit of the latest query', None),
+    'downcast_queue_lag_seconds': (
+        'gauge', 'Time between the newest message in the queue and'
+        ' the newest message in any queue', None),
+    'downcast_queue_unacked_messages': (
+        'gauge', 'Number of messages not yet acknowledged', None),
+    'downcast_queue_acked_saved': (
+        'gauge', 'Number of acknowledged messages remembered from'
+        ' the previous run', None),
+    'downcast_probes_total': (
+        'counter', 'Total number of queries checking an idle queue'
+        ' for new messages', None),
+
+    # Extractor (parent side of each child process)
+    'downcast_child_backpressure_waits_total': (
+        'counter', 'Number of times the pipe to a child process'
+        ' was full', None),
+    'downcast_child_backpressure_seconds_total': (
+        'counter', 'Time spent waiting for a child process to'
+        ' catch up', None),
+
+    # Child processes
+    'downcast_dispatcher_pending_messages': (
+        'gauge', 'Number of messages waiting for acknowledgement', None),
+    'downcast_dispatcher_channels': (
+        'gauge', 'Number of channels with pending messages', None),
+    'downcast_dispatcher_replayed_total': (
+        'counter', 'Total number of messages re-sent to handlers', None),
+    'downcast_dispatcher_expired_total': (
+        'counter', 'Total number of messages that expired', None),
+    'downcast_handler_calls_total': (
+        'counter', 'Total number of messages sent to each handler', None),
+    'downcast_handler_seconds_total': (
+        'counter', 'Total time spent in each handler', None),
+    'downcast_flush_seconds': (
+        'histogram', 'Time spent flushing output files', _time_buckets),
+}
+
+class MetricsRegistry:
+    """
+    Set of metric values belonging to one process.
+
+    Values are keyed by metric name and by a tuple of (label, value)
+    pairs.  Collectors are functions that are called before writing
+    the output file, and may update gauges that are expensive to
+    maintain continuously.
+    """
+
+    def __init__(self, filename, fmt, interval, process):
+        self.filename = filename
+        self.fmt = fmt
+        self.interval = interval
+        self.process = process
+        self.pid = os.getpid()
+        self.values = {}
+        self.collectors = []
+        self.last_write = time.monotonic()
+
+    def output_file(self):
+        if self.process == 'main':
+            return self.filename
+        (base, ext) = os.path.splitext(self.filename)
+        return '%s.%s%s' % (base, self.process, ext)
+
+    def write(self):
+        """Write the current values to the output file."""
+        self.last_write = time.monotonic()
+        if os.getpid() != self.pid:
+            # Forked worker processes do not inherit the right to
+            # write this file
+            return
+        for c in self.collectors:
+            c()
+        if self.fmt == 'json':
+            content = self._format_json()
+        else:
+            content = self._format_prometheus()
+        fname = self.output_file()
+        tmpfname = fname + '.tmp'
+        try:
+            with open(tmpfname, 'wt', encoding = 'UTF-8') as f:
+                f.write(content)
+            os.rename(tmpfname, fname)
+        except OSError as e:
+            logging.warning('unable to write %s: %s' % (fname, e))
+
+    def _sorted_values(self):
+        names = {}
+        for ((name, labels), value) in self.values.items():
+            names.setdefault(name, []).append((labels, value))
+        for name in sorted(names):
+            yield (name, _metric_info[name], sorted(names[name]))
+
+    def _format_prometheus(self):
+        lines = []
+        plabel = ('process', self.process)
+        for (name, (kind, desc, buckets), values) in self._sorted_values():
+            lines.append('# HELP %s %s' % (name, desc))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, value) in values:
+                labels = (plabel,) + labels
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+                (counts, total, count) = value
+                n = 0
+                for (le, c) in zip(buckets, counts):
+                    n += c
+                    lines.append('%s_bucket%s %d'
+                                 % (name, _format_labels(
+                                     labels + (('le', repr(le)),)), n))
+                lines.append('%s_bucket%s %d'
+                             % (name, _format_labels(
+                                 labels + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                              _format_value(total)))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                                count))
+        return ''.join(line + '\n' for line in lines)
+
+    def _format_json(self):
+        data = {}
+        for (name, (kind, desc, buckets), values) in self._sorted_values():
+            samples = []
+            for (labels, value) in values:
+                s = {'labels': dict(labels)}
+                if kind == 'histogram':
+                    (counts, total, count) = value
+                    cumulative = []
+                    n = 0
+                    for (le, c) in zip(buckets, counts):
+                        n += c
+                        cumulative.append([le, n])
+                    s['buckets'] = cumulative
+                    s['sum'] = total
+                    s['count'] = count
+                else:
+                    s['value'] = value
+                samples.append(s)
+            data[name] = {'type': kind, 'help': desc, 'samples': samples}
+        return json.dumps({'process': self.process, 'pid': self.pid,
+                           'time': time.time(), 'metrics': data},
+                          sort_keys = True, indent = 1) + '\n'
+
+def _format_labels(labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for (k, v) in labels)
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+_registry = None
+
+def enable(filename, fmt = 'prometheus', interval = 15):
+    """
+    Enable metrics for this process and its future child processes.
+
+    Values are written to filename (and, for child processes, to a
+    file whose name includes the process name) at most once every
+    interval seconds.  fmt is either 'prometheus' or 'json'.
+    """
+    global _registry
+    if fmt not in ('prometheus', 'json'):
+        raise ValueError('unknown metrics format %r' % fmt)
+    _registry = MetricsRegistry(filename, fmt, interval, 'main')
+
+def enabled():
+    """Check whether metrics are enabled."""
+    return _registry is not None
+
+def child_process(name):
+    """
+    Start a separate set of metrics for a new child process.
+
+    This should be called by the child process immediately after it
+    is forked; values inherited from the parent are discarded.
+    """
+    global _registry
+    r = _registry
+    if r is not None:
+        _registry = MetricsRegistry(r.filename, r.fmt, r.interval, name)
+
+def add_collector(func):
+    """Add a function to be called before writing metrics."""
+    if _registry is not None:
+        _registry.collectors.append(func)
+
+def inc(name, value = 1, **labels):
+    """Increment a counter."""
+    r = _registry
+    if r is not None:
+        k = (name, tuple(sorted(labels.items())))
+        r.values[k] = r.values.get(k, 0) + value
+
+def set_gauge(name, value, **labels):
+    """Set the value of a gauge."""
+    r = _registry
+    if r is not None:
+        r.values[name, tuple(sorted(labels.items()))] = value
+
+def observe(name, value, **labels):
+    """Add an observation to a histogram."""
+    r = _registry
+    if r is not None:
+        k = (name, tuple(sorted(labels.items())))
+        h = r.values.get(k)
+        if h is None:
+            buckets = _metric_info[name][2]
+            h = r.values[k] = ([0] * len(buckets), 0, 0)
+        (counts, total, count) = h
+        i = bisect.bisect_left(_metric_info[name][2], value)
+        if i < len(counts):
+            counts[i] += 1
+        r.values[k] = (counts, total + value, count + 1)
+
+def maybe_write():
+    """Write metrics to disk if the update interval has elapsed."""
+    r = _registry
+    if r is not None and time.monotonic() - r.last_write >= r.interval:
+        r.write()
+
+def write():
+    """Write metrics to disk immediately."""
+    if _registry is not None:
+        _registry.write()
@@ -0,0 +1,663 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks of individual components.
+
+Each benchmark measures one hot path in isolation (reading bcp
+files, executing queries, parsing timestamps, dispatching messages,
+writing waveforms, and reading log files), using synthetic input
+data (see downcast.synthetic) that is identical from one run to the
+next.
+
+Some benchmarks have "cold" and "warm" variants.  A cold run starts
+from scratch each time: input files are evicted from the OS page
+cache (where possible), and connections and memoized values are
+discarded.  A warm run reuses them.
+
+Results may be appended to a JSON history file, in which case each
+result is compared with the previous run, so that regressions can be
+spotted before they reach production.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from . import timestamp
+from .timestamp import T
+from .synthetic import generate, _wave_types
+from .db import dwcbcp
+from .parser import WaveSampleParser
+from .messages import NumericValueMessage
+from .dispatcher import Dispatcher
+from .subprocess import ParallelDispatcher
+from .attributes import WaveAttr
+from .output.archive import ArchiveRecord
+from .output.files import ArchiveLogFile
+from .output.log import ArchiveLogReader
+from .output.waveforms import WaveOutputInfo
+
+# Default size of the synthetic data set
+_default_beds = 2
+_default_hours = 0.25
+_default_seed = 1
+
+################################################################
+
+_benchmarks = OrderedDict()
+
+def _register(cls):
+    _benchmarks[cls.name] = cls
+    return cls
+
+class MicroBenchmark:
+    """
+    Abstract class for a micro-benchmark.
+
+    Derived classes must define 'name' and 'run', and may define
+    'variants', 'setup', 'teardown', and 'close'.  The object is
+    created once for each variant; setup and teardown are called
+    before and after each repetition (and are not included in the
+    measured time); run performs one repetition and returns the
+    number of items processed.
+    """
+    variants = ('warm',)
+
+    def __init__(self, context, variant):
+        self.context = context
+        self.variant = variant
+
+    def setup(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError()
+
+    def teardown(self):
+        pass
+
+    def close(self):
+        pass
+
+class BenchmarkContext:
+    """Shared input data for micro-benchmarks."""
+
+    def __init__(self, data_dir, work_dir):
+        self.data_dir = data_dir
+        self.work_dir = work_dir
+        with open(os.path.join(data_dir, 'synthetic.json')) as f:
+            self.summary = json.load(f)
+        self._counter = 0
+
+    def connect(self):
+        """Open a new connection to the synthetic database."""
+        return dwcbcp.connect([self.data_dir])
+
+    def data_files(self, table):
+        """Get the list of data files for a table."""
+        with self.connect() as conn:
+            return conn.get_table(table).data_files()
+
+    def temp_path(self, name):
+        """Get a unique path name in the working directory."""
+        self._counter += 1
+        return os.path.join(self.work_dir, '%s.%d' % (name, self._counter))
+
+def drop_cache(files):
+    """
+    Evict files from the operating system's page cache.
+
+    This is only a request, and has no effect on dirty pages or on
+    platforms that do not support posix_fadvise.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for f in files:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+################################################################
+
+@_register
+class BCPFetchBenchmark(MicroBenchmark):
+    """Read every row of the WaveSample table."""
+    name = 'bcp.fetch'
+    variants = ('cold', 'warm')
+    table = '_Export.WaveSample_'
+
+    def __init__(self, context, variant):
+        MicroBenchmark.__init__(self, context, variant)
+        self.files = context.data_files(self.table)
+        self.conn = None
+
+    def setup(self):
+        if self.variant == 'cold':
+            drop_cache(self.files)
+            self.close()
+
+    def run(self):
+        if self.conn is None:
+            self.conn = self.context.connect()
+        n = 0
+        with self.conn.get_table(self.table).iterator() as it:
+            while it.fetch() is not None:
+                n += 1
+        return n
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+@_register
+class BCPQueryBenchmark(BCPFetchBenchmark):
+    """
+    Read the WaveSample table through the cursor interface.
+
+    The queries are those that the extractor would generate: one for
+    each minute of data, with a row limit and a TimeStamp range.
+    """
+    name = 'bcp.query'
+    window = timedelta(minutes = 1)
+    limit = 10000
+
+    def __init__(self, context, variant):
+        BCPFetchBenchmark.__init__(self, context, variant)
+        self.queries = []
+        t = T(context.summary['start'])
+        end = T(context.summary['end'])
+        while t <= end:
+            p = WaveSampleParser(dialect = 'sqlite', paramstyle = 'qmark',
+                                 limit = self.limit, time_ge = t,
+                                 time_lt = t + self.window)
+            self.queries += p.queries()
+            t += self.window
+
+    def run(self):
+        if self.conn is None:
+            self.conn = self.context.connect()
+        n = 0
+        with self.conn.cursor() as cursor:
+            for ((query, params), handle_row) in self.queries:
+                cursor.execute(query, params)
+                row = cursor.fetchone()
+                while row:
+                    handle_row(None, row)
+                    n += 1
+                    row = cursor.fetchone()
+        return n
+
+@_register
+class TimestampBenchmark(MicroBenchmark):
+    """
+    Parse timestamp strings.
+
+    The input resembles a database table, in which each timestamp
+    is repeated several times.  Except in the warm variant, the memo
+    of recently parsed timestamps is cleared before each repetition.
+    """
+    name = 'timestamp.parse'
+    variants = ('cold', 'warm', 'bytes')
+    count = 16000
+    repeat = 4
+
+    def __init__(self, context, variant):
+        MicroBenchmark.__init__(self, context, variant)
+        start = T(context.summary['start'])
+        strings = []
+        for i in range(self.count // self.repeat):
+            s = str(start + timedelta(milliseconds = 256 * i))
+            strings += [s] * self.repeat
+        if variant == 'bytes':
+            self.inputs = [s.encode() for s in strings]
+            self.parse = timestamp.parse_bytes
+        else:
+            self.inputs = strings
+            self.parse = T
+
+    def setup(self):
+        if self.variant != 'warm':
+            timestamp._parsed.clear()
+
+    def run(self):
+        parse = self.parse
+        for s in self.inputs:
+            parse(s)
+        return len(self.inputs)
+
+class _NullSource:
+    """Message source that counts acknowledgements."""
+    def __init__(self):
+        self.acked = 0
+
+    def ack_message(self, channel, msg, handler):
+        self.acked += 1
+
+    def nack_message(self, channel, msg, handler):
+        pass
+
+class _AckHandler:
+    """Handler that acknowledges every message immediately."""
+    def send_message(self, chn, msg, source, ttl):
+        source.ack_message(chn, msg, self)
+
+    def flush(self):
+        pass
+
+class _ReplayHandler:
+    """
+    Handler that defers messages until a later message arrives.
+
+    Like the waveform handler, this nacks each message with replay
+    enabled, and acknowledges it once enough later messages have been
+    seen in the same channel.
+    """
+    def __init__(self, period):
+        self.period = period
+        self.acked_through = {}
+
+    def send_message(self, chn, msg, source, ttl):
+        source.nack_message(chn, msg, self)
+        sn = msg.sequence_number
+        if sn % self.period == self.period - 1:
+            self.acked_through[chn] = sn
+        if ttl <= 0 or sn <= self.acked_through.get(chn, -1):
+            source.ack_message(chn, msg, self)
+        else:
+            source.nack_message(chn, msg, self, replay = True)
+
+    def flush(self):
+        pass
+
+def _numeric_messages(context, count, channels):
+    start = T(context.summary['start'])
+    msgs = []
+    for i in range(count):
+        chn = 'bed%d' % (i % channels)
+        msgs.append((chn, NumericValueMessage(
+            origin = None, numeric_id = 1,
+            timestamp = start + timedelta(milliseconds = i // channels),
+            sequence_number = i // channels,
+            is_trend_uploaded = False, compound_value_id = None,
+            value = '80', mapping_id = chn)))
+    return msgs
+
+@_register
+class DispatcherBenchmark(MicroBenchmark):
+    """Send messages to a replaying handler and an acking handler."""
+    name = 'dispatcher.send_message'
+    count = 20000
+    channels = 4
+    period = 16
+    ttl = 10000
+
+    def __init__(self, context, variant):
+        MicroBenchmark.__init__(self, context, variant)
+        self.messages = _numeric_messages(context, self.count, self.channels)
+
+    def run(self):
+        d = Dispatcher(fatal_exceptions = True)
+        d.add_handler(_ReplayHandler(self.period))
+        d.add_handler(_AckHandler())
+        src = _NullSource()
+        for (chn, msg) in self.messages:
+            d.send_message(chn, msg, src, self.ttl)
+        d.terminate()
+        if src.acked != len(self.messages):
+            raise Exception('%d of %d messages acknowledged'
+                            % (src.acked, len(self.messages)))
+        return len(self.messages)
+
+@_register
+class ParallelDispatcherBenchmark(MicroBenchmark):
+    """
+    Send messages to child processes and wait for acknowledgement.
+
+    In the cold variant, starting the child processes is included in
+    the measured time.
+    """
+    name = 'parallel.round_trip'
+    variants = ('cold', 'warm')
+    count = 20000
+    channels = 8
+    children = 4
+    ttl = 10000
+
+    def __init__(self, context, variant):
+        MicroBenchmark.__init__(self, context, variant)
+        self.messages = _numeric_messages(context, self.count, self.channels)
+        self.dispatcher = None
+
+    def setup(self):
+        self.dispatcher = ParallelDispatcher(self.children,
+                                             fatal_exceptions = True)
+        self.dispatcher.add_handler(_AckHandler())
+        if self.variant == 'warm':
+            self.dispatcher.flush()
+
+    def run(self):
+        src = _NullSource()
+        for (chn, msg) in self.messages:
+            self.dispatcher.send_message(chn, msg, src, self.ttl)
+        self.dispatcher.flush()
+        if src.acked != len(self.messages):
+            raise Exception('%d of %d messages acknowledged'
+                            % (src.acked, len(self.messages)))
+        return len(self.messages)
+
+    def teardown(self):
+        self.dispatcher._stop()
+        self.dispatcher = None
+
+@_register
+class WaveformBenchmark(MicroBenchmark):
+    """Write chunks of waveform data to a new record."""
+    name = 'waveform.write_signals'
+    minutes = 10
+    signals = 4
+    chunk = 256
+
+    def __init__(self, context, variant):
+        MicroBenchmark.__init__(self, context, variant)
+        self.attrs = []
+        for (i, w) in enumerate(_wave_types[:self.signals]):
+            (label, base_id, physio_id, period, units, unit_code,
+             (cal_lower, cal_upper), _) = w
+            self.attrs.append(WaveAttr(
+                base_physio_id = base_id, physio_id = physio_id,
+                label = label, channel = i + 1, sample_period = period,
+                is_slow_wave = False, is_derived = False, color = 0,
+                low_edge_frequency = None, high_edge_frequency = None,
+                scale_lower = 0, scale_upper = 4095,
+                calibration_scaled_lower = 0,
+                calibration_scaled_upper = 4095,
+                calibration_abs_lower = float(cal_lower),
+                calibration_abs_upper = float(cal_upper),
+                calibration_type = 0, unit_label = units,
+                unit_code = unit_code, ecg_lead_placement = 0))
+        self.attrs.sort(key = lambda a: (a.base_physio_id, a.channel,
+                                         a.physio_id))
+        samples = bytes(range(1, 256)) * 16
+        self.chunks = []
+        for start in range(0, self.minutes * 60000, self.chunk):
+            self.chunks.append((start, start + self.chunk, [
+                (a, samples[:self.chunk // a.sample_period * 2])
+                for a in self.attrs]))
+        self.record = None
+
+    def setup(self):
+        path = self.context.temp_path('record')
+        self.record = ArchiveRecord(path, 'bench', 'bench', None,
+                                    create = True)
+        self.info = WaveOutputInfo(self.record)
+
+    def run(self):
+        n = 0
+        for (start, end, sigdata) in self.chunks:
+            self.info.write_signals(self.record, start, end, sigdata)
+            for (_, samples) in sigdata:
+                n += len(samples) // 2
+        return n
+
+    def teardown(self):
+        self.info.flush_signals(self.record)
+        self.record.flush()
+        self.record.unload()
+        shutil.rmtree(self.record.path)
+        self.record = None
+
+@_register
+class LogReaderBenchmark(MicroBenchmark):
+    """
+    Read a mostly-sorted log file in order.
+
+    The file resembles a numerics log, in which one block out of
+    every ten arrived late and was written out of order.
+    """
+    name = 'log.sorted_items'
+    variants = ('cold', 'warm')
+    count = 100000
+    block = 100
+
+    def __init__(self, context, variant):
+        MicroBenchmark.__init__(self, context, variant)
+        start = T(context.summary['start'])
+        sn0 = int(start.timestamp() * 1000)
+        blocks = []
+        for b in range(self.count // self.block):
+            lines = []
+            for i in range(b * self.block, (b + 1) * self.block):
+                sn = sn0 + i * 1024
+                t = datetime.fromtimestamp(sn / 1000, timezone.utc)
+                lines.append('S%d' % sn)
+                lines.append(t.strftime('%Y%m%d%H%M%S%f'))
+                lines.append('HR\t%d' % (60 + i % 50))
+            blocks.append(lines)
+        for b in range(10, len(blocks), 10):
+            (blocks[b - 1], blocks[b]) = (blocks[b], blocks[b - 1])
+
+        self.filename = context.temp_path('log')
+        f = ArchiveLogFile(self.filename)
+        for lines in blocks:
+            f.append_many(lines)
+        f.close()
+
+    def setup(self):
+        if self.variant == 'cold':
+            drop_cache([self.filename])
+
+    def run(self):
+        n = 0
+        with ArchiveLogReader(self.filename) as r:
+            for _ in r.sorted_items():
+                n += 1
+        if n != self.count:
+            raise Exception('%d of %d log entries read' % (n, self.count))
+        return n
+
+    def close(self):
+        os.unlink(self.filename)
+
+################################################################
+
+def run_benchmarks(data_dir, work_dir, names = None, repeat = 5,
+                   log = None):
+    """
+    Run micro-benchmarks and return a list of results.
+
+    names is a list of benchmark names (or name prefixes) to run; by
+    default all benchmarks are run.  Each result is a dictionary
+    containing 'name', 'variant', 'items' (number of items processed
+    per repetition), 'min' and 'median' (time per repetition, in
+    seconds), and 'items_per_second' (based on the median.)
+    """
+    context = BenchmarkContext(data_dir, work_dir)
+    results = []
+    for (name, cls) in _benchmarks.items():
+        if names and not any(name == n or name.startswith(n + '.')
+                             for n in names):
+            continue
+        for variant in cls.variants:
+            if log:
+                log('%s [%s]' % (name, variant))
+            bench = cls(context, variant)
+            try:
+                times = []
+                for _ in range(repeat):
+                    bench.setup()
+                    gc.collect()
+                    gc.disable()
+                    try:
+                        start = time.perf_counter()
+                        items = bench.run()
+                        times.append(time.perf_counter() - start)
+                    finally:
+                        gc.enable()
+                        bench.teardown()
+            finally:
+                bench.close()
+            median = statistics.median(times)
+            results.append({
+                'name': name,
+                'variant': variant,
+                'items': items,
+                'min': min(times),
+                'median': median,
+                'items_per_second': items / median,
+            })
+    return results
+
+def _result_key(r):
+    return '%s [%s]' % (r['name'], r['variant'])
+
+def compare_results(results, history, threshold = 0.1):
+    """
+    Compare results with those of previous runs.
+
+    history is a list of previous runs, as saved by main().  Each
+    result is compared with the most recent run of the same benchmark
+    and variant (with the same number of items), and annotated with
+    'change' (the relative change in median time, or None if there is
+    nothing to compare with) and 'regression' (true if the median time
+    increased by more than threshold.)  Returns the list of
+    regressions.
+    """
+    old = {}
+    for run in history:
+        for r in run['results']:
+            old[_result_key(r)] = r
+    regressions = []
+    for r in results:
+        p = old.get(_result_key(r))
+        if p is None or p['items'] != r['items']:
+            r['change'] = None
+            r['regression'] = False
+        else:
+            r['change'] = r['median'] / p['median'] - 1
+            r['regression'] = (r['change'] > threshold)
+            if r['regression']:
+                regressions.append(r)
+    return regressions
+
+def _read_history(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+def _write_history(filename, history):
+    tmpfname = filename + '.tmp'
+    with open(tmpfname, 'wt') as f:
+        json.dump(history, f, indent = 1, sort_keys = True)
+        f.write('\n')
+    os.rename(tmpfname, filename)
+
+def _format_results(results):
+    lines = ['%-36s %8s %10s %10s %12s %8s'
+             % ('benchmark', 'items', 'min (s)', 'median (s)',
+                'items/s', 'change')]
+    for r in results:
+        ch = r.get('change')
+        lines.append('%-36s %8d %10.4f %10.4f %12.0f %8s%s'
+                     % (_result_key(r), r['items'], r['min'], r['median'],
+                        r['items_per_second'],
+                        '-' if ch is None else '%+.1f%%' % (ch * 100),
+                        ' REGRESSION' if r.get('regression') else ''))
+    return '\n'.join(lines)
+
+def main():
+    p = ArgumentParser(
+        description = 'Measure the speed of individual components.')
+    p.add_argument('names', metavar = 'NAME', nargs = '*',
+                   help = 'benchmarks to run (default: all)')
+    p.add_argument('--list', action = 'store_true',
+                   help = 'list available benchmarks and exit')
+    p.add_argument('--repeat', metavar = 'N', type = int, default = 5,
+                   help = 'number of repetitions (default: 5)')
+    p.add_argument('--data-dir', metavar = 'DIR',
+                   help = 'existing synthetic data directory')
+    p.add_argument('--work-dir', metavar = 'DIR',
+                   help = 'directory for temporary files')
+    p.add_argument('--history', metavar = 'FILE',
+                   help = 'append results to FILE, and compare them'
+                   + ' with the previous run')
+    p.add_argument('--label', metavar = 'TEXT',
+                   help = 'description of this run (saved in history)')
+    p.add_argument('--threshold', metavar = 'PERCENT', type = float,
+                   default = 10,
+                   help = 'slowdown reported as a regression (default: 10)')
+    opts = p.parse_args()
+
+    if opts.list:
+        for (name, cls) in _benchmarks.items():
+            print('%-28s %s' % (name, ', '.join(cls.variants)))
+        return
+    for n in opts.names:
+        if not any(name == n or name.startswith(n + '.')
+                   for name in _benchmarks):
+            sys.exit('%s: unknown benchmark %r' % (sys.argv[0], n))
+
+    work_dir = tempfile.mkdtemp(prefix = 'downcast-microbench-',
+                                dir = opts.work_dir)
+    try:
+        data_dir = opts.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(work_dir, 'data')
+            generate(data_dir, beds = _default_beds, hours = _default_hours,
+                     seed = _default_seed)
+
+        results = run_benchmarks(data_dir, work_dir, names = opts.names,
+                                 repeat = opts.repeat,
+                                 log = lambda s: print(s, file = sys.stderr))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+    history = []
+    regressions = []
+    if opts.history:
+        history = _read_history(opts.history)
+        regressions = compare_results(results, history,
+                                      opts.threshold / 100)
+    print(_format_results(results))
+
+    if opts.history:
+        history.append({
+            'time': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'label': opts.label,
+            'python': platform.python_version(),
+            'data_dir': opts.data_dir,
+            'results': results,
+        })
+        _write_history(opts.history, history)
+    if regressions:
+        sys.exit('%d benchmark(s) slower than the previous run'
+                 % len(regressions))
@@ -46,21 +46,23 @@ def send_message(self, chn, msg, source, ttl):
         ts = msg.timestamp.strftime_utc('%Y%m%d%H%M%S%f')
         lbl = msg.label
 
-        logfile.append('S%s' % sn)
+        lines = ['S%s' % sn]
         if msg.announce_time and msg.announce_time > _sane_time:
             ats = msg.announce_time.strftime_utc('%Y%m%d%H%M%S%f')
-            logfile.append(ats)
-            logfile.append('%s+%s' % (msg.severity, lbl))
+            lines.append(ats)
+            lines.append('%s+%s' % (msg.severity, lbl))
         if msg.onset_time and msg.onset_time > _sane_time:
             ots = msg.onset_time.strftime_utc('%Y%m%d%H%M%S%f')
-            logfile.append(ots)
-            logfile.append('%s!%s' % (msg.severity, lbl))
+            lines.append(ots)
+            lines.append('%s!%s' % (msg.severity, lbl))
         if msg.end_time and msg.end_time > _sane_time:
             ets = msg.end_time.strftime_utc('%Y%m%d%H%M%S%f')
-            logfile.append(ets)
-            logfile.append('%s-%s' % (msg.severity, lbl))
-        logfile.append(ts)
-        logfile.append('%s=%s' % (msg.severity, lbl))
+            lines.append(ets)
+            lines.append('%s-%s' % (msg.severity, lbl))
+        lines.append(ts)
+        lines.append('%s=%s' % (msg.severity, lbl))
+
+        logfile.append_many(lines)
 
         source.ack_message(chn, msg, self)
 
@@ -19,11 +19,15 @@
 import os
 import re
 import json
+import logging
+from collections import OrderedDict
 
+from .. import profiler
 from ..timestamp import T, delta_ms
 from .files import ArchiveLogFile, ArchiveBinaryFile
 from .timemap import TimeMap
-from .process import WorkerProcess
+from .process import WorkerPool
+from .sync import SyncBatch
 from .waveforms import WaveSampleHandler
 from .enums import EnumerationValueHandler
 from .numerics import NumericValueHandler
@@ -31,8 +35,15 @@
 from .mapping import PatientMappingHandler
 from .patients import PatientHandler
 
-from datetime import datetime, timezone
-from .log import ArchiveLogReader
+from .log import ArchiveLogReader, log_time_us
+
+# Size at which a record's journal is merged into the properties and
+# time map files
+_journal_max_size = 256 * 1024
+
+# Pattern for record directory names (SERVER_RECORDID_DATESTAMP)
+_record_dir_pattern = re.compile(r'\A([A-Za-z0-9-]+)_([0-9a-f-]+)_([-0-9]+)\Z',
+                                 re.ASCII)
 
 def _subdirs(dirname):
     for f in os.listdir(dirname):
@@ -40,35 +51,139 @@ def _subdirs(dirname):
         if os.path.isdir(p):
             yield (p, f)
 
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _ascending_runs(iterable, size):
+    run = []
+    for item in iterable:
+        if len(run) >= size or (run and item < run[-1]):
+            yield run
+            run = []
+        run.append(item)
+    if run:
+        yield run
+
 class Archive:
-    def __init__(self, base_dir, deterministic_output = False):
+    def __init__(self, base_dir, deterministic_output = False,
+                 finalization_workers = 2, durability = 'fdatasync',
+                 max_open_files = 512):
         self.base_dir = base_dir
         self.prefix_length = 2
         self.records = {}
         self.split_interval = 60 * 60 * 1000 # ~ one hour
-        self.deterministic_output = deterministic_output
-        self.finalization_processes = []
 
-        pat = re.compile('\A([A-Za-z0-9-]+)_([0-9a-f-]+)_([-0-9]+)\Z',
-                         re.ASCII)
+        # Records that are loaded into memory, least recently used
+        # first.  When the archive is flushed, records are unloaded
+        # if they have not received any messages within idle_interval
+        # (compared to the latest message received for any record),
+        # or if there are more than max_open_files files open.
+        self._loaded_records = OrderedDict()
+        self._latest_time = None
+        self.idle_interval = 10 * 60 * 1000 # ~ ten minutes
+        self.max_open_files = max_open_files
 
+        self.deterministic_output = deterministic_output
+        self.durability = durability
+        SyncBatch(durability)   # check that the policy is valid
+        self.finalization_pool = WorkerPool(finalization_workers)
+
+        # The index directory contains a symbolic link to each record
+        # that has not yet been finalized, so that we don't need to
+        # scan the entire archive at startup.  If the index doesn't
+        # exist (e.g., the archive was created by an older version),
+        # scan the archive once and create it.
+        self.index_dir = os.path.join(base_dir, '%active')
+        self._index_modified = False
+        if os.path.isdir(self.index_dir):
+            self._read_index()
+        else:
+            self._create_index()
+
+    def _read_index(self):
+        for name in sorted(os.listdir(self.index_dir)):
+            link = os.path.join(self.index_dir, name)
+            m = _record_dir_pattern.match(name)
+            try:
+                path = os.path.normpath(os.path.join(self.index_dir,
+                                                     os.readlink(link)))
+            except OSError:
+                m = None
+            if m is None or not os.path.isdir(path):
+                logging.warning('removing invalid index entry %s' % link)
+                _unlink(link)
+                continue
+            rec = self._open_record(path = path,
+                                    servername = m.group(1),
+                                    record_id = m.group(2),
+                                    datestamp = m.group(3))
+            if rec is None:
+                _unlink(link)
+
+    def _create_index(self):
         # Find all existing records in 'base_dir' as well as immediate
         # subdirectories of 'base_dir'
+        records = []
         for (subdir, base) in _subdirs(self.base_dir):
-            m = pat.match(base)
+            if base.startswith('%'):
+                continue
+            m = _record_dir_pattern.match(base)
             if m is not None:
-                self._open_record(path = subdir,
-                                  servername = m.group(1),
-                                  record_id = m.group(2),
-                                  datestamp = m.group(3))
+                records.append((subdir, m))
             else:
                 for (subdir2, base2) in _subdirs(subdir):
-                    m = pat.match(base2)
+                    m = _record_dir_pattern.match(base2)
                     if m is not None:
-                        self._open_record(path = subdir2,
-                                          servername = m.group(1),
-                                          record_id = m.group(2),
-                                          datestamp = m.group(3))
+                        records.append((subdir2, m))
+
+        tmpdir = self.index_dir + '.tmp'
+        if os.path.isdir(tmpdir):
+            for name in os.listdir(tmpdir):
+                _unlink(os.path.join(tmpdir, name))
+        else:
+            os.mkdir(tmpdir)
+        for (path, m) in records:
+            rec = self._open_record(path = path,
+                                    servername = m.group(1),
+                                    record_id = m.group(2),
+                                    datestamp = m.group(3))
+            if rec is not None:
+                os.symlink(os.path.relpath(path, self.index_dir),
+                           os.path.join(tmpdir, os.path.basename(path)))
+        batch = SyncBatch(self.durability)
+        batch.add_dir(tmpdir)
+        batch.commit()
+        os.rename(tmpdir, self.index_dir)
+        batch.add_dir(self.base_dir)
+        batch.commit()
+
+    def _add_index(self, rec):
+        name = os.path.basename(rec.path)
+        try:
+            os.symlink(os.path.relpath(rec.path, self.index_dir),
+                       os.path.join(self.index_dir, name))
+        except FileExistsError:
+            pass
+        self._index_modified = True
+
+    def _remove_index(self, rec):
+        _unlink(os.path.join(self.index_dir, os.path.basename(rec.path)))
+        batch = SyncBatch(self.durability)
+        batch.add_dir(self.index_dir)
+        batch.commit()
 
     def _open_record(self, path, servername, record_id, datestamp):
         rec = self.records.get((servername, record_id))
@@ -77,29 +192,44 @@ def _open_record(self, path, servername, record_id, datestamp):
                 path = path,
                 servername = servername,
                 record_id = record_id,
-                datestamp = datestamp)
+                datestamp = datestamp,
+                archive = self)
             # If the record has already been finalized, ignore it
             if not rec.finalized():
                 self.records[servername, record_id] = rec
-                # If the record had begun to be finalized, restart
+                # If the record had begun to be finalized, restart;
+                # otherwise, wait until it's needed to load it
                 if rec.finalizing():
                     self._finalize_record(rec)
+                return rec
+        return None
 
     def _finalize_record(self, rec):
         # Mark the record as finalizing - if the program is
         # interrupted and restarted, we won't write any more data to
         # this record, but restart finalization immediately
         rec.set_finalizing()
-        rec.flush(self.deterministic_output)
+        batch = SyncBatch(self.durability)
+        rec.flush(self.deterministic_output, batch, compact = True)
+        batch.commit()
 
         # Remove it from the list of active records
         self.records.pop((rec.servername, rec.record_id), None)
-
-        # Start a child process
-        proc = WorkerProcess(target = rec.finalize,
-                             name = ('finalize-%s' % rec.record_id))
-        proc.start()
-        self.finalization_processes.append((rec.record_id, proc))
+        self._loaded_records.pop((rec.servername, rec.record_id), None)
+
+        # Queue it to be finalized in a child process (the
+        # 'finalizing' flag ensures that finalization will be resumed
+        # if the program exits before this happens)
+        self.finalization_pool.submit(
+            target = self._finalize_and_remove,
+            name = ('finalize-%s' % rec.record_id),
+            args = (rec,))
+
+    def _finalize_and_remove(self, rec):
+        start = profiler.begin()
+        rec.finalize()
+        self._remove_index(rec)
+        profiler.end('finalize', start)
 
     def get_record(self, message, sync):
         servername = message.origin.servername
@@ -158,20 +288,62 @@ def get_record(self, message, sync):
                                 servername = servername,
                                 record_id = record_id,
                                 datestamp = datestamp,
-                                create = True)
+                                create = True,
+                                archive = self)
             self.records[servername, record_id] = rec
+            self._add_index(rec)
             rec.set_end_time(timestamp)
 
+        if self._latest_time is None or timestamp > self._latest_time:
+            self._latest_time = timestamp
+        self._loaded_records[servername, record_id] = rec
+        self._loaded_records.move_to_end((servername, record_id))
         return rec
 
+    def is_active(self, rec):
+        """Check whether a record is still receiving data."""
+        return self.records.get((rec.servername, rec.record_id)) is rec
+
+    def _record_loaded(self, rec):
+        # Called when an active record is loaded (or reloaded after
+        # being unloaded), so that it will be unloaded again when idle
+        if self.is_active(rec):
+            key = (rec.servername, rec.record_id)
+            if key not in self._loaded_records:
+                self._loaded_records[key] = rec
+
     def flush(self):
+        # Write all records, then sync them all at once
+        batch = SyncBatch(self.durability)
         for rec in self.records.values():
-            rec.flush(self.deterministic_output)
-        while self.finalization_processes:
-            (record_id, proc) = self.finalization_processes.pop()
-            proc.join()
-            if proc.exitcode != 0:
-                raise Exception('Failed to finalize record %s' % record_id)
+            rec.flush(self.deterministic_output, batch)
+        if self._index_modified:
+            batch.add_dir(self.index_dir)
+            self._index_modified = False
+        batch.commit()
+        self._unload_records()
+        self.finalization_pool.poll()
+
+    def _unload_records(self):
+        nfiles = sum(rec.open_files() for rec in self._loaded_records.values())
+        for (k, rec) in list(self._loaded_records.items()):
+            if not rec.loaded:
+                del self._loaded_records[k]
+                continue
+            if rec.modified:
+                continue
+            end = rec.end_time()
+            if (nfiles > self.max_open_files
+                    or (end is not None and self._latest_time is not None
+                        and (delta_ms(self._latest_time, end)
+                             > self.idle_interval))):
+                nfiles -= rec.open_files()
+                rec.unload()
+                del self._loaded_records[k]
+
+    def wait_finalized(self):
+        """Wait for all pending records to be finalized."""
+        self.finalization_pool.wait()
 
     def terminate(self):
         while self.records:
@@ -180,41 +352,125 @@ def terminate(self):
             self._finalize_record(rec)
 
 class ArchiveRecord:
-    def __init__(self, path, servername, record_id, datestamp, create = False):
+    """
+    Output record directory.
+
+    The record's properties and time map are loaded from disk when
+    they are first needed.  unload() saves memory and file
+    descriptors by closing the record's files and discarding its
+    state; it will be loaded again, transparently, when it is next
+    used.
+    """
+
+    def __init__(self, path, servername, record_id, datestamp, create = False,
+                 archive = None):
         self.path = path
+        self.archive = archive
         self.servername = servername
         self.record_id = record_id
         self.datestamp = datestamp
         self.files = {}
         if create:
             os.makedirs(self.path, exist_ok = True)
+        self.loaded = False
+        self.modified = False
 
+    def _load(self):
+        self.loaded = True
         self.properties = self._read_state_file('_phi_properties')
-        self.time_map = TimeMap(record_id)
-        self.time_map.read(path, '_phi_time_map')
+        self.time_map = TimeMap(self.record_id)
+        self.time_map.read(self.path, '_phi_time_map')
+        self._changed_properties = {}
+        self._journal = None
+        self._read_journal()
         self._base_seqnum = self.get_int_property(['base_sequence_number'])
         self._end_time = self.get_timestamp_property(['end_time'])
-        self.modified = False
+        if self.archive is not None:
+            self.archive._record_loaded(self)
+
+    def unload(self):
+        """
+        Close the record's files and discard its state.
+
+        The record must be flushed first.
+        """
+        if self.modified:
+            raise Exception('%s has not been flushed' % self.record_id)
+        for f in self.files.values():
+            f.close(fsync = False)
+        self.files = {}
+        if self.loaded:
+            if self._journal is not None:
+                self._journal.close()
+            del (self.properties, self.time_map, self._changed_properties,
+                 self._journal, self._base_seqnum, self._end_time)
+            self.loaded = False
+
+    def open_files(self):
+        """Count the number of files currently open."""
+        n = len(self.files)
+        if self.loaded and self._journal is not None:
+            n += 1
+        return n
 
     def seqnum0(self):
+        if not self.loaded:
+            self._load()
         return self._base_seqnum
 
     def set_seqnum0(self, seqnum):
+        if not self.loaded:
+            self._load()
         self._base_seqnum = seqnum
         self.modified = True
 
     def end_time(self):
+        if not self.loaded:
+            self._load()
         return self._end_time
 
     def set_end_time(self, time):
+        if not self.loaded:
+            self._load()
         self._end_time = time
         self.modified = True
 
     def finalized(self):
-        return (self.get_int_property(['finalized']) == 1)
+        return (self._finalized_state() == 1)
 
     def finalizing(self):
-        return (self.get_int_property(['finalized']) == 0)
+        return (self._finalized_state() == 0)
+
+    def _finalized_state(self):
+        if self.loaded:
+            return self.get_int_property(['finalized'])
+
+        # Avoid loading the record (in particular, reading the time
+        # map) just to check this one property: read the properties
+        # file, and any later changes to the property in the journal
+        props = self._read_state_file('_phi_properties')
+        if isinstance(props, dict):
+            value = props.get('finalized')
+        else:
+            value = None
+        try:
+            with open(os.path.join(self.path, '_phi_journal'), 'rb') as fp:
+                for line in fp:
+                    if b'"finalized"' not in line or not line.endswith(b'\n'):
+                        continue
+                    try:
+                        entry = json.loads(line.decode('UTF-8'))
+                        if entry.get('p') == ['finalized']:
+                            value = entry['v']
+                    except (UnicodeError, ValueError, KeyError,
+                            TypeError, AttributeError):
+                        pass
+        except FileNotFoundError:
+            pass
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
 
     def set_finalizing(self):
         for f in self.files.values():
@@ -234,18 +490,105 @@ def finalize(self):
             f.close()
         self.files = {}
         self.set_property(['finalized'], 1)
-        self.flush(True)
-
-    def flush(self, deterministic = False):
+        self.flush(True, compact = True)
+
+    def flush(self, deterministic = False, batch = None, compact = False):
+        """
+        Save the record's contents to disk.
+
+        If batch is a SyncBatch, the changes are written, but not
+        necessarily saved to durable storage until the batch is
+        committed.  Otherwise, they are synced immediately.
+
+        Changes to the record's properties and time map are normally
+        appended to the journal file; if compact is true, or the
+        journal is getting large, the properties and time map files
+        are rewritten instead.
+        """
+        if batch is None:
+            b = SyncBatch()
+        else:
+            b = batch
         for f in self.files.values():
-            f.flush()
+            f.flush(fsync = False)
+            b.add_file(f.fileno())
         if self.modified:
             self.set_property(['base_sequence_number'], self._base_seqnum)
             self.set_property(['end_time'], str(self._end_time))
-            self.time_map.write(self.path, '_phi_time_map')
-            self._write_state_file('_phi_properties', self.properties,
-                                   deterministic = deterministic)
-            self.dir_sync()
+            self._write_journal(deterministic, b)
+            if compact or self._journal.tell() > _journal_max_size:
+                self.time_map.write(self.path, '_phi_time_map', b)
+                self._write_state_file('_phi_properties', self.properties,
+                                       deterministic = deterministic,
+                                       batch = b)
+                b.add_dir(self.path)
+                b.add_callback(self._remove_journal)
+            self.modified = False
+        if batch is None:
+            b.commit()
+
+    # The journal is a sequence of JSON objects, one per line:
+    #
+    #   {"p": PATH, "v": VALUE}  - set_property(PATH, VALUE)
+    #   {"t": SPANS}             - time_map.replace_spans(SPANS)
+    #
+    # Applying the journal to the saved properties and time map
+    # brings them up to date.  Applying the same entries more than
+    # once has no further effect, so the journal can be discarded
+    # any time after the properties and time map have been
+    # rewritten.
+
+    def _read_journal(self):
+        fname = os.path.join(self.path, '_phi_journal')
+        try:
+            fp = open(fname, 'r+b')
+        except FileNotFoundError:
+            return
+        with fp:
+            end = 0
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # incomplete entry - discard it
+                    fp.truncate(end)
+                    break
+                end += len(line)
+                try:
+                    entry = json.loads(line.decode('UTF-8'))
+                    if 'p' in entry:
+                        self._set_property(entry['p'], entry['v'])
+                    if 't' in entry:
+                        self.time_map.replace_spans(entry['t'])
+                except (UnicodeError, ValueError, KeyError, TypeError):
+                    logging.warning('invalid journal entry in %s' % fname)
+
+    def _write_journal(self, deterministic, batch):
+        lines = []
+        for (path, value) in self._changed_properties.items():
+            lines.append(json.dumps({'p': list(path), 'v': value},
+                                    sort_keys = deterministic))
+        self._changed_properties = {}
+        spans = self.time_map.take_changes()
+        if spans:
+            lines.append(json.dumps({'t': spans}))
+        if not lines:
+            return
+
+        if self._journal is None:
+            fname = os.path.join(self.path, '_phi_journal')
+            self._journal = open(fname, 'ab')
+            batch.add_dir(self.path)
+        self._journal.write(('\n'.join(lines) + '\n').encode('UTF-8'))
+        self._journal.flush()
+        batch.add_file(self._journal.fileno())
+
+    def _remove_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        try:
+            os.unlink(os.path.join(self.path, '_phi_journal'))
+        except FileNotFoundError:
+            pass
 
     def dir_sync(self):
         d = os.open(self.path, os.O_RDONLY|os.O_DIRECTORY)
@@ -262,23 +605,41 @@ def _read_state_file(self, name):
         except (FileNotFoundError, UnicodeError, ValueError):
             return None
 
-    def _write_state_file(self, name, content, deterministic = False):
+    def _write_state_file(self, name, content, deterministic = False,
+                          batch = None):
         fname = os.path.join(self.path, name)
         tmpfname = os.path.join(self.path, '_' + name + '.tmp')
         with open(tmpfname, 'wt', encoding = 'UTF-8') as f:
             json.dump(content, f, sort_keys = deterministic)
             f.write('\n')
             f.flush()
-            os.fdatasync(f.fileno())
-        os.rename(tmpfname, fname)
+            if batch is None:
+                os.fdatasync(f.fileno())
+        if batch is None:
+            os.rename(tmpfname, fname)
+        else:
+            batch.add_rename(tmpfname, fname)
 
     def get_property(self, path):
+        if not self.loaded:
+            self._load()
         v = self.properties
         for k in path:
             v = v[k]
         return v
 
     def set_property(self, path, value):
+        self._set_property(path, value)
+        # remove and re-insert, so that the journal entries are
+        # written in the correct order
+        path = tuple(path)
+        self._changed_properties.pop(path, None)
+        self._changed_properties[path] = value
+        self.modified = True
+
+    def _set_property(self, path, value):
+        if not self.loaded:
+            self._load()
         if not isinstance(self.properties, dict):
             self.properties = {}
         v = self.properties
@@ -287,9 +648,10 @@ def set_property(self, path, value):
                 v[k] = {}
             v = v[k]
         v[path[-1]] = value
-        self.modified = True
 
     def set_time(self, seqnum, time):
+        if not self.loaded:
+            self._load()
         self.time_map.set_time(seqnum, time)
         self.modified = True
 
@@ -332,6 +694,8 @@ def close_file(self, name):
 
     # XXX
     def _finalize_events(self):
+        if not self.loaded:
+            self._load()
         nfn = os.path.join(self.path, '_phi_numerics')
         efn = os.path.join(self.path, '_phi_enums')
         afn = os.path.join(self.path, '_phi_alerts')
@@ -340,53 +704,37 @@ def _finalize_events(self):
              ArchiveLogReader(efn, allow_missing = True) as el, \
              ArchiveLogReader(afn, allow_missing = True) as al:
 
+            # Read all event times, and use them to refine the time
+            # map.  (This pass is also needed in order for
+            # sorted_items() to locate the sorted subsequences of
+            # each file.)  The files are mostly sorted, so the times
+            # are passed to add_times() in short ascending runs,
+            # rather than collecting and sorting them all at once.
             for l in (nl, el, al):
-                for (sn, ts, line) in l.unsorted_items():
-                    ts = datetime.strptime(str(ts), '%Y%m%d%H%M%S%f')
-                    ts = ts.replace(tzinfo = timezone.utc)
-                    self.time_map.add_time(ts)
+                times = (log_time_us(ts) for (_, ts, _)
+                         in l.unsorted_items())
+                for run in _ascending_runs(times, 4096):
+                    self.time_map.add_times(run)
             self.time_map.resolve_gaps()
 
             sn0 = self.seqnum0()
-
-            if not nl.missing():
-                nf = self.open_log_file('numerics')
-                for (sn, ts, line) in nl.sorted_items():
-                    if b'\030' in line:
-                        continue
-                    ts = datetime.strptime(str(ts), '%Y%m%d%H%M%S%f')
-                    ts = ts.replace(tzinfo = timezone.utc)
-                    sn = self.time_map.get_seqnum(ts) or sn
-                    if sn0 is None:
-                        sn0 = sn
-                    nf.fp.write(('%s\t' % (sn - sn0)).encode()) # XXX
-                    nf.fp.write(line.strip())                   # XXX
-                    nf.fp.write(b'\n')                          # XXX
-
-            if not el.missing():
-                ef = self.open_log_file('enums')
-                for (sn, ts, line) in el.sorted_items():
-                    if b'\030' in line:
-                        continue
-                    ts = datetime.strptime(str(ts), '%Y%m%d%H%M%S%f')
-                    ts = ts.replace(tzinfo = timezone.utc)
-                    sn = self.time_map.get_seqnum(ts) or sn
-                    if sn0 is None:
-                        sn0 = sn
-                    ef.fp.write(('%s\t' % (sn - sn0)).encode()) # XXX
-                    ef.fp.write(line.strip())                   # XXX
-                    ef.fp.write(b'\n')                          # XXX
-
-            if not al.missing():
-                af = self.open_log_file('alerts')
-                for (sn, ts, line) in al.sorted_items():
-                    if b'\030' in line:
-                        continue
-                    ts = datetime.strptime(str(ts), '%Y%m%d%H%M%S%f')
-                    ts = ts.replace(tzinfo = timezone.utc)
-                    sn = self.time_map.get_seqnum(ts) or sn
-                    if sn0 is None:
-                        sn0 = sn
-                    af.fp.write(('%s\t' % (sn - sn0)).encode()) # XXX
-                    af.fp.write(line.strip())                   # XXX
-                    af.fp.write(b'\n')                          # XXX
+            for (l, name) in ((nl, 'numerics'), (el, 'enums'),
+                              (al, 'alerts')):
+                if not l.missing():
+                    sn0 = self._write_sorted_events(l, name, sn0)
+
+    def _write_sorted_events(self, reader, name, sn0):
+        f = self.open_log_file(name)
+        for chunk in _chunks(reader.sorted_items(), 4096):
+            chunk = [i for i in chunk if b'\030' not in i[2]]
+            seqnums = self.time_map.get_seqnums(
+                [log_time_us(ts) for (_, ts, _) in chunk])
+            lines = []
+            for ((sn, ts, line), tsn) in zip(chunk, seqnums):
+                sn = tsn or sn
+                if sn0 is None:
+                    sn0 = sn
+                lines.append('%s\t%s' % (sn - sn0,
+                                          line.strip().decode('UTF-8')))
+            f.append_many(lines)
+        return sn0
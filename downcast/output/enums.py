@@ -53,10 +53,11 @@ def send_message(self, chn, msg, source, ttl):
         sn = msg.sequence_number
         ts = msg.timestamp
         (old_sn, old_ts) = self.last_event.get(record, (None, None))
+        lines = []
         if sn != old_sn:
-            logfile.append('S%s' % sn)
+            lines.append('S%s' % sn)
         if ts != old_ts:
-            logfile.append(ts.strftime_utc('%Y%m%d%H%M%S%f'))
+            lines.append(ts.strftime_utc('%Y%m%d%H%M%S%f'))
         self.last_event[record] = (sn, ts)
 
         # Write value to the log file
@@ -66,7 +67,8 @@ def send_message(self, chn, msg, source, ttl):
             val = ''
         else:
             val = val.translate(_del_control)
-        logfile.append('%s\t%d\t%s' % (attr.label, attr.value_physio_id, val))
+        lines.append('%s\t%d\t%s' % (attr.label, attr.value_physio_id, val))
+        logfile.append_many(lines)
         source.ack_message(chn, msg, self)
 
     def flush(self):
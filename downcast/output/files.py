@@ -20,6 +20,15 @@
 import errno
 import mmap
 
+_madv_sequential = getattr(mmap, 'MADV_SEQUENTIAL', None)
+
+def _utf8_len(text):
+    # Length of text when encoded as UTF-8 (str.isascii() is cheap,
+    # so most messages don't need to be encoded twice)
+    if text.isascii():
+        return len(text)
+    return len(text.encode('UTF-8'))
+
 class ArchiveLogFile:
     """Append-only text log output file.
 
@@ -29,12 +38,21 @@ class ArchiveLogFile:
     When the file is opened, if it ends with an incomplete message
     (i.e., the program writing the file crashed or ran out of space),
     a special marker is appended to indicate that the line is invalid.
+
+    Messages are buffered in memory, and written to the file in large
+    chunks; they are not guaranteed to be written until flush() is
+    called.
     """
 
+    # Number of bytes to buffer before writing to the file
+    buffer_size = 65536
+
     def __init__(self, filename):
         # Open file
-        self.fp = open(filename, 'a+b')
+        self.fp = open(filename, 'a+b', buffering = 0)
         self.fsync_before_close = False
+        self._buffer = []
+        self._buffered = 0
 
         # Check if file ends with \n; if not, append a marker to
         # indicate the last line is invalid
@@ -54,12 +72,41 @@ def append(self, msg):
 
         A line feed is appended automatically.
         """
-        self.fp.write(msg.encode('UTF-8'))
-        self.fp.write(b'\n')
+        self._buffer.append(msg)
+        self._buffered += _utf8_len(msg) + 1
+        if self._buffered >= self.buffer_size:
+            self._write_buffer()
+
+    def append_many(self, msgs):
+        """Write a sequence of messages to the end of the file.
+
+        A line feed is appended to each message automatically.
+        """
+        n = len(self._buffer)
+        self._buffer.extend(msgs)
+        for msg in self._buffer[n:]:
+            self._buffered += _utf8_len(msg) + 1
+        if self._buffered >= self.buffer_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffer:
+            self._buffer.append('')
+            data = '\n'.join(self._buffer).encode('UTF-8')
+            self._buffer = []
+            self._buffered = 0
+            # a raw file object might perform a partial write
+            view = memoryview(data)
+            while view:
+                view = view[self.fp.write(view):]
+
+    def fileno(self):
+        """Get the underlying file descriptor."""
+        return self.fp.fileno()
 
     def flush(self, fsync = True):
         """Ensure that previous messages are saved to disk."""
-        self.fp.flush()
+        self._write_buffer()
         if fsync:
             os.fdatasync(self.fp.fileno())
 
@@ -84,9 +131,19 @@ class ArchiveBinaryFile:
 
     For efficiency, the file on disk will be resized in units of
     mmap.PAGESIZE (or more) at a time; the file will be truncated to
-    its "real" size when flush or close is called.
+    its "real" size when close is called.  (Space allocated in advance
+    is kept when the file is flushed, so that it isn't repeatedly
+    freed and reallocated.)
+
+    Both the file and the mapped window grow geometrically as data is
+    written, so that a file written from start to end is remapped only
+    a few times.
     """
 
+    # Largest window to map, and largest amount by which to extend
+    # the file, at a time
+    max_window_size = 64 * 1024 * 1024
+
     def __init__(self, filename, window_size = None):
         # Open the file R/W and create if missing, never truncate
         self.fd = os.open(filename, os.O_RDWR|os.O_CREAT, 0o666)
@@ -104,18 +161,42 @@ def __init__(self, filename, window_size = None):
         self.map_buffer = None
 
     def _map_range(self, start, end):
-        if end < self.map_start or start >= self.map_end:
-            start -= start % mmap.PAGESIZE
-            if end < start + self.window_size:
-                end = start + self.window_size
-            else:
-                end += mmap.PAGESIZE - (end % mmap.PAGESIZE)
-            if end > self.current_size:
-                os.ftruncate(self.fd, end)
-                self.current_size = end
-            self.map_buffer = mmap.mmap(self.fd, end - start, offset = start)
-            self.map_start = start
-            self.map_end = end
+        if start >= self.map_start and end <= self.map_end:
+            return
+
+        # Grow the window each time we need to remap
+        if self.map_buffer is not None:
+            self.map_buffer.close()
+            self.map_buffer = None
+            if self.window_size < self.max_window_size:
+                self.window_size *= 2
+
+        start -= start % mmap.ALLOCATIONGRANULARITY
+        if end < start + self.window_size:
+            end = start + self.window_size
+        else:
+            end += (-end) % mmap.PAGESIZE
+        if end > self.current_size:
+            self._extend(end)
+        self.map_buffer = mmap.mmap(self.fd, end - start, offset = start)
+        if _madv_sequential is not None:
+            self.map_buffer.madvise(_madv_sequential)
+        self.map_start = start
+        self.map_end = end
+
+    def _extend(self, size):
+        # Grow the file by at least a factor of two (up to
+        # max_window_size at a time), and allocate disk space in
+        # advance if possible
+        step = min(self.current_size, self.max_window_size)
+        size = max(size, self.current_size + step)
+        size += (-size) % mmap.PAGESIZE
+        try:
+            os.posix_fallocate(self.fd, self.current_size,
+                               size - self.current_size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, size)
+        self.current_size = size
 
     def size(self):
         """Get the size of the file."""
@@ -143,15 +224,19 @@ def write(self, pos, data, mask = None):
                 self.map_buffer[i + j] = ((self.map_buffer[i + j] & ~mask[j])
                                           | (data[j] & mask[j]))
 
-    def flush(self, fsync = True):
-        """Ensure that the file contents are saved to disk."""
+    def fileno(self):
+        """Get the underlying file descriptor."""
+        return self.fd
+
+    def _unmap(self):
         self.map_start = self.map_end = 0
         if self.map_buffer is not None:
             self.map_buffer.close()
             self.map_buffer = None
-        if self.real_size != self.current_size:
-            os.ftruncate(self.fd, self.real_size)
-            self.current_size = self.real_size
+
+    def flush(self, fsync = True):
+        """Ensure that the file contents are saved to disk."""
+        self._unmap()
         if fsync:
             os.fdatasync(self.fd)
 
@@ -164,6 +249,10 @@ def close(self, fsync = True):
             if not fsync or self.fsync_before_close:
                 return
 
+        self._unmap()
+        if self.real_size != self.current_size:
+            os.ftruncate(self.fd, self.real_size)
+            self.current_size = self.real_size
         self.flush(fsync = fsync)
         os.close(self.fd)
         self.fd = None
@@ -17,6 +17,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import heapq
+from datetime import date
+
+_epoch_ordinal = date(1970, 1, 1).toordinal()
+
+# Recently converted timestamps, indexed by UTC second
+_seconds = {}
+_seconds_max = 65536
+
+def log_time_us(ts):
+    """
+    Convert a log file timestamp to microseconds since the epoch.
+
+    ts is an integer whose decimal digits give the UTC year, month,
+    day, hour, minute, second, and microsecond, as stored in the log
+    files (see ArchiveLogReader.)
+    """
+    (s, us) = divmod(ts, 1000000)
+    base = _seconds.get(s)
+    if base is None:
+        (ymd, hms) = divmod(s, 1000000)
+        (year, md) = divmod(ymd, 10000)
+        (month, day) = divmod(md, 100)
+        (hour, ms) = divmod(hms, 10000)
+        (minute, second) = divmod(ms, 100)
+        if hour > 23 or minute > 59 or second > 59:
+            raise ValueError('invalid timestamp %d' % ts)
+        days = date(year, month, day).toordinal() - _epoch_ordinal
+        base = ((days * 24 + hour) * 60 + minute) * 60 + second
+        base *= 1000000
+        if len(_seconds) >= _seconds_max:
+            _seconds.clear()
+        _seconds[s] = base
+    return base + us
 
 class ArchiveLogReader:
     """Class for reading log entries from a mostly-sorted input file.
@@ -53,10 +53,11 @@ def send_message(self, chn, msg, source, ttl):
         sn = msg.sequence_number
         ts = msg.timestamp
         (old_sn, old_ts) = self.last_event.get(record, (None, None))
+        lines = []
         if sn != old_sn:
-            logfile.append('S%s' % sn)
+            lines.append('S%s' % sn)
         if ts != old_ts:
-            logfile.append(ts.strftime_utc('%Y%m%d%H%M%S%f'))
+            lines.append(ts.strftime_utc('%Y%m%d%H%M%S%f'))
         self.last_event[record] = (sn, ts)
 
         # Write the value to the log file
@@ -64,7 +65,8 @@ def send_message(self, chn, msg, source, ttl):
         val = msg.value
         if val is None:
             val = ''
-        logfile.append('%s\t%s' % (lbl, val))
+        lines.append('%s\t%s' % (lbl, val))
+        logfile.append_many(lines)
         source.ack_message(chn, msg, self)
 
     def flush(self):
@@ -18,8 +18,13 @@
 
 import os
 import sys
+import logging
 import cProfile
+from collections import deque
 from multiprocessing import Process
+from multiprocessing.util import Finalize
+
+from .. import profiler
 
 class WorkerProcess(Process):
     def __init__(self, name = None, keep_files = None, **kwargs):
@@ -30,21 +35,16 @@ def __init__(self, name = None, keep_files = None, **kwargs):
 
     def run(self):
         # Close all files except those listed in keep_files
-        fds = []
-        for name in os.listdir('/dev/fd'):
-            try:
-                fds.append(int(name))
-            except ValueError:
-                pass
-
-        for fd in fds:
-            if fd not in self.keep_fds:
-                try:
-                    os.close(fd)
-                except OSError:
-                    pass
+        fd = 0
+        for keep in sorted(self.keep_fds):
+            # (note that closerange(n, n) is not reliably a no-op)
+            if fd < keep:
+                os.closerange(fd, keep)
+            fd = keep + 1
+        os.closerange(fd, os.sysconf('SC_OPEN_MAX'))
 
         # Invoke the target function, with profiling if enabled
+        profiler.child_process(self.name, separate_file = False)
         pf = os.environ.get('DOWNCAST_PROFILE_OUT', None)
         name = self.name
         if pf is not None and name is not None:
@@ -52,3 +52,97 @@ def run(self):
             cProfile.runctx('Process.run(self)', globals(), locals(), pf)
         else:
             Process.run(self)
+        profiler.dump()
+
+class WorkerPool:
+    """
+    Object that runs jobs in worker processes, a few at a time.
+
+    Each job is a function that is invoked in a new WorkerProcess.
+    At most max_workers jobs run at once; additional jobs wait in a
+    queue until poll() finds that an earlier job has finished.  Any
+    jobs that are still queued or running when the program exits
+    are completed before exiting.
+
+    Jobs belong to the process that submitted them.  If this object
+    is copied into a child process (by fork), the child ignores the
+    parent's jobs.
+    """
+
+    def __init__(self, max_workers = 2):
+        self.max_workers = max_workers
+        self._queue = deque()
+        self._running = []
+        self._exit_pid = None
+
+    def submit(self, target, name, args = ()):
+        """Add a job to the queue, and start it if possible."""
+        pid = os.getpid()
+        if self._exit_pid != pid:
+            # Finalizers are not inherited by child processes, so
+            # register one for each process that submits jobs
+            Finalize(self, self._wait_at_exit, exitpriority = 10)
+            self._exit_pid = pid
+        self._queue.append((pid, target, name, args))
+        self.poll()
+
+    def poll(self):
+        """
+        Check for finished jobs, and start queued jobs.
+
+        This does not wait for any job to finish.  If a job has
+        failed, an exception is raised.
+        """
+        pid = os.getpid()
+        failed = []
+        for job in list(self._running):
+            (jpid, proc) = job
+            if jpid == pid and proc.exitcode is not None:
+                proc.join()
+                self._running.remove(job)
+                if proc.exitcode != 0:
+                    failed.append(proc.name)
+
+        nrunning = sum(1 for (jpid, _) in self._running if jpid == pid)
+        for job in list(self._queue):
+            if nrunning >= self.max_workers:
+                break
+            (jpid, target, name, args) = job
+            if jpid == pid:
+                self._queue.remove(job)
+                proc = WorkerProcess(target = target, name = name,
+                                     args = args)
+                proc.start()
+                self._running.append((pid, proc))
+                nrunning += 1
+
+        if failed:
+            raise Exception('Failed to run %s' % ', '.join(failed))
+
+    def pending(self):
+        """Count the jobs that are queued or running."""
+        pid = os.getpid()
+        return (sum(1 for job in self._queue if job[0] == pid)
+                + sum(1 for job in self._running if job[0] == pid))
+
+    def wait(self):
+        """Wait for all queued and running jobs to finish."""
+        pid = os.getpid()
+        failed = []
+        while self.pending():
+            for (jpid, proc) in self._running:
+                if jpid == pid:
+                    proc.join()
+            try:
+                self.poll()
+            except Exception as e:
+                failed.append(str(e))
+        if failed:
+            raise Exception('; '.join(failed))
+
+    def _wait_at_exit(self):
+        if self._exit_pid == os.getpid():
+            try:
+                self.wait()
+            except Exception as e:
+                logging.error(str(e))
@@ -0,0 +1,167 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+
+# Methods for writing files to durable storage:
+#
+#  - 'fdatasync': call fdatasync() on each file in turn.
+#
+#  - 'parallel': call fdatasync() on many files at once, using a
+#    pool of threads.
+#
+#  - 'syncfs': call syncfs() once for the entire filesystem.  This
+#    also writes out any other pending changes on the same
+#    filesystem, which may or may not be cheaper than syncing files
+#    individually.  All files in a batch must be on the same
+#    filesystem.
+#
+#  - 'none': don't sync anything.  Output files will be corrupted if
+#    the system crashes.  Only useful for testing.
+durability_policies = ('fdatasync', 'parallel', 'syncfs', 'none')
+
+_sync_threads = 8
+_executor = None
+_executor_pid = None
+
+def _get_executor():
+    global _executor, _executor_pid
+    # Threads are not inherited by child processes, so each process
+    # needs its own pool
+    if _executor_pid != os.getpid():
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(_sync_threads)
+        _executor_pid = os.getpid()
+    return _executor
+
+_syncfs = None
+def _get_syncfs():
+    global _syncfs
+    if _syncfs is None:
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno = True)
+            f = libc.syncfs
+            def syncfs(fd):
+                if f(fd) != 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, os.strerror(e))
+            _syncfs = syncfs
+        except (ImportError, OSError, AttributeError):
+            logging.warning('syncfs is not available; using fdatasync')
+            _syncfs = False
+    return _syncfs
+
+def _fdatasync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+class SyncBatch:
+    """
+    Set of files that must be written to durable storage together.
+
+    Rather than syncing each output file as soon as it is written,
+    add_file(), add_rename(), and add_dir() record what needs to be
+    done; commit() then syncs everything, using the given policy
+    (see durability_policies.)
+
+    The steps are carried out in the order needed to ensure that
+    every file is complete when it appears under its final name:
+    first the contents of all files are synced, then all temporary
+    files are renamed, then all directories are synced.  Finally,
+    any functions added by add_callback() are called.
+    """
+
+    def __init__(self, policy = 'fdatasync'):
+        if policy not in durability_policies:
+            raise ValueError('unknown durability policy %r' % policy)
+        self.policy = policy
+        self._fds = []
+        self._paths = []
+        self._renames = []
+        self._dirs = {}
+        self._callbacks = []
+
+    def add_file(self, fd):
+        """Add an open file descriptor whose contents must be synced."""
+        self._fds.append(fd)
+
+    def add_rename(self, tmpname, name):
+        """Sync a temporary file, then rename it to its final name."""
+        self._paths.append(tmpname)
+        self._renames.append((tmpname, name))
+
+    def add_dir(self, path):
+        """Add a directory whose contents must be synced."""
+        self._dirs[path] = True
+
+    def add_callback(self, func):
+        """Add a function to be called after everything is synced."""
+        self._callbacks.append(func)
+
+    def commit(self):
+        """Carry out all pending operations."""
+        self._sync(self._fds, self._paths)
+        for (tmpname, name) in self._renames:
+            os.rename(tmpname, name)
+        self._sync([], list(self._dirs))
+        callbacks = self._callbacks
+        self._fds = []
+        self._paths = []
+        self._renames = []
+        self._dirs = {}
+        self._callbacks = []
+        for func in callbacks:
+            func()
+
+    def _sync(self, fds, paths):
+        if not fds and not paths:
+            return
+        policy = self.policy
+        if policy == 'none':
+            return
+
+        if policy == 'syncfs':
+            syncfs = _get_syncfs()
+            if syncfs:
+                if fds:
+                    syncfs(fds[0])
+                else:
+                    fd = os.open(paths[0], os.O_RDONLY)
+                    try:
+                        syncfs(fd)
+                    finally:
+                        os.close(fd)
+                return
+            policy = 'fdatasync'
+
+        if policy == 'parallel' and len(fds) + len(paths) > 1:
+            ex = _get_executor()
+            jobs = ([ex.submit(os.fdatasync, fd) for fd in fds]
+                    + [ex.submit(_fdatasync_path, p) for p in paths])
+            for j in jobs:
+                j.result()
+        else:
+            for fd in fds:
+                os.fdatasync(fd)
+            for p in paths:
+                _fdatasync_path(p)
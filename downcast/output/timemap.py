@@ -22,7 +22,7 @@
 import logging
 from datetime import timedelta
 
-from ..timestamp import T, delta_ms
+from ..timestamp import T, to_us, from_us
 
 class TimeMap:
     """
@@ -42,11 +42,20 @@ class TimeMap:
     between sequence number and timestamp, so that given an arbitrary
     timestamp, it is possible to determine the most likely sequence
     number at which that timestamp would have been generated.
+
+    Each entry in the map is a list [start, end, baset, times, base]:
+    start and end are the first and last sequence numbers of a span
+    during which the wall clock was not adjusted, baset is the
+    wall-clock time (T) at sequence number zero, times is the set of
+    non-reference times (integer microseconds) that are known to
+    precede the span, and base is baset in integer microseconds.
     """
 
     def __init__(self, record_id):
         self.entries = []
         self.record_id = record_id
+        self._span_ends = None
+        self._changed = {}
 
     def read(self, path, name):
         """Read a time map file."""
@@ -57,13 +66,20 @@ def read(self, path, name):
                     start = int(row[0])
                     end = int(row[1])
                     baset = T(row[2])
-                    self.entries.append([start, end, baset, set()])
+                    self.entries.append([start, end, baset, set(),
+                                         to_us(baset)])
         except FileNotFoundError:
             pass
         self.entries.sort()
+        self._span_ends = None
+
+    def write(self, path, name, batch = None):
+        """
+        Write a time map file.
 
-    def write(self, path, name):
-        """Write a time map file."""
+        If batch is a SyncBatch, the new file is not synced or
+        renamed into place until the batch is committed.
+        """
         fname = os.path.join(path, name)
         tmpfname = os.path.join(path, '_' + name + '.tmp')
         with open(tmpfname, 'wt', encoding = 'UTF-8') as f:
@@ -71,8 +87,12 @@ def write(self, path, name):
             for e in self.entries:
                 w.writerow(e[0:3])
             f.flush()
-            os.fdatasync(f.fileno())
-        os.rename(tmpfname, fname)
+            if batch is None:
+                os.fdatasync(f.fileno())
+        if batch is None:
+            os.rename(tmpfname, fname)
+        else:
+            batch.add_rename(tmpfname, fname)
 
     def set_time(self, seqnum, time):
         """
@@ -89,7 +109,8 @@ def set_time(self, seqnum, time):
         This information is treated as trustworthy and will be saved
         to the time map file when write() is called.
         """
-        baset = time - timedelta(milliseconds = seqnum)
+        base = to_us(time) - seqnum * 1000
+        self._span_ends = None
 
         # i = index of the first span that begins at or after seqnum
         i = bisect.bisect_right(self.entries, [seqnum])
@@ -99,11 +120,11 @@ def set_time(self, seqnum, time):
         # If this sequence number falls within an existing span,
         # verify that baset is what we expect
         if p and seqnum <= p[0][1]:
-            if baset != p[0][2]:
+            if base != p[0][4]:
                 logging.warning('conflicting timestamps at %d in %s'
                                 % (seqnum, self.record_id))
         elif n and seqnum >= n[0][0]:
-            if baset != n[0][2]:
+            if base != n[0][4]:
                 logging.warning('conflicting timestamps at %d in %s'
                                 % (seqnum, self.record_id))
 
@@ -111,17 +132,68 @@ def set_time(self, seqnum, time):
         # an existing span that has the same baset value (close enough
         # that we assume there could not have been more than one clock
         # adjustment), then extend the existing span(s)
-        elif p and p[0][2] == baset and seqnum - p[0][1] < 30000:
+        elif p and p[0][4] == base and seqnum - p[0][1] < 30000:
             p[0][1] = seqnum
-            if n and n[0][2] == baset and n[0][0] - seqnum < 30000:
+            self._changed[id(p[0])] = p[0]
+            if n and n[0][4] == base and n[0][0] - seqnum < 30000:
                 n[0][0] = p[0][0]
                 del self.entries[i-1]
-        elif n and n[0][2] == baset and n[0][0] - seqnum < 30000:
+                self._changed[id(n[0])] = n[0]
+        elif n and n[0][4] == base and n[0][0] - seqnum < 30000:
             n[0][0] = seqnum
+            self._changed[id(n[0])] = n[0]
 
         # Otherwise, define a new span
         else:
-            self.entries.insert(i, [seqnum, seqnum, baset, set()])
+            baset = time - timedelta(milliseconds = seqnum)
+            e = [seqnum, seqnum, baset, set(), base]
+            self.entries.insert(i, e)
+            self._changed[id(e)] = e
+
+    def take_changes(self):
+        """
+        Retrieve the spans that have changed since the last call.
+
+        The result is a list of [start, end, baset] (where baset is a
+        string), which can be passed to replace_spans() to update a
+        copy of the map that was saved earlier.
+        """
+        present = {id(e) for e in self.entries}
+        changes = [[e[0], e[1], str(e[2])]
+                   for (k, e) in self._changed.items() if k in present]
+        self._changed = {}
+        return sorted(changes)
+
+    def replace_spans(self, spans):
+        """
+        Replace spans in the map.
+
+        spans is a list of [start, end, baset], as returned by
+        take_changes().  Each span replaces any existing spans that
+        overlap it.
+        """
+        for (start, end, baset) in spans:
+            baset = T(baset)
+            self.entries = [e for e in self.entries
+                            if e[1] < start or e[0] > end]
+            bisect.insort(self.entries,
+                          [start, end, baset, set(), to_us(baset)])
+        self._span_ends = None
+
+    def _span_index(self, time_us, lo = 0):
+        # Find the first span whose end is at or after the given
+        # time.  Note that spans are ordered by sequence number, not
+        # by wall-clock time, so the search uses the running maximum
+        # of the span end times.
+        if self._span_ends is None:
+            self._span_ends = []
+            m = None
+            for e in self.entries:
+                end = e[4] + e[1] * 1000
+                if m is None or end > m:
+                    m = end
+                self._span_ends.append(m)
+        return bisect.bisect_left(self._span_ends, time_us, lo)
 
     def add_time(self, time):
         """
@@ -138,14 +210,25 @@ def add_time(self, time):
         This function should be called after all reference timestamps
         have been recorded using set_time().
         """
-        for e in self.entries:
-            start = e[2] + timedelta(milliseconds = e[0])
-            if time < start:
-                e[3].add(time)
-                return
-            end = e[2] + timedelta(milliseconds = e[1])
-            if time <= end:
+        self.add_times([to_us(time)])
+
+    def add_times(self, times):
+        """
+        Add a sequence of non-reference timestamps to the map.
+
+        times must be a sequence of integers (microseconds since the
+        epoch, as returned by timestamp.to_us()) in ascending order.
+        This is equivalent to calling add_time() for each one.
+        """
+        entries = self.entries
+        i = 0
+        for t in times:
+            i = self._span_index(t, i)
+            if i >= len(entries):
                 return
+            e = entries[i]
+            if t < e[4] + e[0] * 1000:
+                e[3].add(t)
 
     def get_seqnum(self, time):
         """
@@ -153,12 +236,32 @@ def get_seqnum(self, time):
 
         If no information is available, this will return None.
         """
-        for e in self.entries[:-1]:
-            end = e[2] + timedelta(milliseconds = e[1])
-            if time <= end:
-                return delta_ms(time, e[2])
-        if self.entries:
-            return delta_ms(time, self.entries[-1][2])
+        return self.get_seqnums([to_us(time)])[0]
+
+    def get_seqnums(self, times):
+        """
+        Guess the sequence numbers corresponding to wall-clock times.
+
+        times must be a sequence of integers (microseconds since the
+        epoch, as returned by timestamp.to_us()).  This is most
+        efficient if the times are mostly in ascending order.  The
+        result is a list of sequence numbers, which are None if no
+        information is available.
+        """
+        entries = self.entries
+        if not entries:
+            return [None] * len(times)
+        last = len(entries) - 1
+        seqnums = []
+        i = 0
+        prev = None
+        for t in times:
+            if prev is None or t < prev:
+                i = 0
+            i = self._span_index(t, i)
+            prev = t
+            seqnums.append((t - entries[min(i, last)][4]) // 1000)
+        return seqnums
 
     def resolve_gaps(self):
         """
@@ -201,19 +304,19 @@ def resolve_gaps(self):
         p = None
         for n in self.entries:
             if p and n[3]:
-                gapstart = p[2] + timedelta(milliseconds = p[1])
-                gapend = n[2] + timedelta(milliseconds = n[0])
+                gapstart = p[4] + p[1] * 1000
+                gapend = n[4] + n[0] * 1000
                 n[3].add(gapstart)
                 n[3].add(gapend)
-                best = (timedelta(0), gapstart)
+                best = (0, gapstart)
                 for d in _differences(sorted(n[3])):
                     best = max(best, d)
                 tbefore = best[1]
                 tafter = best[1] + best[0]
-                snp = delta_ms(tbefore, p[2])
-                snn = delta_ms(tafter, n[2])
-                self.set_time(snp, tbefore)
-                self.set_time(snn, tafter)
+                snp = (tbefore - p[4]) // 1000
+                snn = (tafter - n[4]) // 1000
+                self.set_time(snp, from_us(tbefore, p[2].tzinfo))
+                self.set_time(snn, from_us(tafter, n[2].tzinfo))
             p = n
 
 def _differences(k):
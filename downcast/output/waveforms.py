@@ -137,18 +137,30 @@ def _write_events(self, record, msg, attr, msg_start, tps):
             # FIXME: avoid using desc in filename
             (_, desc) = _get_signal_units_desc(attr)
             logfile = record.open_log_file('_wq_%s' % desc)
+            lines = []
             for pp in _parse_sample_list(msg.paced_pulses):
-                logfile.append('P%s' % (msg_start + pp * tps))
+                lines.append('P%s' % (msg_start + pp * tps))
             for (is0, is1) in _parse_interval_list(msg.invalid_samples):
-                logfile.append('I%s-%s' % (msg_start + is0 * tps,
-                                           msg_start + (is1 + 1) * tps))
+                lines.append('I%s-%s' % (msg_start + is0 * tps,
+                                         msg_start + (is1 + 1) * tps))
             for (us0, us1) in _parse_interval_list(msg.unavailable_samples):
-                logfile.append('U%s-%s' % (msg_start + us0 * tps,
-                                           msg_start + (us1 + 1) * tps))
+                lines.append('U%s-%s' % (msg_start + us0 * tps,
+                                         msg_start + (us1 + 1) * tps))
+            logfile.append_many(lines)
 
     def flush(self):
-        for (record, info) in self.info.items():
-            info.flush_signals(record)
+        for (record, info) in list(self.info.items()):
+            if not self.archive.is_active(record):
+                # Record has been finalized
+                del self.info[record]
+            elif not record.loaded:
+                # Record was unloaded by the previous flush, and its
+                # state has already been saved; don't load it again
+                # until more data arrives
+                if not info.signal_buffer.signals:
+                    del self.info[record]
+            else:
+                info.flush_signals(record)
         self.archive.flush()
 
     def finalize_record(record):
@@ -329,6 +341,15 @@ def __init__(self, record):
                 logging.exception('unable to resume signal output')
             self.close_segment(record)
 
+        # signal_file_size: size of the signal file when it was last
+        # flushed.  The file may have been left with extra space
+        # allocated at the end (see ArchiveBinaryFile); discard it.
+        if self.signal_file is not None:
+            size = record.get_int_property(['waves', 'signal_file_size'])
+            if size is not None:
+                sf = record.open_bin_file(self.signal_file)
+                sf.truncate(size)
+
     def close_segment(self, record):
         if self.signal_file is not None:
             record.close_file(self.signal_file)
@@ -345,6 +366,7 @@ def close_segment(self, record):
         self.frame_size = None
         record.set_property(['waves', 'signals'], [])
         record.set_property(['waves', 'signal_file'], None)
+        record.set_property(['waves', 'signal_file_size'], None)
         record.set_property(['waves', 'segment_start'], None)
         record.set_property(['waves', 'segment_end'], None)
 
@@ -440,9 +462,7 @@ def open_segment(self, record, segname, start, signals):
         self.segment_end = start
 
     def write_signals(self, record, start, end, sigdata):
-        signals = sorted(sigdata, key = lambda a: (a.base_physio_id,
-                                                   a.channel,
-                                                   a.physio_id, a))
+        signals = [signal for (signal, _) in sigdata]
 
         if (signals != self.segment_signals
                 or self.segment_end is None
@@ -454,7 +474,7 @@ def write_signals(self, record, start, end, sigdata):
 
         # FIXME: this could be waaaay optimized, and should be
 
-        for (signal, samples) in sigdata.items():
+        for (signal, samples) in sigdata:
             spf = -(-_tpf // signal.sample_period)
             t0 = (start - self.segment_start) // signal.sample_period
             n = (end - start) // signal.sample_period
@@ -474,17 +494,47 @@ def flush_signals(self, record):
         if self.signal_file is not None:
             sf = record.open_bin_file(self.signal_file)
             sf.flush()
+            record.set_property(['waves', 'signal_file_size'], sf.size())
         record.set_property(['waves', 'segment_start'], self.segment_start)
         record.set_property(['waves', 'segment_end'], self.segment_end)
         record.set_property(['waves', 'flushed_time'], self.flushed_time)
 
 ################################################################
 
+def _signal_order(signal):
+    # Order in which signals are stored in the output files
+    return (signal.base_physio_id, signal.channel, signal.physio_id, signal)
+
 class SignalBuffer:
     """Object that tracks signal availability over time."""
     def __init__(self):
         self.signals = {}
 
+        # Heap of (start, order, serial, signal), where start is the
+        # starting time of the first chunk of the given signal.  When
+        # a signal's first chunk changes, a new entry is added, and
+        # the existing entry (which has a different serial number) is
+        # ignored.
+        self._queue = []
+        self._order = {}
+        self._serial = {}
+        self._next_serial = 0
+
+    def _requeue(self, signal):
+        self._next_serial += 1
+        self._serial[signal] = self._next_serial
+        start = self.signals[signal][1][0][0]
+        heapq.heappush(self._queue, (start, self._order[signal],
+                                     self._next_serial, signal))
+
+    def _peek(self):
+        queue = self._queue
+        while queue and queue[0][2] != self._serial.get(queue[0][3]):
+            heapq.heappop(queue)
+        if queue:
+            return queue[0]
+        return None
+
     def add_signal(self, signal, tps, start, samples):
         """Add signal data to the buffer."""
         if len(samples) == 0:
@@ -492,14 +542,25 @@ def add_signal(self, signal, tps, start, samples):
         info = self.signals.get(signal)
         if info is None:
             self.signals[signal] = (tps, [(start, samples)])
-            return
+            self._order[signal] = _signal_order(signal)
+            self._requeue(signal)
         else:
-            heapq.heappush(info[1], (start, samples))
+            smap = info[1]
+            old_start = smap[0][0]
+            heapq.heappush(smap, (start, samples))
+            if start < old_start:
+                self._requeue(signal)
 
     def truncate_before(self, t):
         """Delete data preceding a given point in time."""
-        dropped_signals = set()
-        for (signal, (tps, smap)) in self.signals.items():
+        updated_signals = []
+        while True:
+            entry = self._peek()
+            if entry is None or entry[0] >= t:
+                break
+            heapq.heappop(self._queue)
+            signal = entry[3]
+            (tps, smap) = self.signals[signal]
             while len(smap) > 0 and smap[0][0] <= t - tps:
                 (start0, samples0) = smap[0]
                 skipsamples = (t - start0) // tps
@@ -510,35 +571,46 @@ def truncate_before(self, t):
                 else:
                     heapq.heappop(smap)
             if len(smap) == 0:
-                dropped_signals.add(signal)
-        for signal in dropped_signals:
-            del self.signals[signal]
+                del self.signals[signal]
+                del self._order[signal]
+                del self._serial[signal]
+            else:
+                updated_signals.append(signal)
+        for signal in updated_signals:
+            self._requeue(signal)
 
     def get_signals(self):
-        """Retrieve a homogeneous chunk from the start of the buffer."""
-
-        # FIXME: keep a sorted list of signals, so that data can be a
-        # sorted list rather than a dictionary that we need to sort
-        # every time
-
-        start = None
+        """
+        Retrieve a homogeneous chunk from the start of the buffer.
+
+        The result is a tuple (start, end, data), where data is a list
+        of (signal, samples) pairs in output order.
+        """
+        entry = self._peek()
+        if entry is None:
+            return (None, None, None)
+
+        # Remove each signal that begins at the earliest time
+        start = entry[0]
         end = None
-        data = None
-        for (signal, (tps, smap)) in self.signals.items():
-            (start0, samples0) = smap[0]
-            end0 = start0 + len(samples0) // 2 * tps
-            if end is None:
-                start = start0
+        data = []
+        entries = []
+        while entry is not None and entry[0] == start:
+            entries.append(heapq.heappop(self._queue))
+            signal = entry[3]
+            (tps, smap) = self.signals[signal]
+            samples0 = smap[0][1]
+            end0 = start + len(samples0) // 2 * tps
+            if end is None or end0 < end:
                 end = end0
-                data = {signal: samples0}
-            elif start0 < start:
-                end = min(end0, start)
-                start = start0
-                data = {signal: samples0}
-            elif start0 == start:
-                end = min(end0, end)
-                data[signal] = samples0
-            else:
-                end = min(start0, end)
-        return (start, end, data)
+            data.append((signal, samples0))
+            entry = self._peek()
+
+        # The chunk ends when any of those signals end, or when any
+        # other signal begins
+        if entry is not None and entry[0] < end:
+            end = entry[0]
 
+        for entry in entries:
+            heapq.heappush(self._queue, entry)
+        return (start, end, data)
@@ -178,6 +178,15 @@ def __init__(self, mapping_id = None, seqnum = None,
         if seqnum_lt is not None:
             self.add_constraint('SequenceNumber < ', seqnum_lt)
 
+    def order(self):
+        # Rows with the same timestamp are sorted by sequence number,
+        # so that a query that stops at its limit can be resumed from
+        # the last timestamp and sequence number received.
+        if self.reverse:
+            return "TimeStamp DESC"
+        else:
+            return "TimeStamp, SequenceNumber"
+
 ################################################################
 
 # Accept either a UUID object or a string.
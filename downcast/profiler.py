@@ -0,0 +1,229 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lightweight timing of processing stages.
+
+Code that performs a stage of processing (such as executing a query,
+parsing a row, or calling a message handler) is bracketed by calls
+to begin() and end():
+
+    start = profiler.begin()
+    ...
+    profiler.end('parse', start)
+
+When profiling is inactive, begin() returns None and end() does
+nothing.  When it is active, each span is added to a ring buffer of
+recent spans, and to a running total for its stage.  Periodically
+(see maybe_dump()), the totals and the distribution of recent span
+durations are appended to a text file, and then reset.  A final
+summary should be written, by calling dump(), before the process
+exits.
+
+Stages may be nested: for example, 'execute' and 'parse' spans are
+part of the 'query' span that contains them.  The percentages in a
+summary can therefore add up to more than 100.
+
+Profiling can be switched on and off while the program is running, by
+sending a signal (see install().)  The signal is forwarded from the
+main process to its child processes; each process writes its own
+file.
+"""
+
+import os
+import time
+import signal
+import logging
+
+_ring_size = 65536
+
+class _ProfilerState:
+    def __init__(self, filename, interval, process):
+        self.filename = filename
+        self.interval = interval
+        self.process = process
+        self.children = []
+        self.reset()
+
+    def reset(self):
+        self.names = [None] * _ring_size
+        self.durations = [0.0] * _ring_size
+        self.position = 0
+        self.count = 0
+        self.totals = {}
+        self.start_time = time.monotonic()
+
+    def record(self, name, duration):
+        i = self.position
+        self.names[i] = name
+        self.durations[i] = duration
+        self.position = (i + 1) % _ring_size
+        self.count += 1
+        t = self.totals.get(name)
+        if t is None:
+            self.totals[name] = [1, duration, duration]
+        else:
+            t[0] += 1
+            t[1] += duration
+            if duration > t[2]:
+                t[2] = duration
+
+    def format(self):
+        """Summarize the spans recorded since the last reset."""
+        elapsed = time.monotonic() - self.start_time
+        n = min(self.count, _ring_size)
+        recent = {}
+        for i in range(self.position - n, self.position):
+            recent.setdefault(self.names[i], []).append(self.durations[i])
+
+        lines = ['# %s %s[%d]: %.1f s, %d spans%s'
+                 % (time.strftime('%Y-%m-%d %H:%M:%S'), self.process,
+                    os.getpid(), elapsed, self.count,
+                    (' (distribution of last %d)' % n
+                     if n < self.count else '')),
+                 '# stages may be nested, so % may total more than 100']
+        lines.append('%-32s %9s %10s %6s %9s %9s %9s %9s'
+                     % ('stage', 'count', 'total (s)', '%', 'mean (ms)',
+                        'p50 (ms)', 'p95 (ms)', 'max (ms)'))
+        for (name, (count, total, dmax)) in sorted(
+                self.totals.items(), key = lambda x: -x[1][1]):
+            d = sorted(recent.get(name, [0]))
+            lines.append('%-32s %9d %10.3f %6.1f %9.3f %9.3f %9.3f %9.3f'
+                         % (name, count, total,
+                            100 * total / elapsed if elapsed > 0 else 0,
+                            1000 * total / count,
+                            1000 * d[len(d) // 2],
+                            1000 * d[min(len(d) - 1, len(d) * 95 // 100)],
+                            1000 * dmax))
+        return ''.join(line + '\n' for line in lines) + '\n'
+
+    def dump(self):
+        """Append a summary to the output file, and reset."""
+        if self.count > 0:
+            text = self.format()
+            try:
+                # Worker processes may share a file with their
+                # parent, so write each summary in a single call
+                fd = os.open(self.filename,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+                try:
+                    os.write(fd, text.encode('UTF-8'))
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logging.warning('unable to write %s: %s'
+                                % (self.filename, e))
+        self.reset()
+
+_state = None
+_active = False
+_toggled = False
+
+def install(filename, interval = 60, signum = signal.SIGUSR2,
+            active = False):
+    """
+    Set up profiling for this process and its future child processes.
+
+    Summaries are appended to filename (and, for child processes, to a
+    file whose name includes the process name) every interval seconds
+    while profiling is active.  Sending the signal signum to the main
+    process switches profiling on or off.
+    """
+    global _state, _active
+    _state = _ProfilerState(filename, interval, 'main')
+    _active = active
+    signal.signal(signum, _handle_signal)
+
+def _handle_signal(signum, frame):
+    global _active, _toggled
+    if _state is None:
+        return
+    _active = not _active
+    if _active:
+        _state.reset()
+    else:
+        _toggled = True
+    for pid in _state.children:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+def add_child(pid):
+    """Forward profiling signals to a child process."""
+    if _state is not None:
+        _state.children.append(pid)
+
+def child_process(name, separate_file = True):
+    """
+    Start a separate profile for a new child process.
+
+    This should be called by the child process immediately after it
+    is forked; spans inherited from the parent are discarded.  If
+    separate_file is false, summaries are written to the parent's
+    file.
+    """
+    global _state
+    s = _state
+    if s is not None:
+        filename = s.filename
+        if separate_file:
+            (base, ext) = os.path.splitext(filename)
+            filename = '%s.%s%s' % (base, name, ext)
+        _state = _ProfilerState(filename, s.interval, name)
+
+def active():
+    """Check whether profiling is active."""
+    return _active
+
+def begin():
+    """Start timing a span; returns None if profiling is inactive."""
+    if _active:
+        return time.perf_counter()
+    return None
+
+def end(name, start):
+    """Finish timing a span that was started by begin()."""
+    if start is not None and _active:
+        _state.record(name, time.perf_counter() - start)
+
+def record(name, duration):
+    """Record a span whose duration (in seconds) is already known."""
+    if _active:
+        _state.record(name, duration)
+
+def maybe_dump():
+    """
+    Write a summary if the dump interval has elapsed.
+
+    This also writes a final summary after profiling is switched off.
+    """
+    global _toggled
+    s = _state
+    if s is None:
+        return
+    if _toggled:
+        _toggled = False
+        s.dump()
+    elif _active and time.monotonic() - s.start_time >= s.interval:
+        s.dump()
+
+def dump():
+    """Write a summary immediately, if any spans have been recorded."""
+    if _state is not None:
+        _state.dump()
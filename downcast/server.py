@@ -20,6 +20,7 @@
 import warnings
 import os
 
+from . import profiler
 from .parser import (WaveAttrParser, NumericAttrParser,
                      EnumerationAttrParser, PatientMappingParser,
                      DBSyntaxError)
@@ -33,20 +34,24 @@ def load_config(filename):
         DWCDB._config = ConfigParser()
         DWCDB._config.read(filename)
 
+    # The first DWCDB object created for each server.  Every message
+    # carries a reference to its origin, so when messages are
+    # unpickled (in a child process), they all refer to this object
+    # rather than creating a new one per message.
+    _shared = {}
+
     def __init__(self, servername):
         self._server = DWCDBServer.get(servername)
         self.servername = servername
         self.dialect = self._server.dialect
         self.paramstyle = self._server.paramstyle
+        DWCDB._shared.setdefault(servername, self)
 
     def __repr__(self):
         return ('%s(%r)' % (self.__class__.__name__, self.servername))
 
-    def __getstate__(self):
-        return self.servername
-
-    def __setstate__(self, servername):
-        DWCDB.__init__(self, servername)
+    def __reduce__(self):
+        return (_shared_dwcdb, (self.servername,))
 
     def connect(self):
         return self._server.connect()
@@ -63,10 +68,14 @@ def get_messages(self, parser, connection = None, cursor = None):
                 tmpconn = self._server.connect()
                 cur = tmpcur = tmpconn.cursor()
             for (query, handler) in parser.queries():
+                start = profiler.begin()
                 cur.execute(*query)
+                profiler.end('execute', start)
                 row = cur.fetchone()
                 while row is not None:
+                    start = profiler.begin()
                     msg = handler(self, row)
+                    profiler.end('parse', start)
                     if msg is not None:
                         yield msg
                     row = cur.fetchone()
@@ -180,6 +189,12 @@ def _parse_attr(self, parser, sync):
             raise UnknownAttrError()
         return results[0]
 
+def _shared_dwcdb(servername):
+    db = DWCDB._shared.get(servername)
+    if db is None:
+        db = DWCDB(servername)
+    return db
+
 class DWCDBServer:
     _named_servers = {}
 
@@ -202,6 +217,8 @@ def __init__(self, servername):
         elif self.dbtype == 'bcp':
             from .db import dwcbcp
             self.bcpdirs = DWCDB._config[servername]['bcp-path']
+            self.bcpfollow = DWCDB._config.getboolean(
+                servername, 'bcp-follow', fallback = False)
             self.dialect = 'sqlite'
             self.paramstyle = dwcbcp.paramstyle
         else:
@@ -231,7 +248,8 @@ def connect(self):
             return sqlite3.connect(self.filename)
         elif self.dbtype == 'bcp':
             from .db import dwcbcp
-            return dwcbcp.connect(self.bcpdirs.split(':'))
+            return dwcbcp.connect(self.bcpdirs.split(':'),
+                                  follow = self.bcpfollow)
 
 class UnknownAttrError(Exception):
     """Internal exception indicating the object does not exist."""
@@ -22,9 +22,12 @@
 import traceback
 import logging
 import cProfile
+import time
 import os
 import sys
 
+from . import metrics
+from . import profiler
 from .dispatcher import Dispatcher
 
 class ParallelDispatcher:
@@ -127,6 +130,7 @@ def __init__(self, handler, pending_limit = 50, name = None):
         self.pending_count = pending_limit
         self.messages = {}
         self.message_id = 0
+        self.name = name
 
         (parent_pipe, child_pipe) = Pipe()
         ChildConnector._all_pipes.add(parent_pipe)
@@ -135,6 +139,7 @@ def __init__(self, handler, pending_limit = 50, name = None):
                                args = (name, child_pipe),
                                name = name)
         self.process.start()
+        profiler.add_child(self.process.pid)
         self.parent_pipe = parent_pipe
         child_pipe.close()
 
@@ -181,7 +186,12 @@ def _async_message(self, channel, message, source, ttl):
 
     def _async_request(self, request):
         if self.pending_count <= 0:
+            start = time.monotonic()
             self._sync_response()
+            metrics.inc('downcast_child_backpressure_waits_total',
+                        child = self.name)
+            metrics.inc('downcast_child_backpressure_seconds_total',
+                        time.monotonic() - start, child = self.name)
         self.parent_pipe.send(request)
         self.pending_count -= 1
 
@@ -222,6 +232,11 @@ def _main(self, name, child_pipe):
                 p.close()
             ChildConnector._all_pipes = set()
 
+            if name is not None:
+                metrics.child_process(name)
+                metrics.add_collector(self.handler.collect_metrics)
+                profiler.child_process(name)
+
             self.pipe = child_pipe
             pf = os.environ.get('DOWNCAST_PROFILE_OUT', None)
             if pf is not None and name is not None:
@@ -240,6 +255,7 @@ def _main1(self):
                 try:
                     req = self.pipe.recv()
                 except EOFError:
+                    profiler.dump()
                     return
                 except (OSError, MemoryError):
                     raise
@@ -271,11 +287,20 @@ def _main1(self):
                     self.acks = []
                     self.pipe.send(resp)
                     counter = 0
+                    metrics.maybe_write()
+                    profiler.maybe_dump()
                 elif req is ChildRequest.FLUSH:
+                    start = time.perf_counter()
                     self.handler.flush()
+                    elapsed = time.perf_counter() - start
+                    metrics.observe('downcast_flush_seconds', elapsed)
+                    profiler.record('flush', elapsed)
+                    metrics.write()
+                    profiler.maybe_dump()
                 elif req is ChildRequest.TERMINATE:
                     self.handler.terminate()
                 elif req is ChildRequest.EXIT:
+                    profiler.dump()
                     return
         except Exception as exc:
             exc_msg = traceback.format_exc()
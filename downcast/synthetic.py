@@ -0,0 +1,454 @@
+#
+# downcast - tools for unpacking patient data from DWC
+#
+# Copyright (c) 2018 Laboratory for Computational Physiology
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generate synthetic DWC data, in the format of a bcp data directory.
+
+The generated data is not physiologically meaningful, but has
+roughly the same shape as real data: each bed produces waveform
+samples in 256-millisecond messages, numerics once per second, and
+occasional enumeration values and alerts.  Each bed's wall clock may
+be adjusted (forward or backward) a given number of times, while
+its sequence numbers continue to increase steadily.
+
+The output directory can be used as a 'bcp' server (see
+downcast.db.dwcbcp.DWCBCPConnection.)  A summary of the data is
+written to 'synthetic.json'.
+"""
+
+import os
+import sys
+import json
+import math
+import heapq
+import uuid
+import random
+import struct
+from array import array
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+
+from .timestamp import T
+from .db.dwcbcp import _table_columns
+
+# Column order of the WaveSample table (the binary WaveSamples column
+# must be followed by the columns matched by the sync pattern)
+_wave_sample_columns = ['WaveId', 'TimeStamp', 'SequenceNumber',
+                        'WaveSamples', 'UnavailableSamples',
+                        'InvalidSamples', 'PacedPulses', 'MappingId']
+
+_data_tables = ['Alert', 'BedTag', 'EnumerationValue', 'NumericValue',
+                'Patient', 'PatientDateAttribute', 'PatientMapping',
+                'PatientStringAttribute', 'WaveSample']
+
+# Waveforms: (label, base physio ID, physio ID, sample period (ms),
+# unit label, unit code, calibration range, shape)
+_wave_types = [
+    ('II',    131328, 131329, 4,  'mV',   4256, ('-1', '1'),   'ecg'),
+    ('ABP',   150016, 150017, 8,  'mmHg', 3872, ('0', '200'),  'pulse'),
+    ('Pleth', 150452, 150452, 8,  '',     512,  ('0', '1'),    'pulse'),
+    ('Resp',  151562, 151562, 16, 'Ohm',  0,    ('0', '1'),    'sine'),
+    ('V',     131389, 131390, 4,  'mV',   4256, ('-1', '1'),   'ecg'),
+    ('CVP',   150084, 150085, 8,  'mmHg', 3872, ('0', '40'),   'sine'),
+    ('PAP',   150044, 150045, 8,  'mmHg', 3872, ('0', '80'),   'pulse'),
+    ('aVF',   131334, 131335, 4,  'mV',   4256, ('-1', '1'),   'ecg'),
+]
+
+# Numerics: (label, base physio ID, sub-physio ID, unit label, typical
+# value)
+_numeric_types = [
+    ('HR',    147842, 147842, '/min', 80),
+    ('SpO2',  150456, 150456, '%',    97),
+    ('RR',    151562, 151562, '/min', 16),
+    ('ABPs',  150016, 150017, 'mmHg', 120),
+    ('ABPd',  150016, 150018, 'mmHg', 70),
+    ('ABPm',  150016, 150019, 'mmHg', 90),
+]
+
+_enum_values = ['Sinus Rhythm', 'Sinus Tachy', 'Sinus Brady', 'Irregular HR']
+_alert_labels = ['HR High', 'SpO2 Low', 'ABPs High', 'Leads Off']
+
+_message_interval = 256         # ms of waveform data per message
+_numeric_interval = 1024        # ms between numeric values
+_enum_interval = 60 * 1024      # ms between enumeration values
+_alert_interval = 15 * 60 * 1024 # mean ms between alerts
+_max_clock_jump = 60 * 1000     # largest clock adjustment (ms)
+
+def _wave_cycle(shape, scale_upper, period, rnd):
+    # One second of samples, as 16-bit little-endian integers
+    n = 1000 // period
+    v = array('H')
+    for i in range(n):
+        x = i / n
+        if shape == 'ecg':
+            y = math.exp(-((x - 0.3) * 40) ** 2) - 0.1 * math.sin(2*math.pi*x)
+        elif shape == 'pulse':
+            y = max(0, math.sin(2 * math.pi * x)) ** 2
+        else:
+            y = 0.5 + 0.5 * math.sin(2 * math.pi * x)
+        y = y + rnd.uniform(-0.01, 0.01)
+        v.append(min(scale_upper, max(1, int(scale_upper * (0.2 + 0.6*y)))))
+    if sys.byteorder == 'big':
+        v.byteswap()
+    return v.tobytes()
+
+class _TimeFormatter:
+    # Format wall-clock times (epoch milliseconds) as DWC timestamps.
+    def __init__(self, tz):
+        self.tz = tz
+        self.offset = int(tz.utcoffset(None).total_seconds() * 1000)
+        m = self.offset // 60000
+        self._suffix = ' %s%02d:%02d' % ('-' if m < 0 else '+',
+                                         abs(m) // 60, abs(m) % 60)
+        self._second = None
+        self._prefix = None
+
+    def format(self, ms):
+        (s, frac) = divmod(ms, 1000)
+        if s != self._second:
+            d = datetime.fromtimestamp(s, self.tz)
+            self._prefix = d.strftime('%Y-%m-%d %H:%M:%S.')
+            self._second = s
+        return '%s%03d%s' % (self._prefix, frac, self._suffix)
+
+    def day(self, ms):
+        return (ms + self.offset) // 86400000
+
+class SyntheticBed:
+    """Generator of data for a single bed."""
+
+    def __init__(self, index, start_ms, end_ms, signals, clock_adjustments,
+                 fmt, rnd):
+        self.index = index
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.signals = signals
+        self.fmt = fmt
+        self.rnd = rnd
+        self.mapping_id = str(uuid.UUID(int = rnd.getrandbits(128))).upper()
+        self.patient_id = str(uuid.UUID(int = rnd.getrandbits(128))).upper()
+        self.base_seqnum = rnd.randrange(10**11, 10**12) // 1024 * 1024
+
+        # Clock adjustments, as (relative time, change in ms).  These
+        # are kept at least _max_clock_jump apart, so that the clock
+        # never goes backward by more than that (see rows())
+        self.adjustments = []
+        t = -_max_clock_jump
+        for rt in sorted(rnd.randrange(end_ms - start_ms)
+                         for _ in range(clock_adjustments)):
+            t = max(rt, t + _max_clock_jump)
+            jump = rnd.randrange(1000, _max_clock_jump)
+            self.adjustments.append((t, rnd.choice((-1, 1)) * jump))
+
+        # One second of each waveform, repeated twice so that any
+        # message's worth of samples can be sliced out of it
+        self.cycles = [_wave_cycle(s[7], 4095, s[3], rnd) * 2
+                       for s in signals]
+        self.count = 0
+
+    def _rows(self):
+        # Rows in order of sequence number, as (wall-clock time, table,
+        # values)
+        fmt = self.fmt
+        rnd = self.rnd
+        n = self.index
+        mid = self.mapping_id
+        pid = self.patient_id
+        t0 = self.start_ms
+
+        ts = fmt.format(t0)
+        yield (t0, 'Patient', {
+            'Id': pid, 'Timestamp': ts, 'BedLabel': 'BED%02d' % n,
+            'Alias': '\0', 'Category': 1, 'Height': '170', 'HeightUnit': 1,
+            'Weight': '70', 'WeightUnit': 1, 'PressureUnit': 1,
+            'PacedMode': 0, 'ResuscitationStatus': 0, 'AdmitState': 1,
+            'ClinicalUnit': 'ICU', 'Gender': rnd.choice((1, 2))})
+        yield (t0, 'PatientStringAttribute', {
+            'PatientId': pid, 'Timestamp': ts, 'Name': 'Notes',
+            'Value': 'synthetic patient %d' % n})
+        yield (t0, 'PatientDateAttribute', {
+            'PatientId': pid, 'Timestamp': ts, 'Name': 'DOB',
+            'Value': '1950-01-01 00:00:00'})
+
+        adjustments = list(self.adjustments)
+        offset = 0
+        next_alert = rnd.expovariate(1 / _alert_interval)
+        for rel in range(0, self.end_ms - t0, _message_interval):
+            while adjustments and adjustments[0][0] <= rel:
+                offset += adjustments.pop(0)[1]
+            wall = t0 + rel + offset
+            sn = self.base_seqnum + rel
+            ts = fmt.format(wall)
+            for (i, sig) in enumerate(self.signals):
+                period = sig[3]
+                nsamples = _message_interval // period
+                cycle = self.cycles[i]
+                k = (rel // period * 2) % (len(cycle) // 2)
+                samples = cycle[k : k + nsamples * 2]
+                yield (wall, 'WaveSample', {
+                    'WaveId': i + 1, 'TimeStamp': ts, 'SequenceNumber': sn,
+                    'WaveSamples': samples, 'MappingId': mid})
+            if rel % _numeric_interval == 0:
+                for (i, num) in enumerate(_numeric_types):
+                    v = num[4] + rnd.randrange(-5, 6)
+                    yield (wall, 'NumericValue', {
+                        'NumericId': i + 1, 'TimeStamp': ts,
+                        'SequenceNumber': sn, 'IsTrendUploaded': 1,
+                        'CompoundValueId': str(uuid.UUID(
+                            int = rnd.getrandbits(128))).upper(),
+                        'Value': str(v), 'MappingId': mid})
+            if rel % _enum_interval == 0:
+                yield (wall, 'EnumerationValue', {
+                    'EnumerationId': 1, 'TimeStamp': ts,
+                    'SequenceNumber': sn,
+                    'CompoundValueId': str(uuid.UUID(
+                        int = rnd.getrandbits(128))).upper(),
+                    'Value': rnd.choice(_enum_values), 'MappingId': mid})
+            if rel >= next_alert:
+                next_alert += rnd.expovariate(1 / _alert_interval)
+                end = fmt.format(wall + rnd.randrange(1000, 60000))
+                yield (wall, 'Alert', {
+                    'TimeStamp': ts, 'SequenceNumber': sn,
+                    'AlertId': str(uuid.UUID(
+                        int = rnd.getrandbits(128))).upper(),
+                    'Source': 1, 'Code': rnd.randrange(1, 1000),
+                    'Label': rnd.choice(_alert_labels),
+                    'Severity': rnd.randrange(0, 3), 'Kind': 1,
+                    'IsSilenced': 0, 'SubtypeId': 0,
+                    'AnnounceTime': ts, 'OnsetTime': ts, 'EndTime': end,
+                    'MappingId': mid})
+
+    def rows(self):
+        """
+        Generate rows for this bed, in order of wall-clock time.
+
+        Each row is a tuple (time, bed, count, table, values), where
+        time is the wall-clock time in milliseconds.  Since the clock
+        may be adjusted backward by up to _max_clock_jump, rows are
+        held in a buffer until no later row can precede them.
+        """
+        pending = []
+        for (wall, table, values) in self._rows():
+            self.count += 1
+            heapq.heappush(pending, (wall, self.index, self.count,
+                                     table, values))
+            while pending[0][0] < wall - _max_clock_jump:
+                yield heapq.heappop(pending)
+        while pending:
+            yield heapq.heappop(pending)
+
+def _write_format_file(path, columns):
+    with open(path, 'wt') as f:
+        f.write('10.0\n%d\n' % len(columns))
+        for (i, (name, ty)) in enumerate(columns):
+            if ty.__name__ == 'BINARY':
+                f.write('%d\tSYBBINARY\t4\t-1\t""\t%d\t%s\t""\n'
+                        % (i + 1, i + 1, name))
+            else:
+                term = ('"\\n"' if i == len(columns) - 1 else '"\\t"')
+                f.write('%d\tSYBCHAR\t0\t-1\t%s\t%d\t%s\t""\n'
+                        % (i + 1, term, i + 1, name))
+
+class _TableWriter:
+    def __init__(self, dirname, table):
+        self.dirname = dirname
+        self.table = table
+        types = _table_columns['_Export.%s_' % table]
+        if table == 'WaveSample':
+            names = _wave_sample_columns
+        else:
+            names = list(types)
+        self.columns = [(name, types[name]) for name in names]
+        _write_format_file(os.path.join(dirname, table + '.fmt'),
+                           self.columns)
+        self.fp = None
+        self.rows = 0
+
+    def open(self, suffix):
+        self.close()
+        self.fp = open(os.path.join(self.dirname, self.table + suffix), 'wb')
+
+    def write(self, values):
+        out = []
+        last = len(self.columns) - 1
+        for (i, (name, ty)) in enumerate(self.columns):
+            v = values.get(name)
+            if ty.__name__ == 'BINARY':
+                if v is None:
+                    v = b''
+                out.append(struct.pack('<I', len(v)))
+                out.append(v)
+            else:
+                if v is not None:
+                    out.append(str(v).encode('UTF-8'))
+                out.append(b'\n' if i == last else b'\t')
+        self.fp.write(b''.join(out))
+        self.rows += 1
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+def _write_metadata(dirname, signals):
+    w = _TableWriter(dirname, 'Wave')
+    w.open('')
+    for (i, s) in enumerate(signals):
+        w.write({
+            'Id': i + 1, 'BasePhysioId': s[1], 'PhysioId': s[2],
+            'Label': s[0], 'Channel': i + 1, 'SamplePeriod': s[3],
+            'IsSlowWave': 0, 'IsDerived': 0, 'Color': 0,
+            'ScaleLower': 0, 'ScaleUpper': 4095,
+            'CalibrationScaledLower': 0, 'CalibrationScaledUpper': 4095,
+            'CalibrationAbsLower': s[6][0], 'CalibrationAbsUpper': s[6][1],
+            'CalibrationType': 0, 'UnitLabel': s[4] or '\0',
+            'UnitCode': s[5], 'EcgLeadPlacement': 0})
+    w.close()
+
+    w = _TableWriter(dirname, 'Numeric')
+    w.open('')
+    for (i, n) in enumerate(_numeric_types):
+        w.write({
+            'Id': i + 1, 'BasePhysioId': n[1], 'PhysioId': n[1],
+            'Label': n[0], 'IsAperiodic': 0, 'UnitLabel': n[3],
+            'Validity': 0, 'LowerLimit': '0', 'UpperLimit': '300',
+            'IsAlarmingOff': 0, 'SubPhysioId': n[2], 'SubLabel': n[0],
+            'Color': 0, 'IsManual': 0, 'MaxValues': 1, 'Scale': 0})
+    w.close()
+
+    w = _TableWriter(dirname, 'Enumeration')
+    w.open('')
+    w.write({
+        'Id': 1, 'BasePhysioId': 184327, 'PhysioId': 184327,
+        'Label': 'Rhythm', 'ValuePhysioId': 184327, 'IsAperiodic': 1,
+        'IsManual': 0, 'Validity': 0, 'UnitCode': 0, 'UnitLabel': '\0',
+        'Color': 0})
+    w.close()
+
+def generate(dirname, beds = 4, hours = 1.0, signals = 4,
+             clock_adjustments = 0, start = None, seed = 1):
+    """
+    Write a synthetic data directory.
+
+    beds is the number of patients (who are all monitored for the
+    entire period); hours is the length of the period; signals is
+    the number of waveforms per bed (at most 8); clock_adjustments
+    is the number of times each bed's clock is adjusted.  start is
+    the starting time (a T object or a string.)
+
+    Returns a summary dictionary, which is also written to
+    'synthetic.json'.
+    """
+    if not 1 <= signals <= len(_wave_types):
+        raise ValueError('number of signals must be between 1 and %d'
+                         % len(_wave_types))
+    if start is None:
+        start = T('2016-01-28 14:00:00.000 -05:00')
+    else:
+        start = T(start)
+    tz = timezone(start.utcoffset())
+    fmt = _TimeFormatter(tz)
+    start_ms = int(start.timestamp()) * 1000 + start.microsecond // 1000
+    end_ms = start_ms + int(hours * 3600 * 1000)
+    rnd = random.Random(seed)
+    sigtypes = _wave_types[:signals]
+
+    os.makedirs(dirname, exist_ok = True)
+    _write_metadata(dirname, sigtypes)
+    writers = {t: _TableWriter(dirname, t) for t in _data_tables}
+
+    beds = [SyntheticBed(i, start_ms + rnd.randrange(5 * 60 * 1000),
+                         end_ms, sigtypes, clock_adjustments, fmt,
+                         random.Random(rnd.getrandbits(64)))
+            for i in range(beds)]
+
+    # Each patient is mapped to a bed shortly before the start
+    mappings = []
+    for b in beds:
+        t = start_ms - 10 * 60 * 1000 + b.index
+        mappings.append((t, b.index, 0, 'PatientMapping', {
+            'Id': b.mapping_id, 'PatientId': b.patient_id,
+            'Timestamp': fmt.format(t), 'IsMapped': 1,
+            'Hostname': 'MONITOR%02d' % b.index}))
+
+    day = None
+    first = last = None
+    for row in heapq.merge(mappings, *(b.rows() for b in beds)):
+        (wall, _, _, table, values) = row
+        d = fmt.day(wall)
+        if d != day:
+            date0 = datetime(1970, 1, 1) + timedelta(days = d)
+            date1 = date0 + timedelta(days = 1)
+            suffix = '.%s_%s' % (date0.strftime('%Y%m%d'),
+                                 date1.strftime('%Y%m%d'))
+            for w in writers.values():
+                w.open(suffix)
+            day = d
+        writers[table].write(values)
+        if first is None:
+            first = wall
+        last = wall
+    for w in writers.values():
+        w.close()
+
+    summary = {
+        'start': fmt.format(first),
+        'end': fmt.format(last),
+        'data_start': fmt.format(start_ms),
+        'data_end': fmt.format(end_ms),
+        'beds': len(beds),
+        'signals': [s[0] for s in sigtypes],
+        'clock_adjustments': clock_adjustments,
+        'seed': seed,
+        'rows': {t: w.rows for (t, w) in sorted(writers.items())},
+    }
+    with open(os.path.join(dirname, 'synthetic.json'), 'wt') as f:
+        json.dump(summary, f, indent = 1, sort_keys = True)
+        f.write('\n')
+    return summary
+
+def main():
+    p = ArgumentParser(
+        description = 'Generate synthetic DWC data in bcp format.')
+    p.add_argument('--beds', metavar = 'N', type = int, default = 4,
+                   help = 'number of beds (default: 4)')
+    p.add_argument('--hours', metavar = 'H', type = float, default = 1.0,
+                   help = 'length of time to generate (default: 1)')
+    p.add_argument('--signals', metavar = 'N', type = int, default = 4,
+                   help = 'number of waveforms per bed (default: 4)')
+    p.add_argument('--clock-adjustments', metavar = 'N', type = int,
+                   default = 0,
+                   help = 'number of clock adjustments per bed')
+    p.add_argument('--start', metavar = 'TIME',
+                   default = '2016-01-28 14:00:00.000 -05:00',
+                   help = 'starting time')
+    p.add_argument('--seed', metavar = 'N', type = int, default = 1,
+                   help = 'random number seed')
+    p.add_argument('output_dir', metavar = 'DIR',
+                   help = 'directory to store data files')
+    opts = p.parse_args()
+
+    if os.path.exists(opts.output_dir):
+        sys.exit('%s: directory %s already exists'
+                 % (sys.argv[0], opts.output_dir))
+    summary = generate(opts.output_dir, beds = opts.beds,
+                       hours = opts.hours, signals = opts.signals,
+                       clock_adjustments = opts.clock_adjustments,
+                       start = opts.start, seed = opts.seed)
+    for (table, n) in summary['rows'].items():
+        print('%-24s %10d' % (table, n))
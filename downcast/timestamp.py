@@ -19,6 +19,22 @@
 import re
 from datetime import datetime, timedelta, timezone
 
+# Timezone objects, indexed by UTC offset in minutes
+_timezones = {}
+
+def fixed_timezone(minutes):
+    """Get a timezone object for a fixed UTC offset in minutes."""
+    tz = _timezones.get(minutes)
+    if tz is None:
+        tz = _timezones[minutes] = timezone(timedelta(minutes = minutes))
+    return tz
+
+# Recently parsed timestamps, indexed by the original string (or
+# bytes).  Consecutive rows frequently have identical timestamps, so
+# this avoids parsing the same string repeatedly.
+_parsed = {}
+_parsed_max = 4096
+
 class T(datetime):
     """Date/time class using MS SQL time string format.
 
@@ -28,8 +44,14 @@ class T(datetime):
 
     Addition, subtraction, and comparison work as for normal datetime
     objects.  repr and str produce something sensible.
+
+    For arithmetic in inner loops, to_us() and from_us() convert
+    between T objects and integer microseconds.
     """
 
+    # Cached result of to_us()
+    __slots__ = ('_us',)
+
     # Note the unusual format of the timezone which (for some
     # braindead reason) means we can't use datetime.strptime or
     # datetime.strftime.  It's especially braindead given that
@@ -38,8 +60,22 @@ class T(datetime):
                           '(\d+):(\d+):(\d+)(\.\d+)\s*' +
                           '([-+])(\d+):(\d+)\Z', re.ASCII)
 
-    def __new__(cls, val, _tz = None):
-        if isinstance(val, datetime):
+    def __new__(cls, val, *args, **kwargs):
+        if args or kwargs:
+            # Standard datetime constructor arguments (used by
+            # datetime arithmetic and by pickle)
+            return datetime.__new__(cls, val, *args, **kwargs)
+        elif type(val) is cls:
+            return val
+        elif isinstance(val, str):
+            t = _parsed.get(val)
+            if t is None or type(t) is not cls:
+                t = cls._parse(val)
+                if len(_parsed) >= _parsed_max:
+                    _parsed.clear()
+                _parsed[val] = t
+            return t
+        elif isinstance(val, datetime):
             tz = val.tzinfo
             if tz is None:
                 raise TypeError('missing timezone')
@@ -53,8 +89,34 @@ def __new__(cls, val, _tz = None):
                 second = val.second,
                 microsecond = val.microsecond,
                 tzinfo = tz)
-        elif isinstance(val, bytes) and isinstance(_tz, timezone):
-            return datetime.__new__(cls, val, _tz)
+        raise TypeError('cannot convert %s to %s'
+                        % (type(val).__name__, cls.__name__))
+
+    @classmethod
+    def _parse(cls, val):
+        # Fast path for the canonical format, which is what DWC
+        # always produces: 'YYYY-MM-DD HH:MM:SS.fff +HH:MM'
+        if (len(val) == 30 and val[4] == '-' and val[7] == '-'
+                and val[10] == ' ' and val[13] == ':' and val[16] == ':'
+                and val[19] == '.' and val[23] == ' ' and val[27] == ':'
+                and (val[24] == '+' or val[24] == '-')):
+            digits = (val[0:4] + val[5:7] + val[8:10] + val[11:13]
+                      + val[14:16] + val[17:19] + val[20:23]
+                      + val[25:27] + val[28:30])
+            if digits.isdigit() and digits.isascii():
+                second = int(val[17:19])
+                microsecond = int(val[20:23]) * 1000
+                if second == 60:
+                    second = 59
+                    microsecond = 999000 + microsecond // 1000
+                tzoffs = int(val[25:27]) * 60 + int(val[28:30])
+                if val[24] == '-':
+                    tzoffs = -tzoffs
+                return datetime.__new__(
+                    cls,
+                    int(val[0:4]), int(val[5:7]), int(val[8:10]),
+                    int(val[11:13]), int(val[14:16]), second,
+                    microsecond, fixed_timezone(tzoffs))
 
         m = T._pattern.match(val)
         if m is None:
@@ -73,8 +135,7 @@ def __new__(cls, val, _tz = None):
             microsecond = 999000 + microsecond // 1000
 
         tzs = 1 if m.group(8) == '+' else -1
-        tz = timezone(timedelta(hours = tzs * int(m.group(9)),
-                                minutes = tzs * int(m.group(10))))
+        tz = fixed_timezone(tzs * (int(m.group(9)) * 60 + int(m.group(10))))
 
         return datetime.__new__(
             cls,
@@ -87,15 +148,22 @@ def __new__(cls, val, _tz = None):
             microsecond = microsecond,
             tzinfo = tz)
 
+    # Since Python 3.8, datetime arithmetic returns an object of the
+    # same class; older versions return a plain datetime.
+
     def __add__(a, b):
-        return T(datetime.__add__(a, b))
+        d = datetime.__add__(a, b)
+        if isinstance(d, datetime) and not isinstance(d, T):
+            return T(d)
+        return d
+
+    __radd__ = __add__
 
     def __sub__(a, b):
         d = datetime.__sub__(a, b)
-        if isinstance(d, datetime):
+        if isinstance(d, datetime) and not isinstance(d, T):
             return T(d)
-        else:
-            return d
+        return d
 
     def __str__(self):
         tzoffs = round(self.tzinfo.utcoffset(None).total_seconds() / 60)
@@ -120,11 +188,38 @@ def strftime_utc(self, fmt):
         """Convert time to UTC and format as a string."""
         return datetime.strftime(self.astimezone(timezone.utc), fmt)
 
+def parse_bytes(val):
+    """Convert an ASCII byte string to a T object."""
+    t = _parsed.get(val)
+    if t is None:
+        t = T._parse(val.decode())
+        if len(_parsed) >= _parsed_max:
+            _parsed.clear()
+        _parsed[val] = t
+    return t
+
+_epoch = datetime(1970, 1, 1, tzinfo = timezone.utc)
+_one_us = timedelta(microseconds = 1)
+
+def to_us(time):
+    """Convert a timestamp to integer microseconds since the epoch."""
+    try:
+        return time._us
+    except AttributeError:
+        us = (time - _epoch) // _one_us
+        if isinstance(time, T):
+            time._us = us
+        return us
+
+def from_us(us, tz):
+    """Convert integer microseconds since the epoch to a T object."""
+    t = T(_epoch.astimezone(tz) + timedelta(microseconds = us))
+    t._us = us
+    return t
+
 def delta_ms(time_a, time_b):
     """Compute the difference between two timestamps in milliseconds."""
-    delta = time_a - time_b
-    return ((delta.days * 86400 + delta.seconds) * 1000
-            + (delta.microseconds // 1000))
+    return (to_us(time_a) - to_us(time_b)) // 1000
 
 very_old_timestamp = T('1800-01-01 00:00:00.000 +00:00')
 dwc_epoch = T('2000-01-01 12:00:00.000 +00:00')